@@ -4,15 +4,23 @@
 This module abstracts the DRMAA native specification and provides
 convenience functions for running Drmaa jobs.
 
+:class:`JobPoller` collects finished jobs for many outstanding
+job ids from a single thread.
+
+Jobs that fail because they exceeded their memory reservation
+raise :class:`JobMemoryError` (see :func:`isMemoryError`).
+
 
 Reference
 ---------
 
 '''
 
+import concurrent.futures
 import re
 import os
 import stat
+import threading
 import time
 import CGAT.Experiment as E
 
@@ -25,6 +33,41 @@ except (ImportError, RuntimeError):
     HAS_DRMAA = False
 
 
+# messages in stderr indicating that a job ran out of memory
+MEMORY_ERROR_PATTERNS = re.compile(
+    "MemoryError|std::bad_alloc|Cannot allocate memory|"
+    "[Oo]ut of memory|OutOfMemoryError|memory exhausted|"
+    "cannot allocate vector of size")
+
+
+class JobMemoryError(OSError):
+    '''a job failed because it exceeded its memory reservation.'''
+    pass
+
+
+def isMemoryError(stderr, max_memory=None, job_memory=None):
+    '''return True if a failed job ran out of memory.
+
+    A job is deemed to have run out of memory if its standard error
+    contains a typical out-of-memory message or if its peak memory
+    usage has come within 5% of its reservation.
+
+    Arguments
+    ---------
+    stderr : list
+        Lines of standard error of the job.
+    max_memory : float
+        Peak memory usage of the job in bytes, if known.
+    job_memory : int
+        Memory reservation of the job in bytes, if known.
+    '''
+    if MEMORY_ERROR_PATTERNS.search("".join(stderr)):
+        return True
+    if max_memory and job_memory:
+        return max_memory >= 0.95 * job_memory
+    return False
+
+
 def setupDrmaaJobTemplate(drmaa_session, options, job_name, job_memory):
     '''Sets up a Drmma job template. Currently SGE, SLURM, Torque and PBSPro are
        supported'''
@@ -296,12 +339,15 @@ def expandStatement(statement, ignore_pipe_errors=False):
         return " ".join((_exec_prefix, statement, _exec_suffix))
 
 
-def collectSingleJobFromCluster(session, job_id,
-                                statement,
-                                stdout_path, stderr_path,
-                                job_path,
-                                ignore_errors=False):
-    '''runs a single job on the cluster.'''
+def waitForJob(session, job_id):
+    '''wait for a job to finish.
+
+    Returns
+    -------
+    retval : drmaa.JobInfo
+        Job information or None if the queue manager could not
+        provide it.
+    '''
     try:
         retval = session.wait(
             job_id, drmaa.Session.TIMEOUT_WAIT_FOREVER)
@@ -310,14 +356,72 @@ def collectSingleJobFromCluster(session, job_id,
         # finished but resource usage information and/or
         # termination status could not be provided.":
 
-        if not msg.message.startswith("code 24"):
+        if not str(msg).startswith("code 24"):
             raise
         retval = None
+    return retval
+
+
+def collectSingleJobFromCluster(session, job_id,
+                                statement,
+                                stdout_path, stderr_path,
+                                job_path,
+                                ignore_errors=False):
+    '''runs a single job on the cluster.'''
+    retval = waitForJob(session, job_id)
+
+    checkJobFromCluster(retval,
+                        statement,
+                        stdout_path,
+                        stderr_path,
+                        job_path,
+                        ignore_errors=ignore_errors)
 
+
+def checkJobFromCluster(retval,
+                        statement,
+                        stdout_path, stderr_path,
+                        job_path,
+                        ignore_errors=False,
+                        job_memory=None):
+    '''check the outcome of a finished cluster job and clean up.
+
+    Arguments
+    ---------
+    retval : drmaa.JobInfo
+        Job information as returned by :meth:`drmaa.Session.wait`.
+        Can be None if the queue manager could not provide it.
+    statement : string
+        The statement that was executed, used for error reporting.
+    job_memory : int
+        Memory reservation of the job in bytes.
+
+    Raises
+    ------
+    JobMemoryError
+        If the job failed because it ran out of memory and
+        `ignore_errors` is not set.
+    OSError
+        If the job failed and `ignore_errors` is not set.
+    '''
     stdout, stderr = getStdoutStderr(stdout_path, stderr_path)
 
+    # SGE reports the peak virtual memory, which is what
+    # ulimit -v restricts
+    max_memory = None
+    if retval and retval.resourceUsage:
+        try:
+            max_memory = float(retval.resourceUsage["maxvmem"])
+        except (KeyError, ValueError):
+            pass
+
+    def _error():
+        if isMemoryError(stderr, max_memory, job_memory):
+            return JobMemoryError
+        return OSError
+
     if retval and retval.exitStatus != 0 and not ignore_errors:
-        raise OSError(
+        raise _error()(
             "---------------------------------------\n"
             "Child was terminated by signal %i: \n"
             "The stderr was: \n%s\n%s\n"
@@ -328,7 +432,7 @@ def collectSingleJobFromCluster(session, job_id,
     if ((retval.hasExited is False or retval.wasAborted is True) and not
         ignore_errors):
 
-        raise OSError(
+        raise _error()(
             "-------------------------------------------------\n"
             "Cluster job was aborted (%s) and/or failed to exit (%s) "
             "while running the following statement:\n"
@@ -345,6 +449,212 @@ def collectSingleJobFromCluster(session, job_id,
              "clean-up - ignored") % job_path)
 
 
+class JobPoller(object):
+    '''track outstanding cluster jobs from a single thread.
+
+    Instead of blocking a pipeline thread inside
+    :meth:`drmaa.Session.wait` for each job, jobs are registered with
+    the poller, which returns a :class:`concurrent.futures.Future`.
+    A single background thread periodically checks all outstanding
+    job ids and resolves the futures with the :class:`drmaa.JobInfo`
+    of the finished job.
+
+    The number of jobs in flight is limited to `max_jobs`, submission
+    through :meth:`submit` blocks until a slot becomes available.
+
+    Calls into the DRMAA session from submitting threads and from the
+    polling thread are serialized through :attr:`session_lock`.
+
+    Arguments
+    ---------
+    session : drmaa.Session
+        An initialized DRMAA session.
+    max_jobs : int
+        Maximum number of jobs submitted and not yet collected.
+    poll_interval : float
+        Time in seconds to sleep between polling rounds.
+    '''
+
+    def __init__(self, session, max_jobs=100, poll_interval=5):
+        self.session = session
+        self.poll_interval = poll_interval
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.lock = threading.Lock()
+        self.session_lock = threading.Lock()
+        self.jobs = {}
+        self.watched = set()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._poll,
+                                       name="JobPoller")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, job_template):
+        '''submit a job and return a future for its job information.
+
+        The future resolves to the :class:`drmaa.JobInfo` of the
+        job, or None if the queue manager could not provide
+        resource usage or termination status (PBS code 24).
+        '''
+        self.slots.acquire()
+        try:
+            with self.session_lock:
+                job_id = self.session.runJob(job_template)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.jobs[job_id] = future
+        E.debug("job has been submitted with job_id %s" % str(job_id))
+        return job_id, future
+
+    def watch(self, job_ids):
+        '''return futures for jobs submitted outside of the poller.
+
+        This is used for the tasks of array jobs. Watched jobs do not
+        count towards `max_jobs`.
+        '''
+        futures = []
+        with self.lock:
+            for job_id in job_ids:
+                future = concurrent.futures.Future()
+                self.jobs[job_id] = future
+                self.watched.add(job_id)
+                futures.append(future)
+        return futures
+
+    def _release(self, job_id):
+        '''stop tracking a job and return its future.'''
+        with self.lock:
+            future = self.jobs.pop(job_id)
+            watched = job_id in self.watched
+            self.watched.discard(job_id)
+        if not watched:
+            self.slots.release()
+        return future
+
+    def _collect(self, job_id):
+        '''check if a job has finished.
+
+        Returns a tuple (finished, retval).
+        '''
+        try:
+            with self.session_lock:
+                retval = self.session.wait(
+                    job_id, drmaa.Session.TIMEOUT_NO_WAIT)
+        except drmaa.errors.ExitTimeoutException:
+            return False, None
+        except Exception as msg:
+            # see waitForJob - PBS code 24
+            if not str(msg).startswith("code 24"):
+                raise
+            retval = None
+        return True, retval
+
+    def _poll(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                job_ids = list(self.jobs.keys())
+
+            for job_id in job_ids:
+                try:
+                    finished, retval = self._collect(job_id)
+                except Exception as msg:
+                    self._release(job_id).set_exception(msg)
+                    continue
+
+                if finished:
+                    self._release(job_id).set_result(retval)
+
+            self.stopped.wait(self.poll_interval)
+
+    def shutdown(self):
+        '''stop polling and cancel all outstanding futures.'''
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            for job_id, future in self.jobs.items():
+                future.set_exception(OSError(
+                    "job poller shut down before job %s finished" % job_id))
+            self.jobs = {}
+            self.watched = set()
+
+
+def getJobHost(job_path):
+    '''return the name of the host a job script has been executed on.
+
+    The host name is written to :file:`job_path.host` by the job
+    script. The file is removed once it is read.
+
+    Returns None if the host is not known.
+    '''
+    host_path = job_path + ".host"
+    try:
+        with open(host_path) as inf:
+            host = inf.read().strip()
+        os.unlink(host_path)
+    except (IOError, OSError):
+        host = None
+    return host
+
+
+def parseResourceUsage(retval):
+    '''convert DRMAA resource usage into job statistics.
+
+    Queue managers differ in the resources they report. SGE reports
+    ``submission_time``, ``start_time``, ``ru_wallclock``, ``cpu``,
+    ``ru_maxrss`` (in kb), ``maxvmem`` (in bytes), ``ru_inblock`` and
+    ``ru_oublock`` (in blocks of 512 bytes). Values that are not
+    reported are set to None.
+
+    Arguments
+    ---------
+    retval : drmaa.JobInfo
+        Job information for a finished job.
+
+    Returns
+    -------
+    statistics : dict
+    '''
+
+    def _get(key, factor=1):
+        try:
+            return float(usage[key]) * factor
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    result = dict([(x, None) for x in ("queue_wait",
+                                       "wall_time",
+                                       "cpu_time",
+                                       "max_rss",
+                                       "max_vmem",
+                                       "bytes_read",
+                                       "bytes_written",
+                                       "exit_status")])
+    if retval is None:
+        return result
+
+    usage = retval.resourceUsage or {}
+
+    submission_time = _get("submission_time")
+    start_time = _get("start_time")
+    if submission_time and start_time:
+        result["queue_wait"] = start_time - submission_time
+
+    result["wall_time"] = _get("ru_wallclock")
+    result["cpu_time"] = _get("cpu")
+    result["max_rss"] = _get("ru_maxrss", 1024)
+    result["max_vmem"] = _get("maxvmem")
+    result["bytes_read"] = _get("ru_inblock", 512)
+    result["bytes_written"] = _get("ru_oublock", 512)
+    if retval.hasExited:
+        result["exit_status"] = retval.exitStatus
+
+    return result
+
+
 def getStdoutStderr(stdout_path, stderr_path, tries=5):
     '''get stdout/stderr allowing for same lag.
 
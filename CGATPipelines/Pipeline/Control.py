@@ -11,6 +11,11 @@ of long log messages, while
 messages and sends event information to a rabbitMQ message exchange
 for task process monitoring.
 
+:class:`DeferredJobPool` is the ruffus thread pool used with
+``cluster_async``. It reports jobs of tasks that set
+``job_async = True`` as complete once their cluster jobs have
+finished without keeping a thread waiting for them.
+
 Reference
 ---------
 
@@ -20,11 +25,13 @@ import inspect
 import json
 import logging
 import os
+import queue
 import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import io
 
@@ -56,7 +63,10 @@ from CGAT import Requirements as Requirements
 
 from CGATPipelines.Pipeline.Utils import isTest, getCaller, getCallerLocals
 from CGATPipelines.Pipeline.Execution import execute, startSession,\
-    closeSession
+    closeSession, startLocalExecutor, closeLocalExecutor, \
+    summarizeJobStatistics, DEFERRED_JOBS
+from CGATPipelines.Pipeline.Database import startDatabaseWriter, \
+    closeDatabaseWriter
 from CGATPipelines.Pipeline.Local import getProjectName, getPipelineName
 from CGATPipelines.Pipeline.Parameters import inputValidation
 # Set from Pipeline.py
@@ -607,6 +617,92 @@ class LoggingFilterRabbitMQ(logging.Filter):
         return True
 
 
+class DeferredJobPool(ThreadPool):
+    '''ruffus thread pool that does not wait for deferred cluster jobs.
+
+    A ruffus job whose task function submitted cluster jobs through
+    :func:`CGATPipelines.Pipeline.Execution.run` with ``job_async``
+    set returns as soon as the jobs have been submitted. The thread
+    is then free to run the next ruffus job, while the result of the
+    ruffus job is held back until the cluster jobs have been
+    collected. Thus downstream tasks only start once all outputs are
+    complete.
+
+    If a deferred cluster job fails, the pipeline stops with a
+    :class:`ruffus.ruffus_exceptions.RethrownJobError`.
+    '''
+
+    def _runJob(self, func, args):
+        DEFERRED_JOBS.pool = self
+        DEFERRED_JOBS.jobs = []
+        try:
+            return func(args), DEFERRED_JOBS.jobs
+        finally:
+            DEFERRED_JOBS.jobs = None
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+
+        # events are tuples of (event, ruffus job result, payload)
+        events = queue.Queue()
+        submitted, collected, drained = range(3)
+
+        def _wait(result, jobs):
+            remaining = [len(jobs)]
+            lock = threading.Lock()
+
+            def _done(future):
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    events.put((collected, result, jobs))
+
+            for task_name, outfile, future in jobs:
+                future.add_done_callback(_done)
+
+        def _drain():
+            try:
+                for result, jobs in ThreadPool.imap_unordered(
+                        self,
+                        lambda args: self._runJob(func, args),
+                        iterable,
+                        chunksize):
+                    events.put((submitted, result, jobs))
+            except Exception as msg:
+                events.put((drained, None, msg))
+            else:
+                events.put((drained, None, None))
+
+        thread = threading.Thread(target=_drain)
+        thread.daemon = True
+        thread.start()
+
+        finished, outstanding = False, 0
+        while not finished or outstanding:
+            event, result, payload = events.get()
+            if event == drained:
+                if payload is not None:
+                    raise payload
+                finished = True
+            elif event == collected:
+                outstanding -= 1
+                errors = [(task_name,
+                           str(outfile),
+                           future.exception().__class__.__name__,
+                           str(future.exception()),
+                           "")
+                          for task_name, outfile, future in payload
+                          if future.exception() is not None]
+                if errors:
+                    raise ruffus_exceptions.RethrownJobError(errors)
+                yield result
+            elif payload:
+                outstanding += 1
+                _wait(result, payload)
+            else:
+                yield result
+
+
 USAGE = '''
 usage: %prog [OPTIONS] [CMD] [target]
 
@@ -647,6 +743,11 @@ regenerate
 check
    check if requirements (external tool dependencies) are satisfied.
 
+profile
+   summarize resource usage of jobs by task. Tasks are sorted by
+   total wall clock time. Requires ``job_statistics_table`` to be
+   set while running the pipeline.
+
 clone <source>
    create a clone of a pipeline in <source> in the current
    directory. The cloning process aims to use soft linking to files
@@ -693,7 +794,8 @@ def main(args=sys.argv):
                       type="choice",
                       choices=(
                           "make", "show", "plot", "dump", "config", "clone",
-                          "check", "regenerate", "printconfig"),
+                          "check", "regenerate", "printconfig",
+                          "profile"),
                       help="action to take [default=%default].")
 
     parser.add_option("--pipeline-format", dest="pipeline_format",
@@ -898,6 +1000,12 @@ def main(args=sys.argv):
                     # Note that threading might cause problems with rpy.
                     task.Pool = ThreadPool
 
+                    # with asynchronous job collection, ruffus jobs of
+                    # tasks with job_async set do not occupy a thread
+                    # while their cluster jobs are running
+                    if PARAMS.get("cluster_async", False):
+                        task.Pool = DeferredJobPool
+
                     # create the session proxy
                     startSession()
 
@@ -907,6 +1015,15 @@ def main(args=sys.argv):
                                " on this host: {}".format(os.uname()[1]))
                     sys.exit(-1)
 
+                elif PARAMS.get("local_executor", False):
+                    # set up before ruffus forks its worker processes
+                    startLocalExecutor()
+
+                if PARAMS.get("database_writer", False):
+                    # serialize loads into the database, set up before
+                    # ruffus forks its worker processes
+                    startDatabaseWriter()
+
                 #
                 #   make sure we are not logging at the same time in
                 #   different processes
@@ -929,6 +1046,8 @@ def main(args=sys.argv):
                 E.info(E.GetFooter())
 
                 closeSession()
+                closeLocalExecutor()
+                closeDatabaseWriter()
 
             elif options.pipeline_action == "show":
                 pipeline_printout(
@@ -1021,6 +1140,14 @@ def main(args=sys.argv):
             print(k, "=", PARAMS[k])
         printConfigFiles()
 
+    elif options.pipeline_action == "profile":
+        header, rows = summarizeJobStatistics()
+        options.stdout.write("\t".join(header) + "\n")
+        for row in rows:
+            options.stdout.write(
+                "\t".join(["na" if x is None else str(x)
+                           for x in row]) + "\n")
+
     elif options.pipeline_action == "config":
         f = sys._getframe(1)
         caller = f.f_globals["__file__"]
@@ -7,11 +7,18 @@ Reference
 """
 import re
 import os
+import random
+import shlex
+import time
 import sqlite3
+import itertools
+import queue
+import threading
+from multiprocessing.connection import Listener, Client
 from CGAT import Database as Database
 import CGAT.Experiment as E
 
-from CGAT.IOTools import touchFile, snip
+from CGAT.IOTools import touchFile, snip, openFile
 
 from CGATPipelines.Pipeline.Execution import buildStatement, run
 from CGATPipelines.Pipeline.Files import getTempFile
@@ -113,6 +120,538 @@ def build_load_statement(tablename, retry=True, options=""):
     return load_statement
 
 
+# values that are loaded as NULL by the in-process loader
+NULL_VALUES = frozenset(("", "na", "NA", "nan", "NaN", "None", "NULL"))
+
+# sqlite column types for the csv2db ``--map`` option
+MAP_TYPES = {"str": "TEXT",
+             "int": "INTEGER",
+             "float": "FLOAT"}
+
+# seconds to wait for a locked database when loading with retry
+LOAD_TIMEOUT = 600
+
+# writer that serializes loads from concurrent tasks, see
+# :func:`startDatabaseWriter`
+GLOBAL_DATABASE_WRITER = None
+
+
+def _parseLoadOptions(options):
+    """parse csv2db options for the in-process loader.
+
+    Only the subset of :doc:`csv2db` options that is used within
+    the pipelines is understood.
+
+    Arguments
+    ---------
+    options : string
+        Command line options for the `csv2db.py` script.
+
+    Returns
+    -------
+    parsed : dict
+        Dictionary of options. None if `options` contains an option
+        that is not supported by the in-process loader.
+    """
+    parsed = {"indices": [],
+              "header": None,
+              "replace_header": False,
+              "column_types": {},
+              "ignore_columns": set(),
+              "allow_empty": False,
+              "ignore_empty": False}
+
+    if "%(" in options:
+        return None
+
+    for option in shlex.split(options):
+        if "=" in option:
+            key, value = option.split("=", 1)
+        else:
+            key, value = option, None
+
+        if key == "--add-index" and value:
+            parsed["indices"].append(value)
+        elif key == "--header-names" and value:
+            parsed["header"] = value.split(",")
+        elif key == "--replace-header":
+            parsed["replace_header"] = True
+        elif key == "--map" and value and ":" in value:
+            column, map_type = value.split(":", 1)
+            if map_type not in MAP_TYPES:
+                return None
+            parsed["column_types"][column] = MAP_TYPES[map_type]
+        elif key == "--ignore-column" and value:
+            parsed["ignore_columns"].add(value)
+        elif key == "--allow-empty-file":
+            parsed["allow_empty"] = True
+        elif key == "--ignore-empty":
+            parsed["ignore_empty"] = True
+        elif key in ("--retry", "--backend", "--database-backend"):
+            if value not in (None, "sqlite"):
+                return None
+        else:
+            return None
+
+    return parsed
+
+
+def _getLoadOptions(options):
+    """return parsed load options if data can be loaded in-process.
+
+    The in-process loader is used if it is enabled through
+    ``database_load_inprocess`` or ``database_writer``, the database
+    backend is sqlite and all options are understood.
+    """
+    PARAMS = getParams()
+    if not (PARAMS.get("database_load_inprocess", False)
+            or PARAMS.get("database_writer", False)):
+        return None
+    if PARAMS["database_backend"] != "sqlite":
+        return None
+    return _parseLoadOptions(options)
+
+
+def _iterateRows(infile):
+    """iterate over rows of a tab-separated file skipping comments."""
+    with openFile(infile) as inf:
+        for line in inf:
+            if line.startswith("#"):
+                continue
+            yield line.rstrip("\r\n").split("\t")
+
+
+def _quoteColumn(name, taken):
+    """return a column name suitable for sqlite that is not in `taken`."""
+    name = re.sub("[^a-zA-Z0-9_]", "_", name)
+    if not name or name[0].isdigit():
+        name = "_" + name
+    candidate, x = name, 1
+    while candidate.lower() in taken:
+        candidate = "%s_%i" % (name, x)
+        x += 1
+    taken.add(candidate.lower())
+    return candidate
+
+
+def _inferColumnType(values):
+    """infer the sqlite column type from a sample of values."""
+    column_type = None
+    for value in values:
+        if value is None:
+            continue
+        if column_type is None:
+            column_type = "INTEGER"
+        if column_type == "INTEGER":
+            try:
+                int(value)
+                continue
+            except ValueError:
+                column_type = "FLOAT"
+        try:
+            float(value)
+        except ValueError:
+            return "TEXT"
+    return column_type or "TEXT"
+
+
+def _iterateBatches(rows, batch_size):
+    """iterate over lists of up to `batch_size` rows."""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def _createTable(cc, tablename, names, types):
+    """create table `tablename`, replacing any existing table."""
+    cc.execute('DROP TABLE IF EXISTS "%s"' % tablename)
+    cc.execute('CREATE TABLE "%s" (%s)' % (
+        tablename,
+        ", ".join('"%s" %s' % x for x in zip(names, types))))
+
+
+def _insertRows(cc, tablename, rows):
+    """insert `rows` into `tablename` and return the number of rows."""
+    if not rows:
+        return 0
+    cc.executemany('INSERT INTO "%s" VALUES (%s)' % (
+        tablename, ",".join(["?"] * len(rows[0]))), rows)
+    return len(rows)
+
+
+def _createIndices(cc, tablename, indices):
+    """add an index on each column in `indices` to `tablename`."""
+    for x, column in enumerate(indices):
+        cc.execute('CREATE INDEX "%s_index%i" ON "%s" ("%s")' %
+                   (tablename, x, tablename, column))
+
+
+class DatabaseWriter(object):
+    '''serialize loads into an sqlite database through a single writer.
+
+    The writer runs as a thread in the pipeline process and owns the
+    only write connection to the database. Tasks in threads or in
+    worker processes forked after the writer has been started send
+    their tables through a local socket with :meth:`load`. Loads are
+    applied one at a time, each within a savepoint, and consecutive
+    loads are grouped into a single transaction. The transaction is
+    committed as soon as no further loads are waiting, so that the
+    database lock is not held while the writer is idle. A load
+    returns once the transaction containing it has been committed.
+
+    The journal mode of the database is not changed, as WAL mode
+    does not work on network file systems.
+
+    Arguments
+    ---------
+    database : string
+        Filename of the sqlite database.
+    max_rows : int
+        Commit after this many rows even if more loads are waiting.
+    max_time : float
+        Commit after a transaction has been open for this many seconds
+        even if more loads are waiting.
+    '''
+
+    def __init__(self, database, max_rows=1000000, max_time=10):
+        self.database = os.path.abspath(database)
+        self.max_rows = max_rows
+        self.max_time = max_time
+        self.authkey = os.urandom(16)
+        self.listener = Listener(family="AF_UNIX", authkey=self.authkey)
+        self.address = self.listener.address
+        self.connections = queue.Queue()
+        self.accept_thread = threading.Thread(target=self._accept)
+        self.accept_thread.daemon = True
+        self.writer_thread = threading.Thread(target=self._write)
+        self.writer_thread.daemon = True
+        self.accept_thread.start()
+        self.writer_thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError):
+                # listener has been closed
+                break
+            except Exception as ex:
+                # failed authentication of a stray connection
+                E.warn("database writer: rejected connection: %s" % ex)
+                continue
+            self.connections.put(conn)
+
+    def _write(self):
+        dbh = sqlite3.connect(self.database,
+                              timeout=LOAD_TIMEOUT,
+                              isolation_level=None,
+                              check_same_thread=False)
+        cc = dbh.cursor()
+        cc.execute("PRAGMA temp_store = MEMORY")
+        cc.execute("PRAGMA cache_size = -65536")
+
+        waiting, nrows, started = [], 0, None
+        while True:
+            conn = self.connections.get()
+            if conn is None:
+                break
+            try:
+                if not dbh.in_transaction:
+                    cc.execute("BEGIN IMMEDIATE")
+                    started = time.time()
+            except sqlite3.Error as ex:
+                self._reply(conn, ("error", str(ex)))
+                continue
+            result = self._apply(cc, conn)
+            if result is not None:
+                waiting.append((conn, result))
+                nrows += result
+            # commit even if the load failed to release the lock
+            if (self.connections.empty()
+                    or nrows >= self.max_rows
+                    or time.time() - started >= self.max_time):
+                self._commit(cc, waiting)
+                waiting, nrows = [], 0
+
+        if dbh.in_transaction:
+            self._commit(cc, waiting)
+        dbh.close()
+
+    def _commit(self, cc, waiting):
+        '''commit the current transaction and notify waiting loads.'''
+        try:
+            cc.execute("COMMIT")
+            error = None
+        except sqlite3.Error as ex:
+            cc.execute("ROLLBACK")
+            error = str(ex)
+        for conn, result in waiting:
+            if error is None:
+                self._reply(conn, ("ok", result))
+            else:
+                self._reply(conn, ("error", error))
+
+    def _apply(self, cc, conn):
+        '''apply the load sent through `conn` within a savepoint.
+
+        Returns the number of rows loaded or None if the load failed.
+        '''
+        cc.execute("SAVEPOINT load")
+        error, nrows = None, 0
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == "end":
+                    break
+                if error is not None:
+                    continue
+                try:
+                    if message[0] == "create":
+                        tablename, names, types, indices = message[1:]
+                        _createTable(cc, tablename, names, types)
+                    elif message[0] == "rows":
+                        nrows += _insertRows(cc, tablename, message[1])
+                    elif message[0] == "index":
+                        _createIndices(cc, tablename, indices)
+                except Exception as ex:
+                    error = str(ex)
+        except (EOFError, OSError):
+            error = "connection lost"
+
+        if error is not None:
+            cc.execute("ROLLBACK TO SAVEPOINT load")
+            cc.execute("RELEASE SAVEPOINT load")
+            self._reply(conn, ("error", error))
+            return None
+
+        cc.execute("RELEASE SAVEPOINT load")
+        return nrows
+
+    def _reply(self, conn, reply):
+        try:
+            conn.send(reply)
+        except (EOFError, OSError):
+            pass
+        conn.close()
+
+    def load(self, tablename, names, types, indices, batches):
+        '''load a table through the writer and wait for completion.
+
+        The table is replaced if it exists.
+
+        Arguments
+        ---------
+        tablename : string
+            Table name.
+        names : list
+            Column names.
+        types : list
+            Column types.
+        indices : list
+            Columns to add an index on after all rows are inserted.
+        batches : iterator
+            Iterator over lists of rows.
+
+        Returns
+        -------
+        nrows : int
+            Number of rows loaded.
+
+        Raises
+        ------
+        OSError
+            If the load failed.
+        '''
+        conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+        try:
+            conn.send(("create", tablename, names, types, indices))
+            for batch in batches:
+                conn.send(("rows", batch))
+            conn.send(("index",))
+            conn.send(("end",))
+            status, result = conn.recv()
+        finally:
+            conn.close()
+
+        if status != "ok":
+            raise OSError("loading table %s failed: %s" % (tablename, result))
+        return result
+
+    def close(self):
+        '''commit outstanding loads and stop the writer.'''
+        self.connections.put(None)
+        self.writer_thread.join()
+        self.listener.close()
+
+
+def startDatabaseWriter():
+    """start the writer serializing loads into the pipeline database.
+
+    Only sqlite databases are supported. The writer needs to be
+    started before ruffus creates its worker processes. Setting
+    ``database_writer`` implies ``database_load_inprocess``, as loads
+    are sent to the writer by the in-process loader.
+    """
+    global GLOBAL_DATABASE_WRITER
+    PARAMS = getParams()
+    if PARAMS["database_backend"] != "sqlite":
+        return None
+    GLOBAL_DATABASE_WRITER = DatabaseWriter(
+        getDatabaseName(),
+        max_rows=int(PARAMS.get("database_writer_max_rows", 1000000)),
+        max_time=float(PARAMS.get("database_writer_max_seconds", 10)))
+    return GLOBAL_DATABASE_WRITER
+
+
+def closeDatabaseWriter():
+    """stop the writer serializing loads into the pipeline database."""
+    global GLOBAL_DATABASE_WRITER
+    if GLOBAL_DATABASE_WRITER is not None:
+        GLOBAL_DATABASE_WRITER.close()
+        GLOBAL_DATABASE_WRITER = None
+
+
+def _bulkLoad(rows,
+              outfile,
+              tablename,
+              options,
+              retry=True,
+              limit=0,
+              shuffle=False,
+              sample_size=1000):
+    """load rows into an sqlite table within the current process.
+
+    The table is replaced if it exists. Rows are inserted in batches
+    within a single transaction and indices are added after all rows
+    have been inserted. Column types are inferred from the first
+    `sample_size` rows.
+
+    Arguments
+    ---------
+    rows : iterator
+        Iterator over rows, each row a list of strings. The first
+        row is the header unless header names are given in `options`.
+    outfile : string
+        Output filename for logging information.
+    tablename : string
+        Table name.
+    options : dict
+        Options as returned by :func:`_parseLoadOptions`.
+    retry : bool
+        If True, wait for a locked database.
+    limit : int
+        If set, only load the first n rows.
+    shuffle : bool
+        If set, randomize rows before loading.
+    sample_size : int
+        Number of rows to use for inferring column types.
+
+    Raises
+    ------
+    ValueError
+        If there is no data to load and empty files are not allowed.
+    """
+    PARAMS = getParams()
+    batch_size = int(PARAMS.get("database_load_batch_size", 10000))
+
+    # quote as csv2db does for table names given explicitly
+    tablename = tablequote(tablename)
+
+    rows = iter(rows)
+    header = options["header"]
+    if header is None or options["replace_header"]:
+        first = next(rows, None)
+        if header is None:
+            header = first
+
+    if not header:
+        if not options["allow_empty"]:
+            raise ValueError("no data to load into table %s" % tablename)
+        E.warn("empty input - table %s not created" % tablename)
+        with open(outfile, "w") as outf:
+            outf.write("table %s: empty input, no table created\n" %
+                       tablename)
+        return
+
+    take = [x for x, name in enumerate(header)
+            if name not in options["ignore_columns"]]
+    ncolumns = len(header)
+
+    def _quoteRow(row):
+        if len(row) < ncolumns:
+            row = row + [""] * (ncolumns - len(row))
+        return [None if row[x] in NULL_VALUES else row[x] for x in take]
+
+    rows = map(_quoteRow, rows)
+    if shuffle:
+        rows = list(rows)
+        random.shuffle(rows)
+    if limit > 0:
+        rows = itertools.islice(rows, limit)
+
+    if options["ignore_empty"]:
+        rows = list(rows)
+        sample = rows
+    else:
+        sample = list(itertools.islice(rows, sample_size))
+        rows = itertools.chain(sample, rows)
+
+    columns = list(zip(*sample)) if sample else [()] * len(take)
+    if options["ignore_empty"]:
+        keep = [x for x, values in enumerate(columns)
+                if any(v is not None for v in values)]
+        if len(keep) < len(take):
+            take = [take[x] for x in keep]
+            columns = [columns[x] for x in keep]
+            rows = [[row[x] for x in keep] for row in rows]
+
+    taken = set()
+    names = [_quoteColumn(header[x], taken) for x in take]
+    types = [options["column_types"].get(header[x],
+                                         _inferColumnType(values))
+             for x, values in zip(take, columns)]
+
+    lookup = dict(zip([header[x] for x in take], names))
+    indices = []
+    for index in options["indices"]:
+        if index not in lookup:
+            E.warn("can not add index on %s to table %s: no such column" %
+                   (index, tablename))
+            continue
+        indices.append(lookup[index])
+
+    batches = _iterateBatches(rows, batch_size)
+    if GLOBAL_DATABASE_WRITER is not None:
+        nrows = GLOBAL_DATABASE_WRITER.load(
+            tablename, names, types, indices, batches)
+    else:
+        dbh = sqlite3.connect(getDatabaseName(),
+                              timeout=LOAD_TIMEOUT if retry else 5,
+                              isolation_level=None)
+        try:
+            cc = dbh.cursor()
+            cc.execute("PRAGMA synchronous = OFF")
+            cc.execute("PRAGMA temp_store = MEMORY")
+            cc.execute("PRAGMA cache_size = -65536")
+            cc.execute("BEGIN IMMEDIATE")
+            _createTable(cc, tablename, names, types)
+            nrows = sum(_insertRows(cc, tablename, batch)
+                        for batch in batches)
+            _createIndices(cc, tablename, indices)
+            cc.execute("COMMIT")
+        finally:
+            # closing the connection rolls back an unfinished transaction
+            dbh.close()
+
+    E.info("loaded %i rows into table %s" % (nrows, tablename))
+    with open(outfile, "w") as outf:
+        outf.write("table %s: loaded %i rows with %i columns\n" %
+                   (tablename, nrows, len(names)))
+
+
 def load(infile,
          outfile=None,
          options="",
@@ -134,7 +673,12 @@ def load(infile,
         def loadData(infile, outfile):
             P.load(infile, outfile)
 
-    Upload is performed via the :doc:`csv2db` script.
+    If ``database_load_inprocess`` or ``database_writer`` is set and
+    the database backend is sqlite, the data are loaded within the
+    current process.
+    Otherwise, or if `options` contains options not understood by the
+    in-process loader, upload is performed via the :doc:`csv2db`
+    script.
 
     Arguments
     ---------
@@ -173,6 +717,17 @@ def load(infile,
     if not tablename:
         tablename = toTable(outfile)
 
+    load_options = _getLoadOptions(options)
+    if load_options is not None and not collapse and not transpose:
+        _bulkLoad(_iterateRows(infile),
+                  outfile,
+                  tablename,
+                  load_options,
+                  retry=retry,
+                  limit=limit,
+                  shuffle=shuffle)
+        return
+
     statement = []
 
     if infile.endswith(".gz"):
@@ -209,6 +764,47 @@ def load(infile,
     run()
 
 
+def _concatenateRows(infiles, cat, regex_filename=None, missing_value="na"):
+    """iterate over the rows of multiple tables with titles.
+
+    The header is the union of all column titles prefixed by the
+    columns in `cat`, which contain the track name derived from the
+    filename.
+    """
+    cat = cat.split(",")
+    headers = []
+    for infile in infiles:
+        headers.append(next(_iterateRows(infile), None))
+
+    columns = []
+    for header in headers:
+        if header:
+            columns.extend(x for x in header if x not in columns)
+
+    yield cat + columns
+
+    map_column = dict((y, x) for x, y in enumerate(columns))
+    for infile, header in zip(infiles, headers):
+        if not header:
+            continue
+        track = None
+        if regex_filename:
+            match = re.search(regex_filename, infile)
+            if match:
+                track = list(match.groups())
+        if track is None:
+            track = [infile]
+        track = (track + [missing_value] * len(cat))[:len(cat)]
+        take = [map_column[x] for x in header]
+        rows = _iterateRows(infile)
+        next(rows)
+        for row in rows:
+            data = [missing_value] * len(columns)
+            for x, value in zip(take, row):
+                data[x] = value
+            yield track + data
+
+
 def concatenateAndLoad(infiles,
                        outfile,
                        regex_filename=None,
@@ -231,7 +827,9 @@ def concatenateAndLoad(infiles,
         def loadData(infile, outfile):
             P.concatenateAndLoad(infiles, outfile)
 
-    Upload is performed via the :doc:`csv2db` script.
+    The data are loaded within the current process if possible,
+    see :func:`load`. Otherwise upload is performed via the
+    :doc:`csv2db` script.
 
     Arguments
     ---------
@@ -275,6 +873,20 @@ def concatenateAndLoad(infiles,
     if tablename is None:
         tablename = toTable(outfile)
 
+    load_options = _getLoadOptions(options)
+    if load_options is not None and has_titles:
+        load_options["indices"].insert(0, "track")
+        if header:
+            load_options["header"] = header.split(",")
+            load_options["replace_header"] = True
+        _bulkLoad(_concatenateRows(infiles, cat, regex_filename,
+                                   missing_value),
+                  outfile,
+                  tablename,
+                  load_options,
+                  retry=retry)
+        return
+
     infiles = " ".join(infiles)
 
     passed_options = options
@@ -309,6 +921,39 @@ def concatenateAndLoad(infiles,
     run()
 
 
+def _mergeRows(infiles, tracks, columns=(0, 1), row_wise=True,
+               missing_value="0"):
+    """iterate over the rows of categorical tables merged by key.
+
+    Column titles in the input files are skipped and empty files
+    are ignored. If `row_wise` is set, each file is a row in the
+    output, otherwise each file is a column.
+    """
+    key_column, value_column = columns
+    keys, seen, values = [], set(), {}
+    for infile, track in zip(infiles, tracks):
+        rows = _iterateRows(infile)
+        if next(rows, None) is None:
+            continue
+        data = values[track] = {}
+        for row in rows:
+            key = row[key_column]
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+            data[key] = row[value_column]
+
+    if row_wise:
+        yield ["track"] + keys
+        for track, data in values.items():
+            yield [track] + [data.get(x, missing_value) for x in keys]
+    else:
+        yield ["bin"] + list(values.keys())
+        for key in keys:
+            yield [key] + [data.get(key, missing_value)
+                           for data in values.values()]
+
+
 def mergeAndLoad(infiles,
                  outfile,
                  suffix=None,
@@ -385,6 +1030,10 @@ def mergeAndLoad(infiles,
         column. The number of `prefixes` and `infiles` needs to be the
         same.
 
+    The data are loaded within the current process if possible,
+    see :func:`load`. Otherwise upload is performed via the
+    :doc:`csv2db` script.
+
     '''
     PARAMS = getParams()
     if len(infiles) == 0:
@@ -398,6 +1047,17 @@ def mergeAndLoad(infiles,
     else:
         header = ",".join([os.path.basename(x) for x in infiles])
 
+    load_options = _getLoadOptions(options)
+    if load_options is not None and columns and len(columns) == 2:
+        load_options["indices"].insert(0, "track")
+        load_options["header"] = None
+        _bulkLoad(_mergeRows(infiles, header.split(","), columns, row_wise),
+                  outfile,
+                  toTable(outfile),
+                  load_options,
+                  retry=retry)
+        return
+
     header_stmt = "--header-names=%s" % header
 
     if columns:
@@ -638,6 +1298,25 @@ def importFromIterator(
         List of column names to add indices on.
     '''
 
+    load_options = _getLoadOptions("")
+    if load_options is not None:
+        load_options["indices"] = list(indices or [])
+
+        def _iterate():
+            # columns maps row keys to column names
+            keys = None
+            if columns:
+                keys, values = list(zip(*list(columns.items())))
+                yield list(values)
+            for row in iterator:
+                if keys is None:
+                    keys = list(row[0].keys())
+                    yield keys
+                yield [str(row[x]) for x in keys]
+
+        _bulkLoad(_iterate(), outfile, tablename, load_options)
+        return
+
     tmpfile = getTempFile(".")
 
     if columns:
@@ -7,26 +7,105 @@ Session
 This module manages a DRMAA session. :func:`startSession`
 starts a session and :func:`closeSession` closes it.
 
+If the configuration value ``cluster_async`` is set, a
+:class:`JobPoller` is started together with the session. Jobs
+submitted through :func:`run` are then handed to the poller and the
+calling task waits on a future instead of blocking in the DRMAA
+library. The number of jobs in flight is limited by
+``cluster_num_jobs``.
+
+Tasks that set ``job_async = True`` do not wait at all. :func:`run`
+returns once the job has been submitted and the ruffus job is
+reported as complete by the
+:class:`CGATPipelines.Pipeline.Control.DeferredJobPool` once the
+cluster job has finished. The number of cluster jobs of such tasks is
+thus limited by ``cluster_num_jobs`` and not by the number of ruffus
+threads (``--multiprocess``).
+
+Local execution
+---------------
+
+If the configuration value ``local_executor`` is set, jobs run with
+``--local`` are subject to admission control by :class:`LocalResources`.
+A statement is only started once the cores (``job_threads``) and
+memory (``job_threads`` times ``job_memory``) it declares are
+available. The size of the pool is set by ``local_num_cores`` and
+``local_memory`` and defaults to the cores and memory of the machine.
+If ``local_memory_limit`` is set, the virtual memory of a statement
+is also restricted to its reservation with ``ulimit -v``. Note that
+this limit is much tighter than the one applied to cluster jobs and
+that multi-threaded tools and the JVM reserve more virtual memory
+than they use.
+
+Job statistics
+--------------
+
+If ``job_statistics_table`` is set, resource usage of each statement
+executed through :func:`run` is recorded in this table of the sqlite
+database ``job_statistics_database`` (see
+:func:`recordJobStatistics`). This is a database separate from the
+pipeline database, so that recording does not compete with loading
+of data. Local jobs are measured through :func:`os.wait4`, cluster
+jobs through the resource usage reported by DRMAA. The pipeline
+command ``profile`` summarizes the table by task
+(:func:`summarizeJobStatistics`).
+
+Adaptive memory
+---------------
+
+If ``cluster_memory_adaptive`` is set, tasks that do not set
+``job_memory`` themselves request memory as predicted from the peak
+virtual memory usage of previous jobs of the same task
+(:func:`predictJobMemory`). Jobs failing because they ran out of
+memory are resubmitted with ``cluster_memory_retry_factor`` times
+their reservation, at most ``cluster_memory_retries`` times and up
+to ``cluster_memory_max``. Predictions require job statistics to be
+recorded.
+
+Result cache
+------------
+
+If ``cache_dir`` is set, tasks can opt into caching of their results
+by setting ``job_cache = True``. Before running a statement, the
+cache is searched for outputs of an identical statement with
+identical inputs and executables (see
+:func:`CGATPipelines.Pipeline.Files.getCacheKey`). On a hit, the
+outputs are restored and the statement is not run. Only set
+``job_cache`` for deterministic statements whose outputs are given
+by ``outfile`` or ``outfiles``.
+
 Reference
 ---------
 
 """
 
+import collections
+import concurrent.futures
 import importlib
+import math
+import multiprocessing
 import os
 import pickle
 import pipes
 import re
+import socket
+import sqlite3
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 import CGAT.Experiment as E
 import CGAT.IOTools as IOTools
 from CGAT.IOTools import snip as snip
 
-from CGATPipelines.Pipeline.Utils import getCallerLocals
-from CGATPipelines.Pipeline.Parameters import substituteParameters
-from CGATPipelines.Pipeline.Files import getTempFilename
+from CGATPipelines.Pipeline.Utils import getCallerLocals, getCallerName
+from CGATPipelines.Pipeline.Parameters import substituteParameters, \
+    LayeredParameters
+from CGATPipelines.Pipeline.Files import getTempFilename, getCacheKey, \
+    restoreFromCache, storeInCache
 from CGATPipelines.Pipeline.Cluster import *
 
 # talking to a cluster
@@ -44,6 +123,31 @@ PARAMS = {}
 # global drmaa session
 GLOBAL_SESSION = None
 
+# global poller for asynchronous job collection
+GLOBAL_POLLER = None
+
+# cluster jobs submitted, but not waited for, by the ruffus job
+# running in this thread. Set by the DeferredJobPool in Control.py
+DEFERRED_JOBS = threading.local()
+
+# pool of cores and memory for local job execution
+GLOBAL_LOCAL_RESOURCES = None
+
+# serialize writing of job statistics within a process
+JOB_STATISTICS_LOCK = threading.Lock()
+
+# columns in the job statistics table
+JOB_STATISTICS_COLUMNS = ("task", "outfile", "job_id", "host",
+                          "end_time", "queue_wait", "wall_time",
+                          "cpu_time", "max_rss", "max_vmem", "bytes_read",
+                          "bytes_written", "exit_status",
+                          "input_bytes", "job_memory")
+
+# statements waiting to be packed into a single cluster job,
+# indexed by task and resource requirements
+PENDING_PACKS = {}
+PACK_LOCK = threading.Lock()
+
 
 def _pickle_args(args, kwargs):
     ''' Pickle a set of function arguments. Removes any kwargs that are
@@ -74,18 +178,334 @@ def startSession():
     """start and initialize the global DRMAA session."""
 
     global GLOBAL_SESSION
+    global GLOBAL_POLLER
     GLOBAL_SESSION = drmaa.Session()
     GLOBAL_SESSION.initialize()
+
+    if PARAMS.get("cluster_async", False):
+        GLOBAL_POLLER = JobPoller(
+            GLOBAL_SESSION,
+            max_jobs=PARAMS.get("cluster_num_jobs", 100),
+            poll_interval=PARAMS.get("cluster_poll_interval", 5))
+
     return GLOBAL_SESSION
 
 
 def closeSession():
     """close the global DRMAA session."""
 
+    global GLOBAL_POLLER
+    if GLOBAL_POLLER is not None:
+        GLOBAL_POLLER.shutdown()
+        GLOBAL_POLLER = None
+
     if GLOBAL_SESSION is not None:
         GLOBAL_SESSION.exit()
 
 
+class LocalResources(object):
+    '''pool of cores and memory for jobs running on the local host.
+
+    The pool uses :mod:`multiprocessing` primitives so that it can be
+    shared between worker processes forked after its creation.
+
+    Arguments
+    ---------
+    num_cores : int
+        Number of cores in the pool.
+    memory : int
+        Memory in the pool in bytes.
+    '''
+
+    def __init__(self, num_cores, memory):
+        self.num_cores = num_cores
+        self.memory = memory
+        self.condition = multiprocessing.Condition()
+        self.free_cores = multiprocessing.Value("i", num_cores, lock=False)
+        self.free_memory = multiprocessing.Value("d", memory, lock=False)
+
+    def clip(self, cores, memory):
+        '''clip a request to the pool size so that it can be satisfied.'''
+        return min(cores, self.num_cores), min(memory, self.memory)
+
+    def acquire(self, cores, memory):
+        '''block until `cores` and `memory` are available and reserve them.
+        '''
+        cores, memory = self.clip(cores, memory)
+        with self.condition:
+            while (self.free_cores.value < cores or
+                   self.free_memory.value < memory):
+                self.condition.wait()
+            self.free_cores.value -= cores
+            self.free_memory.value -= memory
+
+    def release(self, cores, memory):
+        '''return `cores` and `memory` to the pool.'''
+        cores, memory = self.clip(cores, memory)
+        with self.condition:
+            self.free_cores.value += cores
+            self.free_memory.value += memory
+            self.condition.notify_all()
+
+
+def getLocalResources():
+    '''return cores and memory (in bytes) of the local host.'''
+    num_cores = multiprocessing.cpu_count()
+    try:
+        with open("/proc/meminfo") as inf:
+            for line in inf:
+                if line.startswith("MemTotal:"):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except IOError:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return num_cores, memory
+
+
+def startLocalExecutor():
+    """start admission control for jobs running locally."""
+
+    global GLOBAL_LOCAL_RESOURCES
+    num_cores, memory = getLocalResources()
+
+    if PARAMS.get("local_num_cores"):
+        num_cores = int(PARAMS["local_num_cores"])
+    if PARAMS.get("local_memory"):
+        memory = IOTools.human2bytes(PARAMS["local_memory"])
+
+    E.info("local executor: %i cores and %i bytes of memory" %
+           (num_cores, memory))
+    GLOBAL_LOCAL_RESOURCES = LocalResources(num_cores, memory)
+    return GLOBAL_LOCAL_RESOURCES
+
+
+def closeLocalExecutor():
+    """stop admission control for jobs running locally."""
+
+    global GLOBAL_LOCAL_RESOURCES
+    GLOBAL_LOCAL_RESOURCES = None
+
+
+def _getStatisticsDatabase():
+    '''return filename of database for job statistics.
+
+    Returns None if job statistics are not collected.
+    '''
+    if not PARAMS.get("job_statistics_table", ""):
+        return None
+    return os.path.join(PARAMS.get("workingdir", "."),
+                        PARAMS.get("job_statistics_database",
+                                   "job_statistics.db"))
+
+
+def recordJobStatistics(task, outfile, job_id, host, statistics):
+    '''record resource usage of a job in the job statistics database.
+
+    Failure to write to the database is logged but otherwise ignored.
+
+    Arguments
+    ---------
+    task : string
+        Name of the task the job belongs to.
+    outfile : string
+        Output file of the job.
+    job_id : string
+        Cluster job id or process id for local jobs.
+    host : string
+        Host the job has been executed on.
+    statistics : dict
+        Dictionary with resource usage. Times are in seconds, memory
+        and I/O in bytes. Missing values are stored as NULL.
+    '''
+    database = _getStatisticsDatabase()
+    if database is None:
+        return
+
+    tablename = PARAMS["job_statistics_table"]
+    row = dict(statistics)
+    row.update({"task": task,
+                "outfile": outfile,
+                "job_id": str(job_id),
+                "host": host,
+                "end_time": time.time()})
+
+    try:
+        with JOB_STATISTICS_LOCK:
+            dbh = sqlite3.connect(database, timeout=60)
+            dbh.execute(
+                "CREATE TABLE IF NOT EXISTS %s (%s)" %
+                (tablename, ", ".join(JOB_STATISTICS_COLUMNS)))
+            # add columns missing in tables from previous versions
+            existing = set([x[1] for x in dbh.execute(
+                "PRAGMA table_info(%s)" % tablename)])
+            for column in JOB_STATISTICS_COLUMNS:
+                if column not in existing:
+                    dbh.execute("ALTER TABLE %s ADD COLUMN %s" %
+                                (tablename, column))
+            # predictJobMemory selects by task
+            dbh.execute("CREATE INDEX IF NOT EXISTS %s_task ON %s (task)" %
+                        (tablename, tablename))
+            dbh.execute(
+                "INSERT INTO %s (%s) VALUES (%s)" %
+                (tablename,
+                 ", ".join(JOB_STATISTICS_COLUMNS),
+                 ", ".join(["?"] * len(JOB_STATISTICS_COLUMNS))),
+                [row.get(x, None) for x in JOB_STATISTICS_COLUMNS])
+            dbh.commit()
+            dbh.close()
+    except sqlite3.Error as msg:
+        E.warn("could not record job statistics for %s: %s" %
+               (outfile, msg))
+
+
+def getFilenames(options, keys):
+    '''return filenames given by `keys` in `options`.
+
+    Values can be filenames or (nested) lists of filenames.
+    '''
+
+    def _flatten(x):
+        if isinstance(x, str):
+            yield x
+        elif isinstance(x, (list, tuple)):
+            for y in x:
+                for z in _flatten(y):
+                    yield z
+
+    filenames = []
+    for key in keys:
+        filenames.extend(_flatten(options.get(key, None)))
+    return filenames
+
+
+def getInputBytes(options):
+    '''return the total size of input files in bytes.
+
+    Input files are taken from the variables ``infile`` or ``infiles``
+    in `options`. Files that do not exist are ignored.
+
+    Returns None if there are no input files.
+    '''
+    filenames = getFilenames(options, ("infile", "infiles"))
+    sizes = [os.path.getsize(x) for x in filenames if os.path.isfile(x)]
+    if not sizes:
+        return None
+    return sum(sizes)
+
+
+def predictJobMemory(task, input_bytes=None, min_observations=3):
+    '''predict peak memory usage of a job from previous jobs of a task.
+
+    The prediction uses the peak virtual memory recorded in the job
+    statistics table for successful jobs of `task`. This is the
+    quantity limited by the memory reservation (``ulimit -v`` and
+    ``h_vmem``) and checked by :func:`isMemoryError`. It is only
+    reported by the queue manager, thus jobs run locally do not
+    contribute to the prediction. If the
+    size of the input files is known, a linear model of peak memory
+    against input size is fitted. The prediction is the model
+    value plus the largest residual seen so far. Otherwise, the
+    maximum observed peak memory is returned.
+
+    Arguments
+    ---------
+    task : string
+        Name of the task.
+    input_bytes : int
+        Size of input files of the job to predict.
+    min_observations : int
+        Minimum number of previous jobs required for a prediction.
+
+    Returns
+    -------
+    memory : int
+        Predicted peak memory in bytes or None if there is no
+        sufficient data.
+    '''
+    database = _getStatisticsDatabase()
+    if database is None or not os.path.exists(database):
+        return None
+
+    dbh = sqlite3.connect(database, timeout=60)
+    try:
+        data = dbh.execute(
+            "SELECT input_bytes, max_vmem FROM %s "
+            "WHERE task = ? AND exit_status = 0 AND max_vmem IS NOT NULL" %
+            PARAMS["job_statistics_table"], (task,)).fetchall()
+    except sqlite3.Error:
+        return None
+    finally:
+        dbh.close()
+
+    if len(data) < min_observations:
+        return None
+
+    ys = [float(y) for x, y in data]
+    if input_bytes is None or None in [x for x, y in data]:
+        return int(max(ys))
+
+    xs = [float(x) for x, y in data]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    var_x = sum([(x - mean_x) ** 2 for x in xs])
+    if var_x == 0:
+        return int(max(ys))
+
+    slope = sum([(x - mean_x) * (y - mean_y)
+                 for x, y in zip(xs, ys)]) / var_x
+    slope = max(0, slope)
+    intercept = mean_y - slope * mean_x
+    residual = max([y - (intercept + slope * x) for x, y in zip(xs, ys)])
+
+    return int(intercept + slope * input_bytes + residual)
+
+
+def bytes2memory(nbytes):
+    '''convert a number of bytes into a memory request in megabytes.'''
+    return "%iM" % int(math.ceil(float(nbytes) / 2 ** 20))
+
+
+def summarizeJobStatistics():
+    '''summarize recorded resource usage by task.
+
+    Tasks are sorted by total wall clock time, the most expensive
+    task first.
+
+    Returns
+    -------
+    header : list
+        Column names
+    rows : list
+        List of tuples with one row per task.
+    '''
+    database = _getStatisticsDatabase()
+    if database is None or not os.path.exists(database):
+        raise ValueError("no job statistics have been recorded")
+
+    tablename = PARAMS["job_statistics_table"]
+    header = ["task", "njobs", "nfailed",
+              "wall_total", "wall_mean", "wall_max",
+              "cpu_total", "queue_wait_mean",
+              "max_rss", "max_vmem", "bytes_read", "bytes_written"]
+
+    dbh = sqlite3.connect(database)
+    try:
+        rows = dbh.execute('''
+        SELECT task, COUNT(*),
+        SUM(CASE WHEN exit_status != 0 THEN 1 ELSE 0 END),
+        SUM(wall_time), AVG(wall_time), MAX(wall_time),
+        SUM(cpu_time), AVG(queue_wait),
+        MAX(max_rss), MAX(max_vmem), SUM(bytes_read), SUM(bytes_written)
+        FROM %s
+        GROUP BY task
+        ORDER BY SUM(wall_time) DESC''' % tablename).fetchall()
+    except sqlite3.OperationalError as msg:
+        raise ValueError("no job statistics have been recorded: %s" % msg)
+    finally:
+        dbh.close()
+
+    return header, rows
+
+
 def shellquote(statement):
     '''shell quote a string to be used as a function argument.
 
@@ -316,6 +736,77 @@ def getParallelEnvironment(options=False):
         options["job_options"] = re.sub("-pe\s+(\w+)\s+(\d+)", "", o)
 
 
+def _getLocalOptions(options):
+    '''return `options` without the layer of the global configuration.
+
+    :func:`buildStatement` adds the global configuration itself, so
+    that it does not need to be passed as keyword arguments.
+    '''
+    return dict(collections.ChainMap(*options.maps[:-1]))
+
+
+def _flushPack(key, pack, run_pack):
+    '''submit `pack` unless it has been submitted already.'''
+    with PACK_LOCK:
+        if PENDING_PACKS.get(key) is not pack:
+            return
+        del PENDING_PACKS[key]
+    _startPack(pack, run_pack)
+
+
+def _startPack(pack, run_pack):
+    '''run `pack` in a separate thread.
+
+    Exceptions are passed on to all statements in the pack.
+    '''
+    def _target():
+        try:
+            run_pack(pack)
+        except Exception as msg:
+            for statement, outfile, future in pack:
+                if not future.done():
+                    future.set_exception(msg)
+
+    thread = threading.Thread(target=_target)
+    thread.daemon = True
+    thread.start()
+
+
+def _addToPack(key, statement, outfile, run_pack, pack_size, pack_wait):
+    '''add `statement` to the pack of statements for `key`.
+
+    `outfile` is recorded with the job statistics of the statement.
+
+    The pack is submitted by calling `run_pack` once it contains
+    `pack_size` statements or `pack_wait` seconds after its first
+    statement has been added, whichever comes first.
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        Future resolving to a tuple (exit status, stderr) of the
+        statement.
+    '''
+    future = concurrent.futures.Future()
+    full = None
+    with PACK_LOCK:
+        if key not in PENDING_PACKS:
+            pack = PENDING_PACKS[key] = []
+            timer = threading.Timer(pack_wait, _flushPack,
+                                    (key, pack, run_pack))
+            timer.daemon = True
+            timer.start()
+        pack = PENDING_PACKS[key]
+        pack.append((statement, outfile, future))
+        if len(pack) >= pack_size:
+            full = PENDING_PACKS.pop(key)
+
+    if full:
+        _startPack(full, run_pack)
+
+    return future
+
+
 def run(**kwargs):
     """run a command line statement.
 
@@ -344,6 +835,43 @@ def run(**kwargs):
     ``job_array`` is defined, the single statement will be submitted
     as an array job.
 
+    If ``job_pack`` is set to a value larger than 1, statements of the
+    same task with the same resource requirements are packed into a
+    single cluster job of up to ``job_pack`` statements. A pack is
+    submitted once it is full or ``job_pack_wait`` seconds after its
+    first statement has been added. Within the job, up to
+    ``job_pack_threads`` statements are run in parallel. The exit
+    status of each statement is reported separately, so each calling
+    task succeeds or fails independently.
+
+    If the session has been started with ``cluster_async`` set, jobs
+    are collected by the global :class:`JobPoller` and this function
+    waits on a future. Set ``cluster_async = False`` in the calling
+    function to wait within the DRMAA library instead.
+
+    If the calling function also sets ``job_async = True``, a single
+    statement is submitted and this function returns without waiting
+    for the job. The ruffus job is completed once the cluster job has
+    finished. Only set ``job_async`` if nothing after the call to
+    :func:`run` depends on the job having finished.
+
+    If ``cache_dir`` is set and the calling function sets
+    ``job_cache = True``, the outputs of a single statement are
+    restored from the result cache instead of running the statement
+    if an identical statement has been run on identical inputs
+    before.
+
+    If ``cluster_memory_adaptive`` is set and the calling function
+    does not set ``job_memory``, the memory reservation is predicted
+    from previous jobs of the same task. Jobs that run out of memory
+    are resubmitted with a larger reservation.
+
+    Jobs running locally are subject to admission control if
+    :func:`startLocalExecutor` has been called. Each statement will
+    wait until ``job_threads`` cores and ``job_memory`` memory are
+    available and will run with its virtual memory limited to
+    ``job_memory``.
+
     Troubleshooting:
 
        1. DRMAA creates sessions and their is a limited number
@@ -362,9 +890,11 @@ def run(**kwargs):
     """
 
     # combine options using correct preference
-    options = dict(list(PARAMS.items()))
-    options.update(list(getCallerLocals().items()))
-    options.update(list(kwargs.items()))
+    # the global configuration is not copied but layered below
+    # caller locals and kwargs. Modifications go into the top layer.
+    local_options = dict(list(getCallerLocals().items()))
+    local_options.update(list(kwargs.items()))
+    options = LayeredParameters({}, local_options, PARAMS)
 
     # insert legacy synonyms
     options['without_cluster'] = options.get('without_cluster')
@@ -394,8 +924,166 @@ def run(**kwargs):
         options["cluster_options"] = options.get("job_options", options["cluster_options"])
 
     # get the memory requirement for the job
+    explicit_memory = "job_memory" in options
     job_memory = getJobMemory(options, PARAMS)
 
+    task_name = getCallerName()
+    input_bytes = getInputBytes(options)
+    options["input_bytes"] = input_bytes
+
+    adaptive = options.get("cluster_memory_adaptive", False)
+    if adaptive and not explicit_memory:
+        predicted = predictJobMemory(task_name, input_bytes)
+        if predicted is not None:
+            predicted *= float(options.get("cluster_memory_margin", 1.2))
+            job_memory = bytes2memory(predicted)
+            E.debug("task %s: predicted memory %s" % (task_name, job_memory))
+
+    if options.get("cluster_memory_max", ""):
+        max_memory = IOTools.human2bytes(options["cluster_memory_max"])
+    else:
+        max_memory = None
+
+    if adaptive:
+        retries = int(options.get("cluster_memory_retries", 0))
+    else:
+        retries = 0
+
+    # look up single statements in the result cache
+    cache_key = None
+    outfiles = getFilenames(options, ("outfile", "outfiles"))
+    if options.get("cache_dir", "") and \
+       options.get("job_cache", False) and \
+       outfiles and \
+       "statement" in options and \
+       not options.get("statements") and \
+       not options.get("job_array") and \
+       not options.get("dryrun", False):
+        cache_key = getCacheKey(
+            buildStatement(**_getLocalOptions(options)),
+            getFilenames(options, ("infile", "infiles")))
+        if restoreFromCache(options["cache_dir"], cache_key, outfiles):
+            E.info("task %s: restored %s from cache %s" %
+                   (task_name, ",".join(outfiles), cache_key))
+            return
+
+    def _store():
+        if cache_key:
+            if options.get("cache_size", ""):
+                max_size = IOTools.human2bytes(options["cache_size"])
+            else:
+                max_size = None
+            storeInCache(options["cache_dir"], cache_key, outfiles,
+                         max_size)
+
+    deferred_jobs = getattr(DEFERRED_JOBS, "jobs", None)
+    if deferred_jobs is not None and \
+       options.get("job_async", False) and \
+       GLOBAL_POLLER is not None and \
+       options.get("cluster_async", False):
+        options["job_deferred"] = True
+        deferred_jobs.append((task_name,
+                              options.get("outfile", None),
+                              _runDeferred(options, job_memory, task_name,
+                                           retries, max_memory, _store)))
+        return
+
+    for attempt in range(retries + 1):
+        if max_memory and IOTools.human2bytes(job_memory) > max_memory:
+            job_memory = options["cluster_memory_max"]
+        try:
+            _run(options, job_memory, task_name)
+            break
+        except JobMemoryError:
+            job_memory = _increaseJobMemory(options, job_memory, task_name,
+                                            attempt, retries, max_memory)
+            if job_memory is None:
+                raise
+
+    _store()
+
+
+def _increaseJobMemory(options, job_memory, task_name,
+                       attempt, retries, max_memory):
+    '''return the memory to resubmit a job with that ran out of memory.
+
+    Returns None if the job is not to be resubmitted.
+    '''
+    if attempt == retries:
+        return None
+    memory = IOTools.human2bytes(job_memory)
+    if max_memory and memory >= max_memory:
+        return None
+    job_memory = bytes2memory(
+        memory * float(options.get("cluster_memory_retry_factor", 2)))
+    E.warn("task %s: job ran out of memory, resubmitting with %s" %
+           (task_name, job_memory))
+    return job_memory
+
+
+def _runDeferred(options, job_memory, task_name, retries, max_memory,
+                 on_success):
+    '''run the statement in `options` without waiting for the job.
+
+    The job is collected on a thread of the pool in
+    :data:`DEFERRED_JOBS` once the poller has seen it finish. Jobs
+    that run out of memory are resubmitted as in :func:`run` and
+    `on_success` is called once the job has finished successfully.
+
+    Returns a :class:`concurrent.futures.Future` that resolves once
+    the job has been collected.
+    '''
+    pool = DEFERRED_JOBS.pool
+    result = concurrent.futures.Future()
+
+    def _submit(attempt, job_memory):
+        if max_memory and IOTools.human2bytes(job_memory) > max_memory:
+            job_memory = options["cluster_memory_max"]
+        job = _run(options, job_memory, task_name)
+        if job is None:
+            # the statement could not be deferred and has been run
+            on_success()
+            result.set_result(None)
+            return
+        future, collect = job
+        future.add_done_callback(
+            lambda x: pool.apply_async(
+                _collect, (x, collect, attempt, job_memory)))
+
+    def _collect(future, collect, attempt, job_memory):
+        try:
+            try:
+                collect(future.result())
+            except JobMemoryError:
+                job_memory = _increaseJobMemory(
+                    options, job_memory, task_name,
+                    attempt, retries, max_memory)
+                if job_memory is None:
+                    raise
+                _submit(attempt + 1, job_memory)
+                return
+            on_success()
+        except Exception as msg:
+            result.set_exception(msg)
+            return
+        result.set_result(None)
+
+    _submit(0, job_memory)
+    return result
+
+
+def _run(options, job_memory, task_name):
+    '''run the statements in `options` with `job_memory` reserved.
+
+    If ``job_deferred`` is set in `options` and the statement is a
+    single cluster job collected by the poller, the function returns
+    after submission. It then returns a tuple of the future of the
+    job and a function to check the job information for errors.
+    Otherwise it returns None once all statements have finished.
+
+    See :func:`run`.
+    '''
+
     # get the queue manager
     queue_manager = PARAMS["cluster_queue_manager"]
 
@@ -411,6 +1099,18 @@ def run(**kwargs):
     ignore_pipe_errors = options.get('ignore_pipe_errors', False)
     ignore_errors = options.get('ignore_errors', False)
 
+    # collect jobs through the poller if available
+    poller = None
+    if options.get("cluster_async", False):
+        poller = GLOBAL_POLLER
+
+    # serialize calls into the session with the poller thread,
+    # otherwise the lock is private to this call
+    if poller:
+        session_lock = poller.session_lock
+    else:
+        session_lock = threading.Lock()
+
     # run on cluster if:
     # * to_cluster is not defined or set to True
     # * command line option without_cluster is set to False
@@ -425,6 +1125,10 @@ def run(**kwargs):
         "[:]", "_",
         os.path.basename(options.get("outfile", "ruffus")))
 
+    # pack statements of the same task into a single job
+    input_bytes = options.get("input_bytes", None)
+    job_pack = int(options.get("job_pack", 0) or 0)
+
     def _writeJobScript(statement, job_memory, job_name, shellfile):
         # disabled - problems with quoting
         # tmpfile.write( '''echo 'statement=%s' >> %s\n''' %
@@ -442,6 +1146,12 @@ def run(**kwargs):
                     echo "%(job_name)s : END -> ${0}" >> %(shellfile)s
                  ''' % locals()
 
+        job_path = getTempFilename(dir=PARAMS["workingdir"])
+
+        # record execution host for job statistics
+        script += "hostname > %s.host 2> /dev/null || true\n" % \
+            os.path.abspath(job_path)
+
         # restrict virtual memory
         # Note that there are resources in SGE which could do this directly
         # such as v_hmem.
@@ -452,29 +1162,181 @@ def run(**kwargs):
                                   ignore_pipe_errors=ignore_pipe_errors)
         script += "\n"
 
+        with open(job_path, "w") as script_file:
+            script_file.write(script)
+
+        return(job_path)
+
+    def _recordJob(job_id, job_path, retval):
+        statistics = parseResourceUsage(retval)
+        statistics["input_bytes"] = input_bytes
+        statistics["job_memory"] = IOTools.human2bytes(job_memory)
+        recordJobStatistics(task_name,
+                            options.get("outfile", None),
+                            job_id,
+                            getJobHost(os.path.abspath(job_path)),
+                            statistics)
+
+    def _writePackedJobScript(statements, job_memory, job_name, shellfile,
+                              parallel):
+        # each statement is a job script of its own. The packed job
+        # runs these through xargs and records exit status, stdout
+        # and stderr for each statement separately.
+        statement_paths = []
+        for statement in statements:
+            statement_path = _writeJobScript(
+                statement, job_memory, job_name, shellfile)
+            os.chmod(statement_path, stat.S_IRWXG | stat.S_IRWXU)
+            statement_paths.append(os.path.abspath(statement_path))
+
+        script = "#!/bin/bash\n"
+        script += "xargs -P %i -I{} /bin/bash -c " % parallel
+        script += "'{} > {}.stdout 2> {}.stderr; echo $? > {}.status' "
+        script += "<< 'EOF'\n%s\nEOF\n" % "\n".join(statement_paths)
+        script += "exit 0\n"
+
         job_path = getTempFilename(dir=PARAMS["workingdir"])
 
         with open(job_path, "w") as script_file:
             script_file.write(script)
 
-        return(job_path)
+        return job_path, statement_paths
+
+    def _runPack(pack):
+        statements = [x[0] for x in pack]
+        E.info("running pack of %i statements for task %s" %
+               (len(statements), task_name))
+
+        pack_options = options.new_child()
+        pack_options["job_threads"] = \
+            options.get("job_threads", 1) * pack_threads
+
+        job_path, statement_paths = _writePackedJobScript(
+            statements, job_memory, task_name, shellfile, pack_threads)
+
+        with session_lock:
+            jt = setupDrmaaJobTemplate(session, pack_options, task_name,
+                                       job_memory)
+        jt, stdout_path, stderr_path = setDrmaaJobPaths(jt, job_path)
+
+        if poller:
+            job_id, future = poller.submit(jt)
+            retval = future.result()
+        else:
+            job_id = session.runJob(jt)
+            E.debug("job has been submitted with job_id %s" % str(job_id))
+            retval = waitForJob(session, job_id)
+
+        with session_lock:
+            session.deleteJobTemplate(jt)
+        getStdoutStderr(stdout_path, stderr_path)
+
+        # resource usage is only known for the pack as a whole
+        statistics = parseResourceUsage(retval)
+        pack_statistics = {"queue_wait": statistics["queue_wait"],
+                           "job_memory": IOTools.human2bytes(job_memory)}
+
+        for (statement, outfile, future), statement_path in zip(
+                pack, statement_paths):
+            stdout, stderr = getStdoutStderr(statement_path + ".stdout",
+                                             statement_path + ".stderr")
+            try:
+                status = int(open(statement_path + ".status").read())
+                os.unlink(statement_path + ".status")
+            except (IOError, ValueError):
+                # statement did not complete, job has been aborted
+                status = -1
+
+            pack_statistics["exit_status"] = status
+            recordJobStatistics(task_name,
+                                outfile,
+                                job_id,
+                                getJobHost(statement_path),
+                                pack_statistics)
+
+            os.unlink(statement_path)
+            future.set_result((status, stderr))
+
+        os.unlink(job_path)
+
+    if run_on_cluster and job_pack > 1 and not options.get("job_array"):
+
+        statement_list = []
+        if options.get("statements"):
+            for statement in options.get("statements"):
+                options["statement"] = statement
+                statement_list.append(
+                    buildStatement(**_getLocalOptions(options)))
+        else:
+            statement_list.append(
+                buildStatement(**_getLocalOptions(options)))
+
+        if options.get("dryrun", False):
+            return
 
-    if run_on_cluster:
+        pack_threads = int(options.get("job_pack_threads", 1))
+        # statements are only packed if they would otherwise have
+        # been submitted with the same job template and environment
+        # and expanded in the same way
+        key = (task_name,
+               ignore_pipe_errors,
+               job_memory,
+               options.get("job_threads", 1),
+               options.get("conda_env"),
+               options["workingdir"],
+               shellfile,
+               options.get("cluster_queue"),
+               options.get("cluster_pe_queue"),
+               options.get("cluster_priority"),
+               options.get("cluster_options"),
+               options.get("cluster_parallel_environment"))
+
+        futures = []
+        for statement in statement_list:
+            E.info("packing statement:\n%s" % statement)
+            futures.append(_addToPack(key, statement,
+                                      options.get("outfile", None),
+                                      _runPack,
+                                      job_pack,
+                                      options.get("job_pack_wait", 10)))
+
+        for statement, future in zip(statement_list, futures):
+            status, stderr = future.result()
+            if status != 0 and not ignore_errors:
+                if isMemoryError(stderr):
+                    error = JobMemoryError
+                else:
+                    error = OSError
+                if status < 0:
+                    reason = "did not complete, the packed job was aborted"
+                else:
+                    reason = "exited with status %i" % status
+                raise error(
+                    "---------------------------------------\n"
+                    "Packed statement %s: \n"
+                    "The stderr was: \n%s\n%s\n"
+                    "-----------------------------------------" %
+                    (reason, "".join(stderr), statement))
+
+    elif run_on_cluster:
         # run multiple jobs
         if options.get("statements"):
 
             statement_list = []
             for statement in options.get("statements"):
                 options["statement"] = statement
-                statement_list.append(buildStatement(**options))
+                statement_list.append(
+                    buildStatement(**_getLocalOptions(options)))
 
             if options.get("dryrun", False):
                 return
 
-            jt = setupDrmaaJobTemplate(session, options, job_name, job_memory)
+            with session_lock:
+                jt = setupDrmaaJobTemplate(session, options, job_name,
+                                           job_memory)
             E.debug("Job spec is: %s" % jt.nativeSpecification)
 
-            job_ids, filenames = [], []
+            job_ids, futures, filenames = [], [], []
 
             for statement in statement_list:
                 E.info("running statement:\n%s" % statement)
@@ -483,41 +1345,70 @@ def run(**kwargs):
 
                 jt, stdout_path, stderr_path = setDrmaaJobPaths(jt, job_path)
 
-                job_id = session.runJob(jt)
+                if poller:
+                    job_id, future = poller.submit(jt)
+                    futures.append(future)
+                else:
+                    job_id = session.runJob(jt)
+                    E.debug("job has been submitted with job_id %s" %
+                            str(job_id))
 
                 job_ids.append(job_id)
                 filenames.append((job_path, stdout_path, stderr_path))
 
-                E.debug("job has been submitted with job_id %s" % str(job_id))
-
             E.debug("waiting for %i jobs to finish " % len(job_ids))
 
-            session.synchronize(job_ids, drmaa.Session.TIMEOUT_WAIT_FOREVER,
-                                False)
-
-            # collect and clean up
-            for job_id, statement, paths in zip(job_ids, statement_list,
-                                                filenames):
-                job_path, stdout_path, stderr_path = paths
-                collectSingleJobFromCluster(session, job_id,
-                                            statement,
-                                            stdout_path,
-                                            stderr_path,
-                                            job_path,
-                                            ignore_errors=ignore_errors)
-
-            session.deleteJobTemplate(jt)
+            if poller:
+                # collect and clean up in order of completion
+                index = dict([(f, x) for x, f in enumerate(futures)])
+                for future in concurrent.futures.as_completed(futures):
+                    x = index[future]
+                    job_path, stdout_path, stderr_path = filenames[x]
+                    retval = future.result()
+                    _recordJob(job_ids[x], job_path, retval)
+                    checkJobFromCluster(retval,
+                                        statement_list[x],
+                                        stdout_path,
+                                        stderr_path,
+                                        job_path,
+                                        ignore_errors=ignore_errors,
+                                        job_memory=IOTools.human2bytes(
+                                            job_memory))
+            else:
+                session.synchronize(job_ids,
+                                    drmaa.Session.TIMEOUT_WAIT_FOREVER,
+                                    False)
+
+                # collect and clean up
+                for job_id, statement, paths in zip(job_ids, statement_list,
+                                                    filenames):
+                    job_path, stdout_path, stderr_path = paths
+                    retval = waitForJob(session, job_id)
+                    _recordJob(job_id, job_path, retval)
+                    checkJobFromCluster(retval,
+                                        statement,
+                                        stdout_path,
+                                        stderr_path,
+                                        job_path,
+                                        ignore_errors=ignore_errors,
+                                        job_memory=IOTools.human2bytes(
+                                            job_memory))
+
+            with session_lock:
+                session.deleteJobTemplate(jt)
 
         # run single job on cluster - this can be an array job
         else:
 
-            statement = buildStatement(**options)
+            statement = buildStatement(**_getLocalOptions(options))
             E.info("running statement:\n%s" % statement)
 
             if options.get("dryrun", False):
                 return
 
-            jt = setupDrmaaJobTemplate(session, options, job_name, job_memory)
+            with session_lock:
+                jt = setupDrmaaJobTemplate(session, options, job_name,
+                                           job_memory)
             E.debug("Job spec is: %s" % jt.nativeSpecification)
 
             job_path = _writeJobScript(statement, job_memory, job_name, shellfile)
@@ -529,36 +1420,72 @@ def run(**kwargs):
                 E.debug("starting an array job: %i-%i,%i" %
                         (start, end, increment))
                 # sge works with 1-based, closed intervals
-                job_ids = session.runBulkJobs(jt, start + 1, end, increment)
+                with session_lock:
+                    job_ids = session.runBulkJobs(jt, start + 1, end,
+                                                  increment)
                 E.debug("%i array jobs have been submitted as job_id %s" %
                         (len(job_ids), job_ids[0]))
-                retval = session.synchronize(
-                    job_ids, drmaa.Session.TIMEOUT_WAIT_FOREVER, True)
+                if poller:
+                    for future in poller.watch(job_ids):
+                        future.result()
+                else:
+                    retval = session.synchronize(
+                        job_ids, drmaa.Session.TIMEOUT_WAIT_FOREVER, True)
 
                 stdout, stderr = getStdoutStderr(stdout_path, stderr_path)
 
+            elif poller:
+                # run a single job and wait for the poller to collect it
+                job_id, future = poller.submit(jt)
+
+                def _collect(retval):
+                    _recordJob(job_id, job_path, retval)
+                    checkJobFromCluster(retval,
+                                        statement,
+                                        stdout_path,
+                                        stderr_path,
+                                        job_path,
+                                        ignore_errors=ignore_errors,
+                                        job_memory=IOTools.human2bytes(
+                                            job_memory))
+
+                if options.get("job_deferred", False):
+                    # the job template is not needed after submission
+                    with session_lock:
+                        session.deleteJobTemplate(jt)
+                    return future, _collect
+
+                _collect(future.result())
+
             else:
                 # run a single job
                 job_id = session.runJob(jt)
                 E.debug("job has been submitted with job_id %s" % str(job_id))
 
-                collectSingleJobFromCluster(session, job_id,
-                                            statement,
-                                            stdout_path,
-                                            stderr_path,
-                                            job_path,
-                                            ignore_errors=ignore_errors)
-
-            session.deleteJobTemplate(jt)
+                retval = waitForJob(session, job_id)
+                _recordJob(job_id, job_path, retval)
+                checkJobFromCluster(retval,
+                                    statement,
+                                    stdout_path,
+                                    stderr_path,
+                                    job_path,
+                                    ignore_errors=ignore_errors,
+                                    job_memory=IOTools.human2bytes(
+                                        job_memory))
+
+            with session_lock:
+                session.deleteJobTemplate(jt)
     else:
         # run job locally on cluster
         statement_list = []
         if options.get("statements"):
             for statement in options.get("statements"):
                 options["statement"] = statement
-                statement_list.append(buildStatement(**options))
+                statement_list.append(
+                    buildStatement(**_getLocalOptions(options)))
         else:
-            statement_list.append(buildStatement(**options))
+            statement_list.append(
+                buildStatement(**_getLocalOptions(options)))
 
         if options.get("dryrun", False):
             return
@@ -581,21 +1508,77 @@ def run(**kwargs):
                 statement = pipes.quote(statement)
                 statement = "%s -c %s" % (shell, statement)
 
-            process = subprocess.Popen(
-                expandStatement(
+            statement = expandStatement(
+                statement,
+                ignore_pipe_errors=ignore_pipe_errors)
+
+            start_time = time.time()
+            resources = GLOBAL_LOCAL_RESOURCES
+            if resources:
+                # job_memory is per slot as for cluster jobs
+                job_threads = int(options.get("job_threads", 1))
+                memory = job_threads * IOTools.human2bytes(job_memory)
+                if options.get("local_memory_limit", False):
+                    # ulimit -v expects kilobytes
+                    statement = "ulimit -v %i\n%s" % (
+                        memory // 1024, statement)
+                resources.acquire(job_threads, memory)
+            queue_wait = time.time() - start_time
+
+            # output is collected in temporary files so that the
+            # process can be reaped with os.wait4 to obtain its
+            # resource usage.
+            stdout_file = tempfile.TemporaryFile()
+            stderr_file = tempfile.TemporaryFile()
+            try:
+                start_time = time.time()
+                process = subprocess.Popen(
                     statement,
-                    ignore_pipe_errors=ignore_pipe_errors),
-                cwd=PARAMS["workingdir"],
-                shell=True,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-
-            # process.stdin.close()
-            stdout, stderr = process.communicate()
+                    cwd=PARAMS["workingdir"],
+                    shell=True,
+                    stdin=subprocess.PIPE,
+                    stdout=stdout_file,
+                    stderr=stderr_file)
+
+                process.stdin.close()
+                pid, status, rusage = os.wait4(process.pid, 0)
+                if os.WIFSIGNALED(status):
+                    process.returncode = -os.WTERMSIG(status)
+                else:
+                    process.returncode = os.WEXITSTATUS(status)
+            finally:
+                if resources:
+                    resources.release(job_threads, memory)
+
+            recordJobStatistics(
+                task_name,
+                options.get("outfile", None),
+                process.pid,
+                socket.gethostname(),
+                {"queue_wait": queue_wait,
+                 "wall_time": time.time() - start_time,
+                 "cpu_time": rusage.ru_utime + rusage.ru_stime,
+                 "max_rss": rusage.ru_maxrss * 1024,
+                 "bytes_read": rusage.ru_inblock * 512,
+                 "bytes_written": rusage.ru_oublock * 512,
+                 "exit_status": process.returncode,
+                 "input_bytes": input_bytes,
+                 "job_memory": IOTools.human2bytes(job_memory)})
+
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+            stdout_file.close()
+            stderr_file.close()
 
             if process.returncode != 0 and not ignore_errors:
-                raise OSError(
+                # memory is only restricted with admission control
+                if isMemoryError([stderr.decode("utf-8", "replace")]) or \
+                   (resources and isMemoryError(
+                       [], rusage.ru_maxrss * 1024, memory)):
+                    error = JobMemoryError
+                else:
+                    error = OSError
+                raise error(
                     "---------------------------------------\n"
                     "Child was terminated by signal %i: \n"
                     "The stderr was: \n%s\n%s\n"
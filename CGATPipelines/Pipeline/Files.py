@@ -1,18 +1,44 @@
 """Files.py - Working with files in ruffus pipelines
 ====================================================
 
+Result cache
+------------
+
+The functions :func:`getCacheKey`, :func:`restoreFromCache` and
+:func:`storeInCache` implement a content-addressed cache of output
+files. The cache key combines a command line statement, the contents
+of its input files and the executables it calls. Outputs are stored
+in a shared cache directory and restored by copying. Files are not
+hard-linked, as a statement writing to a restored output would
+otherwise modify the cache entry.
+:func:`evictFromCache` removes least recently used entries to keep
+the cache below a given size.
+
 Reference
 ---------
 
 """
+import hashlib
 import os
+import re
+import shutil
 import tempfile
+import threading
 
 import CGAT.IOTools as IOTools
 
 # Set from Pipeline.py
 PARAMS = {}
 
+# checksums of files indexed by path, size and modification time
+CHECKSUMS = {}
+CHECKSUMS_LOCK = threading.Lock()
+
+# shell keywords that are not commands
+SHELL_KEYWORDS = set(("if", "then", "else", "elif", "fi", "for", "do",
+                      "done", "while", "until", "case", "esac", "in",
+                      "function", "time", "!", "{", "}"))
+
 
 def getTempFile(dir=None, shared=False, suffix="", mode="w+", encoding="utf-8"):
     '''get a temporary file.
@@ -134,3 +160,206 @@ def checkScripts(filenames):
 
     if missing:
         raise ValueError("missing scripts: %s" % ",".join(missing))
+
+
+def getFileChecksum(filename, blocksize=2 ** 20):
+    '''return the sha1 checksum of the contents of a file.
+
+    Checksums are memoized for the lifetime of the process using the
+    path, size and modification time of the file.
+    '''
+    st = os.stat(filename)
+    key = (os.path.realpath(filename), st.st_size, st.st_mtime)
+    with CHECKSUMS_LOCK:
+        if key in CHECKSUMS:
+            return CHECKSUMS[key]
+
+    sha = hashlib.sha1()
+    with open(filename, "rb") as inf:
+        while True:
+            block = inf.read(blocksize)
+            if not block:
+                break
+            sha.update(block)
+    checksum = sha.hexdigest()
+
+    with CHECKSUMS_LOCK:
+        CHECKSUMS[key] = checksum
+    return checksum
+
+
+def getStatementExecutables(statement):
+    '''return the executables called in a command line statement.
+
+    Commands are taken as the first word of every command within a
+    pipe or list of commands, ignoring variable assignments and shell
+    keywords.
+    '''
+    executables = []
+    for command in re.split("[|;&()\n]+", statement):
+        for word in command.split():
+            if word in SHELL_KEYWORDS or re.match("^[A-Za-z_]+=", word):
+                continue
+            executables.append(word)
+            break
+    return executables
+
+
+def getCacheKey(statement, infiles=()):
+    '''return the cache key for a statement.
+
+    The key is computed from the statement with the working directory
+    removed, the checksums of all input files and the location, size
+    and modification time of each executable called within the
+    statement.
+
+    Arguments
+    ---------
+    statement : string
+        The fully interpolated command line statement.
+    infiles : list
+        Filenames of input files.
+
+    Returns
+    -------
+    key : string
+    '''
+    sha = hashlib.sha256()
+
+    workingdir = PARAMS.get("workingdir", None)
+    if workingdir:
+        statement = statement.replace(workingdir, "@WORKINGDIR@")
+    sha.update(statement.encode("utf-8"))
+
+    for infile in infiles:
+        if os.path.isfile(infile):
+            sha.update(getFileChecksum(infile).encode("utf-8"))
+
+    for executable in sorted(set(getStatementExecutables(statement))):
+        path = IOTools.which(executable)
+        if path:
+            st = os.stat(path)
+            sha.update(("%s:%i:%i" % (path, st.st_size, st.st_mtime)).
+                       encode("utf-8"))
+
+    return sha.hexdigest()
+
+
+def restoreFromCache(cache_dir, key, outfiles):
+    '''restore output files from the cache.
+
+    The modification time of each restored file is set to the current
+    time so that ruffus regards them as up-to-date.
+
+    Arguments
+    ---------
+    cache_dir : string
+        Directory of the cache.
+    key : string
+        Cache key, see :func:`getCacheKey`.
+    outfiles : list
+        Filenames of output files.
+
+    Returns
+    -------
+    bool
+        True if the outputs have been restored.
+    '''
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return False
+
+    sources = [os.path.join(entry, str(x)) for x in range(len(outfiles))]
+    if not all([os.path.exists(x) for x in sources]):
+        return False
+
+    for source, outfile in zip(sources, outfiles):
+        if os.path.exists(outfile):
+            os.unlink(outfile)
+        shutil.copy2(source, outfile)
+        os.utime(outfile, None)
+
+    # mark entry as recently used
+    os.utime(entry, None)
+    return True
+
+
+def storeInCache(cache_dir, key, outfiles, max_size=None):
+    '''store output files in the cache.
+
+    Output files are copied into the cache. The entry is created in a
+    temporary directory first and then moved into place, so that
+    concurrent jobs never see partial entries.
+
+    Arguments
+    ---------
+    cache_dir : string
+        Directory of the cache.
+    key : string
+        Cache key, see :func:`getCacheKey`.
+    outfiles : list
+        Filenames of output files.
+    max_size : int
+        If given, evict entries so that the cache does not exceed
+        `max_size` bytes.
+
+    Returns
+    -------
+    bool
+        True if the outputs have been stored.
+    '''
+    if not all([os.path.isfile(x) for x in outfiles]):
+        return False
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    entry = os.path.join(cache_dir, key)
+    if os.path.exists(entry):
+        return True
+
+    tmpdir = tempfile.mkdtemp(dir=cache_dir, prefix=".ctmp")
+    try:
+        for x, outfile in enumerate(outfiles):
+            shutil.copy2(outfile, os.path.join(tmpdir, str(x)))
+        os.rename(tmpdir, entry)
+    except OSError:
+        # another process has stored the same entry
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if max_size:
+        evictFromCache(cache_dir, max_size)
+
+    return True
+
+
+def evictFromCache(cache_dir, max_size):
+    '''remove least recently used entries from the cache.
+
+    Arguments
+    ---------
+    cache_dir : string
+        Directory of the cache.
+    max_size : int
+        Maximum size of the cache in bytes.
+    '''
+    entries = []
+    total = 0
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        if key.startswith(".") or not os.path.isdir(entry):
+            continue
+        try:
+            size = sum([os.path.getsize(os.path.join(entry, x))
+                        for x in os.listdir(entry)])
+            entries.append((os.path.getmtime(entry), size, entry))
+        except OSError:
+            # entry removed by another process
+            continue
+        total += size
+
+    entries.sort()
+    while total > max_size and entries:
+        mtime, size, entry = entries.pop(0)
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
@@ -35,17 +35,24 @@ Reference
 '''
 import os
 import re
+import json
 import shutil
+import hashlib
 import inspect
 import collections
+from multiprocessing.pool import ThreadPool
 import brewer2mpl
 
 from CGAT import Experiment as E
 import CGAT.IOTools as IOTools
 from CGATPipelines.Pipeline.Parameters import loadParameters
+from CGATPipelines.Pipeline.Files import getFileChecksum
 
 PROJECT_ROOT = '/ifs/projects'
 
+# name of the file recording the pages of a published report
+PUBLISH_MANIFEST = ".publish_manifest.json"
+
 # Variables PARAMS and CONFIG will be set by Pipeline.py
 # on import.
 PARAMS = None
@@ -231,6 +238,119 @@ def getPublishDestinations(prefix="", suffix=None):
     return dest_report, dest_export
 
 
+def _publishPage(args):
+    '''copy a page to its destination applying substitutions.'''
+    src, dest, patterns = args
+    with open(src) as inf:
+        data = inf.read()
+    for rx, repl in patterns:
+        data = rx.sub(repl, data)
+    with open(dest, "w") as outf:
+        outf.write(data)
+    shutil.copymode(src, dest)
+    return dest
+
+
+def _publishPages(src_dir, dest_dir, patterns=[], threads=1):
+    '''incrementally publish the pages in `src_dir` into `dest_dir`.
+
+    Each file is fingerprinted by its content hash, which is stored
+    in the manifest :file:`.publish_manifest.json` in `dest_dir`
+    together with the size and modification time of the file. Only
+    files that are new or have changed since the last publication are
+    copied. Pages ending in ``.html`` are read once, `patterns` are
+    applied in memory and the page is written to `dest_dir`. Pages
+    are rewritten using a pool of `threads` threads, which works
+    with any replacement in `patterns` including callables. All pages
+    are rewritten if `patterns` change. Files that no longer exist in
+    `src_dir` are removed from `dest_dir`.
+    '''
+    if not os.path.exists(src_dir):
+        if os.path.exists(dest_dir):
+            shutil.rmtree(dest_dir)
+        E.warn("%s does not exist - skipped" % src_dir)
+        return
+
+    patterns = [(re.compile(rx), repl) for rx, repl in patterns]
+    fingerprint = hashlib.sha1(repr(
+        [(rx.pattern, rx.flags, repl if isinstance(repl, str) else
+          getattr(repl, "__name__", repr(repl)))
+         for rx, repl in patterns]).encode("utf-8")).hexdigest()
+
+    manifest_file = os.path.join(dest_dir, PUBLISH_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file) as inf:
+                manifest = json.load(inf)
+        except ValueError:
+            E.warn("could not read %s - republishing all pages" %
+                   manifest_file)
+    published = manifest.get("files", {})
+    patterns_changed = manifest.get("patterns") != fingerprint
+
+    files, copy, rewrite = {}, [], []
+    for root, dirs, filenames in os.walk(src_dir, followlinks=True):
+        for f in filenames:
+            src = os.path.join(root, f)
+            relpath = os.path.relpath(src, src_dir)
+            dest = os.path.join(dest_dir, relpath)
+            st = os.stat(src)
+            entry = published.get(relpath)
+            if entry and entry[:2] == [st.st_size, st.st_mtime]:
+                checksum = entry[2]
+            else:
+                checksum = getFileChecksum(src)
+            files[relpath] = [st.st_size, st.st_mtime, checksum]
+
+            is_html = f.endswith(".html")
+            if (entry is None or entry[2] != checksum
+                    or not os.path.exists(dest)
+                    or (is_html and patterns_changed)):
+                if is_html:
+                    rewrite.append((src, dest, patterns))
+                else:
+                    copy.append((src, dest))
+
+    # remove files that are no longer part of the report
+    removed = 0
+    if os.path.exists(dest_dir):
+        for root, dirs, filenames in os.walk(dest_dir):
+            for f in filenames:
+                fn = os.path.join(root, f)
+                relpath = os.path.relpath(fn, dest_dir)
+                if relpath != PUBLISH_MANIFEST and relpath not in files:
+                    os.remove(fn)
+                    removed += 1
+
+    for dirname in set([os.path.dirname(x[1]) for x in copy + rewrite]):
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    for src, dest in copy:
+        shutil.copy2(src, dest)
+
+    threads = min(threads, len(rewrite))
+    if threads > 1:
+        pool = ThreadPool(threads)
+        pool.map(_publishPage, rewrite,
+                 chunksize=max(1, len(rewrite) // (4 * threads)))
+        pool.close()
+        pool.join()
+    else:
+        for args in rewrite:
+            _publishPage(args)
+
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    with open(manifest_file, "w") as outf:
+        json.dump({"patterns": fingerprint, "files": files}, outf)
+
+    E.info("published %i files: %i copied, %i rewritten, %i removed, "
+           "%i unchanged" % (len(files), len(copy), len(rewrite), removed,
+                             len(files) - len(copy) - len(rewrite)))
+
+
 def publish_report(prefix="",
                    patterns=[],
                    project_id=None,
@@ -238,6 +358,7 @@ def publish_report(prefix="",
                    export_files=None,
                    suffix=None,
                    subdirs=False,
+                   threads=None,
                    ):
     '''publish report into web directory.
 
@@ -256,6 +377,12 @@ def publish_report(prefix="",
     replacement_string).  Each substitutions will be applied on each
     file ending in .html.
 
+    Publishing is incremental. Only pages that have changed since
+    the last time the report was published are copied, see
+    :func:`_publishPages`. Pages are rewritten in parallel using
+    *threads* threads, which defaults to the option
+    ``report_threads``.
+
     If *project_id* is not given, it will be looked up. This requires
     that this method is called within a subdirectory of PROJECT_ROOT.
 
@@ -335,14 +462,6 @@ def publish_report(prefix="",
 
         os.symlink(os.path.abspath(src), dest)
 
-    def _copy(src, dest):
-        if os.path.exists(dest):
-            shutil.rmtree(dest)
-        if not os.path.exists(src):
-            E.warn("%s does not exist - skipped" % src)
-            return
-        shutil.copytree(os.path.abspath(src), dest)
-
     # publish export dir via symlinking
     E.info("linking export directory in %s" % dest_export)
     _link(src_export,
@@ -351,20 +470,12 @@ def publish_report(prefix="",
     # publish web pages by copying
     E.info("publishing web pages in %s" %
            os.path.abspath(os.path.join(web_dir, dest_report)))
-    _copy(os.path.abspath("report/html"),
-          os.path.abspath(os.path.join(web_dir, dest_report)))
-
-    for root, dirs, files in os.walk(os.path.join(web_dir, dest_report)):
-        for f in files:
-            fn = os.path.join(root, f)
-            if fn.endswith(".html"):
-                with open(fn) as inf:
-                    data = inf.read()
-                for rx, repl in _patterns:
-                    data = rx.sub(repl, data)
-                outf = open(fn, "w")
-                outf.write(data)
-                outf.close()
+    if threads is None:
+        threads = PARAMS.get("report_threads", 1)
+    _publishPages(os.path.abspath("report/html"),
+                  os.path.abspath(os.path.join(web_dir, dest_report)),
+                  _patterns,
+                  threads=threads)
 
     if export_files:
         bigwigs, bams, beds = [], [], []
@@ -7,6 +7,7 @@ Reference
 """
 
 import re
+import bisect
 import collections
 import os
 
@@ -65,10 +66,114 @@ class TriggeredDefaultFactory:
         else:
             raise KeyError("missing parameter accessed")
 
+
+class ParameterDict(collections.defaultdict):
+    '''dictionary of configuration values with a prefix index.
+
+    The keys are kept in a sorted index, which permits finding all
+    keys starting with a given prefix in time proportional to the
+    number of matches. Keys containing the wildcard ``%`` are kept
+    as precompiled regular expressions. Both are rebuilt lazily
+    after the dictionary has been modified.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        collections.defaultdict.__init__(self, *args, **kwargs)
+        self._version = 0
+        self._index = None
+        self._patterns = None
+
+    def _invalidate(self):
+        self._version += 1
+        self._index = None
+        self._patterns = None
+
+    def __setitem__(self, key, value):
+        collections.defaultdict.__setitem__(self, key, value)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        collections.defaultdict.__delitem__(self, key)
+        self._invalidate()
+
+    def update(self, *args, **kwargs):
+        collections.defaultdict.update(self, *args, **kwargs)
+        self._invalidate()
+
+    def pop(self, *args):
+        value = collections.defaultdict.pop(self, *args)
+        self._invalidate()
+        return value
+
+    def popitem(self):
+        value = collections.defaultdict.popitem(self)
+        self._invalidate()
+        return value
+
+    def setdefault(self, key, default=None):
+        value = collections.defaultdict.setdefault(self, key, default)
+        self._invalidate()
+        return value
+
+    def clear(self):
+        collections.defaultdict.clear(self)
+        self._invalidate()
+
+    def _getIndex(self):
+        index = self._index
+        if index is None:
+            version = self._version
+            index = sorted([x for x in list(self.keys())
+                            if isinstance(x, str)])
+            if version == self._version:
+                self._index = index
+        return index
+
+    def getKeysWithPrefix(self, prefix):
+        '''return all keys starting with `prefix`.'''
+        index = self._getIndex()
+        result = []
+        for x in range(bisect.bisect_left(index, prefix), len(index)):
+            if not index[x].startswith(prefix):
+                break
+            result.append(index[x])
+        return result
+
+    def getWildcardPatterns(self):
+        '''return a list of (regular expression, key) tuples for all
+        keys containing a ``%`` wildcard.'''
+        patterns = self._patterns
+        if patterns is None:
+            version = self._version
+            patterns = [(re.compile(re.sub("%", ".*", x)), x)
+                        for x in list(self.keys())
+                        if isinstance(x, str) and "%" in x]
+            if version == self._version:
+                self._patterns = patterns
+        return patterns
+
+
+class LayeredParameters(collections.ChainMap):
+    '''a stack of parameter dictionaries.
+
+    Lookups search the dictionaries in order. Modifications only
+    affect the first dictionary, so the underlying global
+    configuration is never copied or changed. Unlike a plain
+    :class:`collections.ChainMap`, missing keys do not trigger the
+    default factory of the global dictionary.
+    '''
+
+    def __getitem__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                return mapping[key]
+        return self.__missing__(key)
+
+
 # Global variable for parameter interpolation in commands
 # This is a dictionary that can be switched between defaultdict
 # and normal dict behaviour.
-PARAMS = collections.defaultdict(TriggeredDefaultFactory())
+PARAMS = ParameterDict(TriggeredDefaultFactory())
 
 # patch - if --help or -h in command line arguments,
 # switch to a default dict to avoid missing paramater
@@ -115,6 +220,19 @@ HARDCODED_PARAMS = {
     'database_password': "",
     # database port - if required
     'database_port': 3306,
+    # load tables into sqlite databases within the pipeline process
+    # instead of through csv2db
+    'database_load_inprocess': False,
+    # number of rows to insert per batch when loading in-process
+    'database_load_batch_size': 10000,
+    # send loads of concurrent tasks through a single writer instead
+    # of competing for the database lock. This implies loading
+    # in-process
+    'database_writer': False,
+    # number of rows after which the writer commits a transaction
+    'database_writer_max_rows': 1000000,
+    # number of seconds after which the writer commits a transaction
+    'database_writer_max_seconds': 10,
     # wrapper around non-CGAT scripts
     'cmd-run': """%(pipeline_scriptsdir)s/run.py""",
     # legacy directory used for temporary local files
@@ -146,6 +264,38 @@ HARDCODED_PARAMS = {
     'cluster_options': "",
     # parallel environment to use for multi-threaded jobs
     'cluster_parallel_environment': 'dedicated',
+    # collect cluster jobs asynchronously through a single poller
+    # thread instead of blocking one thread per job
+    'cluster_async': False,
+    # interval in seconds between polls of outstanding cluster jobs
+    'cluster_poll_interval': 5,
+    # apply admission control to jobs running locally
+    'local_executor': False,
+    # number of cores available to local jobs - default is all
+    'local_num_cores': 0,
+    # memory available to local jobs - default is all
+    'local_memory': "",
+    # restrict virtual memory of local jobs to their reservation
+    'local_memory_limit': False,
+    # request memory as predicted from previous jobs of a task
+    'cluster_memory_adaptive': False,
+    # safety margin to apply to predicted memory
+    'cluster_memory_margin': 1.2,
+    # number of times to resubmit a job that ran out of memory
+    'cluster_memory_retries': 2,
+    # factor to increase memory by when resubmitting
+    'cluster_memory_retry_factor': 2,
+    # maximum amount of memory to request - empty for no limit
+    'cluster_memory_max': "",
+    # shared directory for caching results of statements - empty
+    # to disable caching
+    'cache_dir': "",
+    # maximum size of the result cache - empty for no limit
+    'cache_size': "",
+    # table to record job statistics in, empty to disable
+    'job_statistics_table': "",
+    # sqlite database in the working directory for job statistics
+    'job_statistics_database': "job_statistics.db",
     # ruffus job limits for databases
     'jobs_limit_db': 10,
     # ruffus job limits for R
@@ -558,11 +708,9 @@ def matchParameter(param):
     if param in PARAMS:
         return param
 
-    for key in list(PARAMS.keys()):
-        if "%" in key:
-            rx = re.compile(re.sub("%", ".*", key))
-            if rx.search(param):
-                return key
+    for rx, key in PARAMS.getWildcardPatterns():
+        if rx.search(param):
+            return key
 
     raise KeyError("parameter '%s' can not be matched in dictionary" %
                    param)
@@ -593,6 +741,11 @@ def substituteParameters(**kwargs):
         print substituteParameters(**locals())
         {"tophat_cutoff": 0.5, "tophat_threads": 6}
 
+    The global dictionary is not copied. Instead, the returned
+    dictionary layers task specific values and `kwargs` on top of
+    :py:data:`PARAMS`. Task specific values are found through the
+    prefix index of :py:data:`PARAMS`.
+
     Returns
     -------
     params : dict
@@ -601,13 +754,20 @@ def substituteParameters(**kwargs):
     '''
 
     # build parameter dictionary
-    # note the order of addition to make sure that kwargs takes precedence
-    local_params = dict(list(PARAMS.items()) + list(kwargs.items()))
+    # note the order of layers to make sure that kwargs takes precedence
+    local_params = LayeredParameters({}, kwargs, PARAMS)
 
     if "outfile" in local_params:
         # replace specific parameters with task (outfile) specific parameters
         outfile = local_params["outfile"]
-        for k in list(local_params.keys()):
+        if isinstance(outfile, str):
+            keys = [k for k in kwargs if k.startswith(outfile)] + \
+                [k for k in PARAMS.getKeysWithPrefix(outfile)
+                 if k not in kwargs]
+        else:
+            keys = list(local_params.keys())
+
+        for k in keys:
             if k.startswith(outfile):
                 p = k[len(outfile) + 1:]
                 if p not in local_params:
@@ -6,6 +6,7 @@ Reference
 
 """
 import inspect
+import os
 import sys
 
 
@@ -60,6 +61,29 @@ def getCaller(decorators=0):
     return mod
 
 
+def getCallerName():
+    """return the name of the task calling into the Pipeline module.
+
+    The stack is searched for the first function outside of the
+    :mod:`CGATPipelines.Pipeline` package, so that calls through
+    helpers such as :func:`load` are attributed to the calling task.
+
+    Returns
+    -------
+    name : string
+        The name of the calling function or "ruffus" if none could
+        be found.
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if os.path.dirname(filename) != package_dir:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return "ruffus"
+
+
 def add_doc(value, replace=False):
     """add doc string of value to function that is decorated.
 
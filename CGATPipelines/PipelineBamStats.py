@@ -30,6 +30,8 @@ Reference
 import os
 import re
 import gzip
+import math
+import multiprocessing
 import pysam
 import pandas as pd
 
@@ -55,7 +57,111 @@ def getNumReadsFromReadsFile(infile):
     return nreads
 
 
-def getStrandSpecificity(infile, outfile, iterations):
+# library types reported by :func:`getStrandSpecificity`
+STRAND_LIBRARY_TYPES = ("MSR", "ISR", "OSR", "ISF", "MSF", "OSF", "SF", "SR")
+
+
+def _classifyStrand(read):
+    '''return the salmon library type supported by a read.
+
+    Paired reads are classified by their first read only so that
+    each pair is counted once. Returns None for reads that are not
+    informative.
+    '''
+    if read.is_unmapped or read.is_secondary or read.is_supplementary:
+        return None
+
+    if not read.is_paired:
+        if read.is_reverse:
+            return "SR"
+        else:
+            return "SF"
+
+    if not read.is_proper_pair or not read.is_read1:
+        return None
+
+    R1_is_reverse = read.is_reverse
+    R1_reference_start = read.reference_start
+    R2_is_reverse = read.mate_is_reverse
+    R2_reference_start = read.next_reference_start
+
+    if R1_is_reverse:
+        if R2_is_reverse:
+            return "MSF"
+        elif R2_reference_start - R1_reference_start >= 0:
+            return "OSR"
+        else:
+            return "ISR"
+    else:
+        if not R2_is_reverse:
+            return "MSR"
+        elif R1_reference_start - R2_reference_start >= 0:
+            return "OSF"
+        else:
+            return "ISF"
+
+
+def _countStrandRegions(args):
+    '''count library types in a list of regions of a bam file.
+
+    Each region is a tuple of (contig, start, nreads). Reads are
+    collected from `start` onwards until `nreads` informative reads
+    have been seen or the end of the contig has been reached.
+    '''
+    infile, regions = args
+    counts = dict([(x, 0) for x in STRAND_LIBRARY_TYPES])
+    with pysam.AlignmentFile(infile) as samfile:
+        for contig, start, nreads in regions:
+            n = 0
+            for read in samfile.fetch(contig, start):
+                if read.reference_start < start:
+                    continue
+                library_type = _classifyStrand(read)
+                if library_type is None:
+                    continue
+                counts[library_type] += 1
+                n += 1
+                if n >= nreads:
+                    break
+    return counts
+
+
+def _sampleStrandRegions(samfile, nreads, reads_per_region=1000):
+    '''distribute `nreads` across evenly spaced regions of all contigs.
+
+    The number of reads sampled from each contig is proportional to the
+    number of reads mapped to it according to the bam index.
+    '''
+    stats = [(x.contig, x.mapped) for x in samfile.get_index_statistics()
+             if x.mapped > 0]
+    total = sum(x[1] for x in stats)
+    regions = []
+    for contig, mapped in stats:
+        quota = int(math.ceil(float(nreads) * mapped / total))
+        length = samfile.get_reference_length(contig)
+        nregions = max(1, min(quota // reads_per_region, length))
+        per_region = int(math.ceil(float(quota) / nregions))
+        for x in range(nregions):
+            regions.append((contig,
+                            int(length * float(x) / nregions),
+                            per_region))
+    return regions
+
+
+def _getBinomialInterval(k, n, z=1.96):
+    '''return the Wilson score interval for a proportion of `k` in `n`.'''
+    if n == 0:
+        return 0.0, 0.0
+    p = float(k) / n
+    denominator = 1.0 + z * z / n
+    centre = (p + z * z / (2.0 * n)) / denominator
+    width = z * math.sqrt(p * (1.0 - p) / n
+                          + z * z / (4.0 * n * n)) / denominator
+    return max(0.0, centre - width), min(1.0, centre + width)
+
+
+@P.cluster_runnable
+def getStrandSpecificity(infile, outfile, iterations, threads=4):
     '''
     This code will determine the strand specificity of your reads
     for calculating library strandness.
@@ -71,106 +177,93 @@ def getStrandSpecificity(infile, outfile, iterations):
 
     For paired-end data:
     The relative position of read1 and read2 needs to be determined including
-    orientation relative to each other.
-    '''
-    outfile = IOTools.openFile(outfile, "w")
-    samfile = pysam.Samfile(infile)
+    orientation relative to each other. Each proper pair is counted once
+    through its first read, improper pairs are ignored.
 
-    n = 0
+    If the bam file is indexed, reads are sampled from evenly spaced
+    regions across all contigs in proportion to the number of reads
+    mapped to each contig. The regions are processed in `threads`
+    worker processes. Without an index, the first reads in the file
+    are used. As it starts worker processes, the function should be
+    run with ``submit=True`` from within a pipeline.
 
-    # initialise counts for each library type
-    MSR = 0
-    MSF = 0
-    ISF = 0
-    ISR = 0
-    OSF = 0
-    OSR = 0
-    SR = 0
-    SF = 0
+    The output contains the percentage of reads supporting each
+    library type. The lower and upper bounds of the 95% confidence
+    interval of each percentage and the number of reads sampled are
+    written to :file:`outfile.intervals`.
+
+    Arguments
+    ---------
+    infile : string
+        Input filename in :term:`BAM` format.
+    outfile : string
+        Output filename.
+    iterations : int
+        Number of reads to sample.
+    threads : int
+        Number of worker processes.
+    '''
+    iterations = int(iterations)
 
-    reads_processed = set()
+    with pysam.AlignmentFile(infile) as samfile:
+        if samfile.has_index():
+            regions = _sampleStrandRegions(samfile, iterations)
+        else:
+            E.warn("%s is not indexed - using the first %i reads" %
+                   (infile, iterations))
+            regions = None
+
+            counts = dict([(x, 0) for x in STRAND_LIBRARY_TYPES])
+            n = 0
+            for read in samfile.fetch(until_eof=True):
+                library_type = _classifyStrand(read)
+                if library_type is None:
+                    continue
+                counts[library_type] += 1
+                n += 1
+                if n >= iterations:
+                    break
 
-    for read in samfile:
+    if regions is not None:
+        # worker processes of ruffus can not have children
+        if multiprocessing.current_process().daemon:
+            threads = 1
+        chunks = [(infile, regions[x::threads]) for x in range(threads)]
+        if threads > 1:
+            pool = multiprocessing.Pool(threads)
+            results = pool.map(_countStrandRegions, chunks)
+            pool.close()
+            pool.join()
+        else:
+            results = list(map(_countStrandRegions, chunks))
 
-        n += 1
-        if n <= int(iterations):
+        counts = dict([(x, sum(y[x] for y in results))
+                       for x in STRAND_LIBRARY_TYPES])
 
-            # to handle paired end reads:
-            if read.is_paired and read.is_proper_pair:
-                if read.qname in reads_processed:
-                    pass
-                else:
+    total = sum(counts.values())
+    if total == 0:
+        E.warn("no informative reads in %s" % infile)
 
-                    # get attributes of read
-                    read_start = read.reference_start
-                    read_end = read.reference_end
-                    read_neg = read.is_reverse
-
-                    # specify which read is R1 and which is R2:
-                    # specify which read is R1 and which is R2:
-                    if read.is_read1 is True:
-                        R1_is_reverse = read.is_reverse
-                        R1_reference_start = read.reference_start
-
-                        R2_is_reverse = read.mate_is_reverse
-                        R2_reference_start = read.next_reference_start
-                    else:
-                        R1_is_reverse = read.mate_is_reverse
-                        R1_reference_start = read.next_reference_start
-
-                        R2_is_reverse = read.is_reverse
-                        R2_reference_start = read.reference_start
-
-                        # Decision tree to specify strandness:
-                        # potential to convert this to a machine learning
-                        # decision tree algorithm in the future:
-                    if R1_is_reverse is True:
-
-                        if R2_is_reverse is True:
-
-                            MSF += 1
-                        else:
-                            if R2_reference_start - R1_reference_start >= 0:
-                                OSR += 1
-                            else:
-                                ISR += 1
-
-                    else:
-
-                        if R2_is_reverse is True:
-
-                            if R1_reference_start - R2_reference_start >= 0:
-
-                                OSF += 1
-                            else:
-                                ISF += 1
-                        else:
-                            MSR += 1
-            else:
-                if read.is_reverse:
-                    SR += 1
-                else:
-                    SF += 1
+    percentages, intervals = [], []
+    for library_type in STRAND_LIBRARY_TYPES:
+        k = counts[library_type]
+        if total > 0:
+            percentages.append(100.0 * k / total)
         else:
-            break
-    total = MSR + ISR + OSR + ISF + MSF + OSF + SF + SR
+            percentages.append(0.0)
+        lower, upper = _getBinomialInterval(k, total)
+        intervals.extend((100.0 * lower, 100.0 * upper))
 
-    def total_percent(strand, total):
-        return float(strand) / float(total) * 100
+    with IOTools.openFile(outfile, "w") as outf:
+        outf.write("\t".join(STRAND_LIBRARY_TYPES) + "\n")
+        outf.write("\t".join(map(str, percentages)) + "\n")
 
-    MSR_total = total_percent(MSR, total)
-    ISR_total = total_percent(ISR, total)
-    OSR_total = total_percent(OSR, total)
-    ISF_total = total_percent(ISF, total)
-    MSF_total = total_percent(MSF, total)
-    OSF_total = total_percent(OSF, total)
-    SF_total = total_percent(SF, total)
-    SR_total = total_percent(SR, total)
-
-    outfile.write("MSR\tISR\tOSR\tISF\tMSF\tOSF\tSF\tSR\n")
-    outfile.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" %
-                  (MSR_total, ISR_total, OSR_total, ISF_total, MSF_total, OSF_total,
-                   SF_total, SR_total))
+    with IOTools.openFile(outfile + ".intervals", "w") as outf:
+        outf.write("\t".join(
+            ["%s_%s" % (x, y) for x in STRAND_LIBRARY_TYPES
+             for y in ("lower", "upper")]
+            + ["nreads"]) + "\n")
+        outf.write("\t".join(map(str, intervals + [total])) + "\n")
 
 
 def buildPicardInsertSizeStats(infile, outfile, genome_file):
@@ -622,41 +715,40 @@ def loadTranscriptProfile(infiles, outfile,
 def loadStrandSpecificity(infiles, outfile,
                           suffix="strand",
                           tablename=None):
-    '''
+    '''load strand specificity of all tracks into a single table.
+
+    The confidence intervals of the percentages and the number of
+    reads sampled are loaded into the table ``<tablename>_intervals``
+    if they are present.
     '''
 
     if not tablename:
         tablename = "%s_%s" % (P.toTable(outfile), suffix)
 
-    outf = P.getTempFile(".")
-
-    table_count = 0
-    table_join = None
-
-    for infile in infiles:
-        name = P.snip(os.path.basename(infile), ".strand")
+    def _load(filenames, tablename):
+        tables = []
+        for infile, filename in filenames:
+            table = pd.read_csv(filename, sep="\t")
+            table["track"] = P.snip(os.path.basename(infile), ".strand")
+            tables.append(table)
 
-        table = pd.read_csv(infile, sep="\t")
-        table["track"] = name
+        outf = P.getTempFile(".")
+        pd.concat(tables).to_csv(outf, sep="\t", index=False)
+        outf.close()
 
-        if table_count == 0:
-            table_join = table
-            table_count += 1
-        else:
-            table_join = table.merge(table_join,
-                                     on=["MSR", "ISR", "OSR", "ISF", "MSF", "OSF", "SF", "SR", "track"],
-                                     how="outer")
+        P.load(infile=outf.name,
+               outfile=outfile,
+               tablename=tablename,
+               options="--add-index=track")
 
-    table_join.to_csv(outf, sep="\t", index=False)
+        os.unlink(outf.name)
 
-    outf.close()
+    _load([(x, x) for x in infiles], tablename)
 
-    P.load(infile=outf.name,
-           outfile=outfile,
-           tablename=tablename,
-           options="--add-index=track")
-
-    os.unlink(outf.name)
+    intervals = [(x, x + ".intervals") for x in infiles
+                 if os.path.exists(x + ".intervals")]
+    if intervals:
+        _load(intervals, tablename + "_intervals")
 
 
 def loadCountReads(infiles, outfile,
@@ -3,10 +3,13 @@ import CGAT.IOTools as IOTools
 import sqlite3
 import os
 import copy
+import multiprocessing
+import collections.abc
 import rpy2.robjects as robjects
 import rpy2.interactive as r
 import rpy2.interactive.packages
 import scipy.stats as stats
+import scipy.sparse as sparse
 from CGATPipelines.Pipeline import cluster_runnable
 import CGAT.Experiment as E
 import ast as ast
@@ -132,25 +135,197 @@ def getAllAncestorsDescendants(term, ontologyDict):
     ontologyDict should be a dictionary where keys are terms and values
     are sets of all the immediate children (for descendents) or parents
     (for ancestors) of those terms.
+    For queries across many terms, use an OntologyClosure instead.
     '''
-    ids = ontologyDict[term]
     allids = set()
-    done = set()
-
-    while len(ids) != 0:
-        allids = allids | ids
-        for item in allids:
-            if item in ontologyDict:
-                newids = ontologyDict[item]
-            else:
-                newids = set()
-            ids = ids | newids
-            done.add(item)
-        ids = ids - done
+    ids = list(ontologyDict[term])
+    while ids:
+        item = ids.pop()
+        if item in allids:
+            continue
+        allids.add(item)
+        ids.extend(ontologyDict.get(item, ()))
 
     return allids
 
 
+class OntologyClosure(object):
+    '''
+    Transitive closure of an ontology.
+
+    Terms are numbered in topological order so that every term comes
+    after all of its ancestors.  The ancestors of each term are stored
+    as a sparse term x term matrix in compressed row format (indptr,
+    indices), so that the ancestors of term i are
+    indices[indptr[i]:indptr[i + 1]].
+
+    The closure is stored by save() as two files next to the files
+    written by AnnotationSet.stow:
+    prefix_ontclosure.tsv - the terms in order
+    prefix_ontclosure.npy - indptr followed by indices
+
+    load() memory-maps the array so that it is only read as needed.
+    '''
+
+    def __init__(self, Terms, indptr, indices):
+        self.Terms = Terms
+        self.TermIndex = dict([(y, x) for x, y in enumerate(Terms)])
+        self.indptr = indptr
+        self.indices = indices
+        self._matrix = None
+
+    @classmethod
+    def fromOntology(cls, TermsToOnt):
+        '''
+        Builds the closure from a dictionary of terms to the set of
+        their immediate parents, such as AnnotationSet.TermsToOnt.
+        Each term is visited once in topological order and inherits
+        the ancestors of its parents.
+        '''
+        # topological sort, parents before children
+        children = dict()
+        nparents = dict()
+        for term, parents in TermsToOnt.items():
+            nparents.setdefault(term, 0)
+            for parent in parents:
+                if parent == term:
+                    continue
+                nparents.setdefault(parent, 0)
+                nparents[term] += 1
+                children.setdefault(parent, []).append(term)
+        Terms = sorted(x for x, y in nparents.items() if y == 0)
+        x = 0
+        while x < len(Terms):
+            for child in children.get(Terms[x], ()):
+                nparents[child] -= 1
+                if nparents[child] == 0:
+                    Terms.append(child)
+            x += 1
+        if len(Terms) != len(nparents):
+            raise ValueError("ontology contains cycles")
+
+        TermIndex = dict([(y, x) for x, y in enumerate(Terms)])
+        ancestors = []
+        indptr = [0]
+        for term in Terms:
+            anc = set()
+            for parent in TermsToOnt.get(term, ()):
+                if parent == term:
+                    continue
+                x = TermIndex[parent]
+                anc.add(x)
+                anc.update(ancestors[x])
+            anc = np.array(sorted(anc), dtype=np.int32)
+            ancestors.append(anc)
+            indptr.append(indptr[-1] + len(anc))
+        if ancestors:
+            indices = np.concatenate(ancestors).astype(np.int32)
+        else:
+            indices = np.zeros(0, dtype=np.int32)
+        return cls(Terms, np.array(indptr, dtype=np.int32), indices)
+
+    @classmethod
+    def load(cls, prefix):
+        '''
+        Loads a closure stored by save(), memory-mapping the array.
+        Returns None if no closure has been stored for prefix.
+        '''
+        if not os.path.exists("%s_ontclosure.npy" % prefix):
+            return None
+        with IOTools.openFile("%s_ontclosure.tsv" % prefix) as inf:
+            Terms = [line.rstrip("\n") for line in inf]
+        data = np.load("%s_ontclosure.npy" % prefix, mmap_mode="r")
+        n = len(Terms) + 1
+        return cls(Terms, data[:n], data[n:])
+
+    def save(self, prefix):
+        '''
+        Stores the closure, see load().
+        '''
+        with IOTools.openFile("%s_ontclosure.tsv" % prefix, "w") as outf:
+            for term in self.Terms:
+                outf.write("%s\n" % removeNonAscii(term))
+        np.save("%s_ontclosure.npy" % prefix,
+                np.concatenate((self.indptr, self.indices)).astype(np.int32))
+
+    def matrix(self):
+        '''
+        Returns the closure as a sparse term x term matrix with a 1 in
+        row i, column j if term j is an ancestor of term i.
+        '''
+        if self._matrix is None:
+            n = len(self.Terms)
+            self._matrix = sparse.csr_matrix(
+                (np.ones(len(self.indices), dtype=np.int32),
+                 np.asarray(self.indices), np.asarray(self.indptr)),
+                shape=(n, n))
+        return self._matrix
+
+    def ancestors(self, term):
+        '''
+        Returns the set of all ancestors of term.
+        '''
+        x = self.TermIndex[term]
+        return set(self.Terms[y]
+                   for y in self.indices[self.indptr[x]:self.indptr[x + 1]])
+
+    def descendants(self, term):
+        '''
+        Returns the set of all descendents of term.
+        '''
+        x = self.TermIndex[term]
+        return set(self.Terms[y]
+                   for y in self.matrix()[:, x].nonzero()[0])
+
+
+class CSRSetDict(collections.abc.Mapping):
+    '''
+    Read-only dictionary of sets stored in compressed row format.
+
+    Keys are the names in Keys with at least one value, the values
+    of the key in row i are the names in Values at positions
+    indices[indptr[i]:indptr[i + 1]].  Values are only turned into
+    sets when they are accessed, so that an AnnotationSet regenerated
+    from binary storage does not need to build all its dictionaries.
+    '''
+
+    def __init__(self, Keys, Values, indptr, indices):
+        self.Keys = Keys
+        self.Values = Values
+        self.indptr = indptr
+        self.indices = indices
+        self._index = None
+
+    def _getIndex(self):
+        if self._index is None:
+            rows = np.nonzero(np.diff(self.indptr))[0]
+            self._index = dict([(self.Keys[x], x) for x in rows])
+        return self._index
+
+    def __getitem__(self, key):
+        x = self._getIndex()[key]
+        return set(self.Values[y]
+                   for y in self.indices[self.indptr[x]:self.indptr[x + 1]])
+
+    def __contains__(self, key):
+        return key in self._getIndex()
+
+    def __iter__(self):
+        return iter(self._getIndex())
+
+    def __len__(self):
+        return len(self._getIndex())
+
+    def matrix(self):
+        '''
+        Returns the dictionary as a sparse Keys x Values matrix.
+        '''
+        return sparse.csr_matrix(
+            (np.ones(len(self.indices), dtype=np.int32),
+             np.asarray(self.indices), np.asarray(self.indptr)),
+            shape=(len(self.Keys), len(self.Values)))
+
+
 class AnnotationSet(object):
     '''
     Used to contain all the annotations associated with a particular
@@ -196,6 +371,7 @@ class AnnotationSet(object):
         self.TermsToOnt = dict()
         self.TermsToDetails = dict()
         self.DetailsColumns = []
+        self.Closure = None
 
     def unstow(self):
         '''
@@ -203,11 +379,20 @@ class AnnotationSet(object):
         files by stow().
         '''
         prefix = self.prefix
-        self.GenesToTerms = self.unstowSetDict("%s_genestoterms.tsv" % prefix)
-        self.TermsToGenes = self.unstowSetDict("%s_termstogenes.tsv" % prefix)
+        binary = "%s_annotations.npy" % prefix
+        if (os.path.exists(binary)
+                and os.path.getmtime(binary)
+                >= os.path.getmtime("%s_genestoterms.tsv" % prefix)):
+            self.GenesToTerms, self.TermsToGenes = self.unstowBinary(prefix)
+        else:
+            self.GenesToTerms = self.unstowSetDict(
+                "%s_genestoterms.tsv" % prefix)
+            self.TermsToGenes = self.unstowSetDict(
+                "%s_termstogenes.tsv" % prefix)
         self.TermsToOnt = self.unstowSetDict("%s_termstoont.tsv" % prefix)
         self.TermsToDetails, self.DetailsColumns = self.unstowDetails(
             "%s_termstodetails.tsv" % prefix)
+        self.Closure = OntologyClosure.load(prefix)
 
     def stow(self, outprefix):
         '''
@@ -221,9 +406,12 @@ class AnnotationSet(object):
 
         self.stowSetDict(self.GenesToTerms, outGenesToTerms, ["gene", "term"])
         self.stowSetDict(self.TermsToGenes, outTermsToGenes, ["term", "gene"])
+        self.stowBinary(outprefix)
 
         if self.TermsToOnt is not None:
             self.stowSetDict(self.TermsToOnt, outTermsToOnt, ['term', 'is_a'])
+            if self.TermsToOnt:
+                self.getClosure().save(outprefix)
         else:
             os.system("touch %s" % outTermsToOnt)
 
@@ -249,6 +437,70 @@ class AnnotationSet(object):
                                     removeNonAscii(",".join(id2))))
         out.close()
 
+    def stowBinary(self, outprefix):
+        '''
+        Stores GenesToTerms and TermsToGenes in a binary format that
+        can be memory-mapped by unstowBinary.
+        Genes and terms are interned to integers and listed, genes
+        first, in outprefix_annotations.tsv.  Both dictionaries are
+        stored in compressed row format in outprefix_annotations.npy
+        as the number of genes and terms followed by the row pointers
+        and column indices of GenesToTerms and then TermsToGenes.
+        '''
+        genes = set(self.GenesToTerms.keys())
+        terms = set(self.TermsToGenes.keys())
+        for gene in self.GenesToTerms:
+            terms.update(self.GenesToTerms[gene])
+        for term in self.TermsToGenes:
+            genes.update(self.TermsToGenes[term])
+        genes = sorted(genes)
+        terms = sorted(terms)
+        GeneIndex = dict([(y, x) for x, y in enumerate(genes)])
+        TermIndex = dict([(y, x) for x, y in enumerate(terms)])
+
+        def _toCSR(adict, keys, index):
+            indptr, indices = [0], []
+            for key in keys:
+                values = sorted(index[x] for x in adict.get(key, ()))
+                indices.extend(values)
+                indptr.append(len(indices))
+            return indptr, indices
+
+        g2t = _toCSR(self.GenesToTerms, genes, TermIndex)
+        t2g = _toCSR(self.TermsToGenes, terms, GeneIndex)
+
+        with IOTools.openFile("%s_annotations.tsv" % outprefix, "w") as outf:
+            for name in genes + terms:
+                outf.write("%s\n" % removeNonAscii(name))
+        np.save("%s_annotations.npy" % outprefix,
+                np.array([len(genes), len(terms)]
+                         + g2t[0] + g2t[1] + t2g[0] + t2g[1],
+                         dtype=np.int32))
+
+    def unstowBinary(self, prefix):
+        '''
+        Regenerates GenesToTerms and TermsToGenes stored by stowBinary
+        as CSRSetDict objects backed by a memory-mapped array.
+        '''
+        with IOTools.openFile("%s_annotations.tsv" % prefix) as inf:
+            names = [line.rstrip("\n") for line in inf]
+        data = np.load("%s_annotations.npy" % prefix, mmap_mode="r")
+        ngenes, nterms = int(data[0]), int(data[1])
+        genes = names[:ngenes]
+        terms = names[ngenes:ngenes + nterms]
+
+        start = 2
+        g2t_indptr = data[start:start + ngenes + 1]
+        start += ngenes + 1
+        g2t_indices = data[start:start + int(g2t_indptr[-1])]
+        start += int(g2t_indptr[-1])
+        t2g_indptr = data[start:start + nterms + 1]
+        start += nterms + 1
+        t2g_indices = data[start:start + int(t2g_indptr[-1])]
+
+        return (CSRSetDict(genes, terms, g2t_indptr, g2t_indices),
+                CSRSetDict(terms, genes, t2g_indptr, t2g_indices))
+
     def stowDetails(self, adict, outfile, cnames):
         '''
         Stores the TermsToDetails dictionary in a flat file
@@ -333,6 +585,14 @@ class AnnotationSet(object):
         self.GenesToTerms = g2t
         self.TermsToGenes = self.reverseDict(self.GenesToTerms)
 
+    def compile(self, dbname=None, idtype="ensemblg"):
+        '''
+        Compiles the GenesToTerms and TermsToGenes dictionaries into an
+        AnnotationMatrix for vectorised enrichment testing, see
+        AnnotationMatrix.
+        '''
+        return AnnotationMatrix(self, dbname, idtype)
+
     def reverseDict(self, D):
         '''
         Inverts a dictionary of sets so that values are keys and
@@ -350,6 +610,15 @@ class AnnotationSet(object):
                 rD[s].add(key)
         return rD
 
+    def getClosure(self):
+        '''
+        Returns the OntologyClosure of TermsToOnt, computing it if it
+        has not been loaded by unstow.
+        '''
+        if self.Closure is None:
+            self.Closure = OntologyClosure.fromOntology(self.TermsToOnt)
+        return self.Closure
+
     def ontologise(self):
         '''
         Takes the TermsToGenes and GenesToTerms dictionaries and
@@ -358,39 +627,191 @@ class AnnotationSet(object):
         associated with the HPO term Nephropathy, it is also associated with
         all the ancestors of that term, e.g. ENSG00000144061 must also be
         associated with Abnormality of the Kidney.
-        This function deals with this by taking the TermsToGenes
-        dictionary and, for each term, taking the descendent terms,
-        looking up their associated genes and adding them to the TermsToGenes
-        set for the original term.
-
+        This function deals with this by building a sparse gene x term
+        matrix of the direct annotations and propagating it to all
+        ancestors through the transitive closure of the ontology in a
+        single matrix product.
+        Terms which are not part of the ontology are dropped.
         '''
         TermsToGenes = self.TermsToGenes
-        TermsToOntP = copy.copy(self.TermsToOnt)
-        TermsToOntC = self.reverseDict(TermsToOntP)
+        self.Closure = OntologyClosure.fromOntology(self.TermsToOnt)
+        closure = self.Closure
+
+        genes = sorted(set().union(*TermsToGenes.values())
+                       if TermsToGenes else set())
+        GeneIndex = dict([(y, x) for x, y in enumerate(genes)])
+        rows, cols = [], []
+        for term, x in closure.TermIndex.items():
+            for gene in TermsToGenes.get(term, ()):
+                rows.append(GeneIndex[gene])
+                cols.append(x)
+        direct = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+            shape=(len(genes), len(closure.Terms)))
+
+        # genes of a term are propagated to all of its ancestors
+        propagated = sparse.csc_matrix(direct + direct.dot(closure.matrix()))
 
         Adict = dict()
-        # topologically sorts the terms in the ontology so that
-        # every term is earlier in the list than all of its ancestors.
-        sortedterms = toposort_flatten(self.TermsToOnt)
-        sortedterms_p = []
-        for s in sortedterms:
-            if s in TermsToGenes:
-                sortedterms_p.append(s)
-        for term in sortedterms_p:
-            Adict[term] = set()
-            if term in TermsToOntC:
-                # return descendents
-                allids = getAllAncestorsDescendants(term, TermsToOntC)
-
-                allids.add(term)
-                for term2 in allids:
-                    if term2 in TermsToGenes:
-                        Adict[term] = Adict[term] | TermsToGenes[term2]
+        for term, x in closure.TermIndex.items():
+            if term in TermsToGenes:
+                rows = propagated.indices[
+                    propagated.indptr[x]:propagated.indptr[x + 1]]
+                Adict[term] = set(genes[y] for y in rows)
 
         self.TermsToGenes = Adict
         self.GenesToTerms = self.reverseDict(Adict)
 
 
+class AnnotationMatrix(object):
+    '''
+    Sparse gene x term incidence matrix compiled from an AnnotationSet.
+
+    Genes are the keys of GenesToTerms and terms the keys of TermsToGenes,
+    GeneIndex and TermIndex map them to rows and columns of Matrix.
+
+    If idtype is not ensemblg, the ensemblg2idtype$geneid table is read
+    from dbname once and stored as a sparse gene x id matrix
+    (Translation) so that gene sets can be collapsed back to the
+    original id type without going back to the database.
+    '''
+
+    def __init__(self, AS, dbname=None, idtype="ensemblg"):
+        if (isinstance(AS.TermsToGenes, CSRSetDict)
+                and AS.TermsToGenes.Values is AS.GenesToTerms.Keys):
+            # annotations from binary storage are already interned
+            self.Genes = AS.TermsToGenes.Values
+            self.GeneIndex = dict([(y, x) for x, y in enumerate(self.Genes)])
+            self.Terms = AS.TermsToGenes.Keys
+            self.TermIndex = dict([(y, x) for x, y in enumerate(self.Terms)])
+            self.Matrix = sparse.csc_matrix(AS.TermsToGenes.matrix().T)
+        else:
+            genes = set(AS.GenesToTerms.keys())
+            for term in AS.TermsToGenes:
+                genes.update(AS.TermsToGenes[term])
+            self.Genes = sorted(genes)
+            self.GeneIndex = dict([(y, x)
+                                   for x, y in enumerate(self.Genes)])
+            self.Terms = sorted(AS.TermsToGenes.keys())
+            self.TermIndex = dict([(y, x)
+                                   for x, y in enumerate(self.Terms)])
+
+            rows, cols = [], []
+            for term, col in self.TermIndex.items():
+                for gene in AS.TermsToGenes[term]:
+                    rows.append(self.GeneIndex[gene])
+                    cols.append(col)
+            self.Matrix = sparse.csc_matrix(
+                (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                shape=(len(self.Genes), len(self.Terms)))
+
+        # genes in GenesToTerms, the universe for genes not
+        # associated with a term
+        self.AllGenes = self.toVector(AS.GenesToTerms.keys())
+
+        self.Translation = None
+        self.IDs = None
+        if idtype != "ensemblg":
+            db = sqlite3.connect(dbname)
+            tab = pd.read_sql_query(
+                "SELECT * FROM ensemblg2%s$geneid" % idtype, db)
+            db.close()
+            id = list(tab.columns)
+            id.remove('ensemblg')
+            id = id[0]
+            tab = tab[tab['ensemblg'].isin(self.GeneIndex)]
+            self.IDs = sorted(set(tab[id]))
+            IDIndex = dict([(y, x) for x, y in enumerate(self.IDs)])
+            pairs = set(zip(tab['ensemblg'].map(self.GeneIndex),
+                            tab[id].map(IDIndex)))
+            rows = [x[0] for x in pairs]
+            cols = [x[1] for x in pairs]
+            self.Translation = sparse.csr_matrix(
+                (np.ones(len(pairs), dtype=np.int32), (rows, cols)),
+                shape=(len(self.Genes), len(self.IDs)))
+
+    def toVector(self, genes):
+        '''
+        Returns an indicator vector over the genes in the matrix for
+        a set of genes.  Genes not in the matrix are ignored.
+        '''
+        v = np.zeros(len(self.Genes), dtype=np.int32)
+        v[[self.GeneIndex[g] for g in genes if g in self.GeneIndex]] = 1
+        return v
+
+    def toIDVector(self, genes, original=None):
+        '''
+        Collapses a set of genes to an indicator vector over the original
+        ids, restricted to the ids in original if given.
+        '''
+        v = (self.Translation.T.dot(self.toVector(genes)) > 0)
+        if original is not None:
+            v &= np.array([x in original for x in self.IDs], dtype=bool)
+        return v.astype(np.int32)
+
+    def countTables(self, With, Full, foreground, background):
+        '''
+        Computes the 2x2 contingency counts for a set of tests in one
+        batch.
+
+        With and Full are gene x test matrices.  With marks the genes
+        associated with the term in each test, the genes not associated
+        with the term are all genes not in Full.  foreground and
+        background are indicator vectors as returned by toVector or,
+        if the matrix translates ids, toIDVector.
+
+        Returns arrays A, B, C and D with the number of genes in the
+        foreground associated (A) and not associated (B) with the term
+        and the same for the background (C, D).
+        '''
+        nfg = foreground.sum()
+        nbg = background.sum()
+        if self.Translation is None:
+            A = With.T.dot(foreground)
+            C = With.T.dot(background)
+            B = nfg - Full.T.dot(foreground)
+            D = nbg - Full.T.dot(background)
+        else:
+            # an id is associated with a term if any of its genes is,
+            # it is not associated if any of its genes is not in Full
+            degree = self.Translation.T.dot(self.AllGenes)
+            W = self.termItems(With)
+            A = W.dot(foreground)
+            C = W.dot(background)
+            Full = sparse.csc_matrix(Full.multiply(self.AllGenes[:, None]))
+            F = sparse.csr_matrix(Full.T.dot(self.Translation))
+            F.data = (F.data == degree[F.indices]).astype(np.int32)
+            B = nfg - F.dot(foreground)
+            D = nbg - F.dot(background)
+        return (np.asarray(A).ravel(), np.asarray(B).ravel(),
+                np.asarray(C).ravel(), np.asarray(D).ravel())
+
+    def termItems(self, With):
+        '''
+        Returns a sparse test x item matrix marking the items associated
+        with the term in each test of the gene x test matrix With.
+        Items are genes or, if the matrix translates ids, original ids,
+        matching the indicator vectors passed to countTables.
+        '''
+        if self.Translation is None:
+            return sparse.csr_matrix(With.T)
+        W = sparse.csr_matrix(With.T.dot(self.Translation))
+        W.data = (W.data > 0).astype(np.int32)
+        return W
+
+    def getGenes(self, With, col, genes):
+        '''
+        Returns the genes in column col of the gene x test matrix With
+        which are in genes, collapsed to the original ids if the matrix
+        translates ids.
+        '''
+        rows = With[:, col].nonzero()[0]
+        if self.Translation is None:
+            return set(self.Genes[x] for x in rows) & genes
+        ids = self.Translation[rows].nonzero()[1]
+        return set(self.IDs[x] for x in ids) & genes
+
+
 class AnnotationParser(object):
     '''
     Base class for parsing an existing set of annotations into an
@@ -716,7 +1137,7 @@ class EnrichmentTester(object):
 
     def __init__(self, foreground, background, AS, runtype,
                  testtype, correction, thresh, outfile, outfile2,
-                 idtype, dbname):
+                 idtype, dbname, nperm=1000, seed=1, threads=1):
         allgenes = set(AS.GenesToTerms.keys())
 
         #  read the list of background genes, remove genes not in the
@@ -760,6 +1181,63 @@ class EnrichmentTester(object):
         self.outfile2 = outfile2
         self.idtype = idtype
         self.dbname = dbname
+        # options for permutation tests
+        self.nperm = nperm
+        self.seed = seed
+        self.threads = threads
+
+        # compile the AnnotationSet into a sparse matrix and the gene
+        # lists into indicator vectors, collapsed back to the original
+        # id type if necessary as different types of ID do not have a
+        # 1:1 relationship
+        self.AM = AS.compile(dbname, idtype)
+        if self.AM.Translation is None:
+            self.fgvector = self.AM.toVector(self.foreground)
+            self.bgvector = self.AM.toVector(self.background)
+            self.fggenes = self.foreground
+            self.bggenes = self.background
+        else:
+            self.fgvector = self.AM.toIDVector(self.foreground, self.ofg)
+            self.bgvector = self.AM.toIDVector(self.background, self.obg)
+            self.fggenes = set(x for x, y in zip(self.AM.IDs, self.fgvector)
+                               if y)
+            self.bggenes = set(x for x, y in zip(self.AM.IDs, self.bgvector)
+                               if y)
+
+    def test(self, terms, With, Full):
+        '''
+        Runs the statistical test for a batch of terms.  With and Full
+        are gene x term matrices as described in
+        AnnotationMatrix.countTables, column i corresponding to terms[i].
+
+        Returns a dictionary with the result for each term as a tuple
+        of odds ratio, p value, adjusted p value, significance,
+        contingency table and the (With, column) pair the genes
+        of the term can be retrieved from.
+        '''
+        results = dict()
+        if len(terms) == 0:
+            return results
+        A, B, C, D = self.AM.countTables(With, Full,
+                                         self.fgvector, self.bgvector)
+        if self.testtype == "Fisher":
+            ST = FisherExactTest(self.correction, self.thresh,
+                                 len(self.terms))
+            OR, p, padj, significant = ST.run(A, B, C, D)
+        elif self.testtype == "Permutation":
+            ST = PermutationTest(self.correction, self.thresh,
+                                 len(self.terms), self.nperm, self.seed,
+                                 self.threads)
+            OR, p, padj, significant = ST.run(A, B, C, D,
+                                              self.AM.termItems(With),
+                                              self.fgvector, self.bgvector)
+        else:
+            raise ValueError("unknown test type %s" % self.testtype)
+        for x, term in enumerate(terms):
+            fishlist = ((int(A[x]), int(B[x])), (int(C[x]), int(D[x])))
+            results[term] = (OR[x], p[x], padj[x], significant[x],
+                             fishlist, (With, x))
+        return results
 
     def writeStats(self, resultsdict, outfile, outfile2, writegenes,
                    host, ngenes):
@@ -773,7 +1251,6 @@ class EnrichmentTester(object):
         '''
         parsedresults = []
         i = 0
-        tdict_bg = dict()
         tdict_fg = dict()
         for term in resultsdict:
             res = resultsdict[term]
@@ -804,8 +1281,7 @@ class EnrichmentTester(object):
             # add metadata
             L += self.AS.TermsToDetails[term]
             parsedresults.append(L)
-            tdict_fg[str(term)] = res[-2]
-            tdict_bg[str(term)] = res[-1]
+            tdict_fg[str(term)] = res[-1]
             i += 1
 
         cols = ['term_id', 'fg_genes_mapped_to_term',
@@ -833,8 +1309,9 @@ class EnrichmentTester(object):
                     bg = outfile.replace(".tsv", "_bg_genes_%s.tsv"
                                          % (term.replace(":", "_")))
                     bgo = IOTools.openFile(bg, "w")
-                    fggenes = tdict_fg[term]
-                    bggenes = tdict_bg[term]
+                    With, col = tdict_fg[term]
+                    fggenes = self.AM.getGenes(With, col, self.fggenes)
+                    bggenes = self.AM.getGenes(With, col, self.bggenes)
 
                     for gene in fggenes:
                         fgo.write("%s\n" % gene)
@@ -852,32 +1329,19 @@ class TermByTermET(EnrichmentTester):
 
     def __init__(self, foreground, background, AS, runtype,
                  testtype, correction, thresh, outfile, outfile2, idtype,
-                 dbname):
+                 dbname, nperm=1000, seed=1, threads=1):
 
         EnrichmentTester.__init__(self, foreground, background, AS, runtype,
                                   testtype, correction, thresh, outfile,
-                                  outfile2, idtype, dbname)
+                                  outfile2, idtype, dbname, nperm, seed,
+                                  threads)
 
     def run(self, writegenes, host, ngenes):
-        results = dict()
-        for term in self.terms:
-            GenesWith = self.AS.TermsToGenes[term]
-            GenesWithout = set(self.AS.GenesToTerms.keys()) - GenesWith
-
-            if self.testtype == "Fisher":
-                ST = FisherExactTest(term,
-                                     self.foreground,
-                                     self.background,
-                                     GenesWith,
-                                     GenesWithout,
-                                     self.correction,
-                                     self.thresh,
-                                     len(self.terms), self.idtype,
-                                     self.dbname,
-                                     self.ofg,
-                                     self.obg)
-                res = ST.run()
-                results[term] = res
+        # all terms are tested in one batch
+        terms = sorted(self.terms)
+        cols = [self.AM.TermIndex[term] for term in terms]
+        With = self.AM.Matrix[:, cols]
+        results = self.test(terms, With, With)
         self.writeStats(results, self.outfile, self.outfile2,
                         writegenes, host, ngenes)
 
@@ -894,10 +1358,12 @@ class EliminateET(EnrichmentTester):
     '''
 
     def __init__(self, foreground, background, AS, runtype, testtype,
-                 correction, thresh, outfile, outfile2, idtype, dbname):
+                 correction, thresh, outfile, outfile2, idtype, dbname,
+                 nperm=1000, seed=1, threads=1):
         EnrichmentTester.__init__(self, foreground, background, AS, runtype,
                                   testtype, correction, thresh, outfile,
-                                  outfile2, idtype, dbname)
+                                  outfile2, idtype, dbname, nperm, seed,
+                                  threads)
 
     def run(self, writegenes, host, ngenes):
         TermsToOntP = copy.copy(self.AS.TermsToOnt)
@@ -951,143 +1417,484 @@ class EliminateET(EnrichmentTester):
 
         # find the highest level in the ontology
         maxLevel = max(bylevel.keys())
-        markedGenes = dict()
-        allgenes = set(self.AS.GenesToTerms.keys())
-        for term in self.terms:
-            markedGenes[term] = set()
+        AM = self.AM
+        closure = self.AS.getClosure()
+        # "marked" genes for each term as a gene x term matrix
+        marked = sparse.csc_matrix(AM.Matrix.shape, dtype=np.int32)
+        nall = AM.AllGenes.sum()
 
         # iterate through the levels starting at the highest level - the
-        # bottom of the tree
+        # bottom of the tree.  Terms at the same level do not affect each
+        # other, so each level is tested in one batch
         for j in range(1, maxLevel)[::-1]:
-            for term in bylevel[j]:
-                genes = self.AS.TermsToGenes[term]
-
-                # remove "marked genes" from the list of genes associated
-                # with the term - these are genes which have already been
-                # associated with a descendent of the term
-                GenesWith = genes - markedGenes[term]
-                GenesWithout = allgenes - genes
-                if len(GenesWith) != 0 and len(GenesWithout) != 0:
-                    if self.testtype == "Fisher":
-                        ST = FisherExactTest(term, self.foreground,
-                                             self.background,
-                                             GenesWith,
-                                             GenesWithout,
-                                             self.correction,
-                                             self.thresh,
-                                             len(self.terms), self.idtype,
-                                             self.dbname, self.ofg, self.obg)
-                        R = ST.run()
-                        results[term] = R
-
-                    if R[3] is True:
-                        # "mark" the genes mapped to this term so
-                        # they are not also mapped to ancestors of the term
-                        ancs = getAllAncestorsDescendants(term, TermsToOntP)
-                        for anc in ancs:
-                            if anc in self.terms:
-                                markedGenes[anc] = markedGenes[anc] | GenesWith
+            terms = sorted(bylevel.get(j, []))
+            if len(terms) == 0:
+                continue
+            cols = [AM.TermIndex[term] for term in terms]
+            genes = AM.Matrix[:, cols]
+
+            # remove "marked genes" from the list of genes associated
+            # with the term - these are genes which have already been
+            # associated with a descendent of the term
+            With = genes - genes.multiply(marked[:, cols])
+            With = sparse.csc_matrix(With)
+            With.eliminate_zeros()
+            nwith = np.asarray(With.sum(axis=0)).ravel()
+            nwithout = nall - np.asarray(
+                genes.T.dot(AM.AllGenes)).ravel()
+            tested = np.where((nwith != 0) & (nwithout != 0))[0]
+            if len(tested) == 0:
+                continue
+            With = With[:, tested]
+            level = self.test([terms[x] for x in tested],
+                              With, genes[:, tested])
+            results.update(level)
+
+            # "mark" the genes mapped to significant terms so
+            # they are not also mapped to ancestors of the term
+            rows, cols = [], []
+            for x, y in enumerate(tested):
+                if level[terms[y]][3] is not True:
+                    continue
+                ancs = closure.ancestors(terms[y])
+                for anc in ancs:
+                    if anc in self.terms:
+                        rows.append(x)
+                        cols.append(AM.TermIndex[anc])
+            if rows:
+                ancestors = sparse.csr_matrix(
+                    (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                    shape=(len(tested), len(AM.Terms)))
+                marked = marked + With.dot(ancestors)
+                marked.data = (marked.data > 0).astype(np.int32)
+
         self.writeStats(results, self.outfile, self.outfile2,
                         writegenes, host, ngenes)
 
 
-class StatsTest(object):
+class PrerankedGSEA(EnrichmentTester):
     '''
-    Container for StatsTest objects corresponding to different types
-    of statistical test for enrichment.
-    '''
-
-    def __init__(self, term, foreground, background, GenesWith, GenesWithout,
-                 correction, thresh, ntests, idtype, dbname, ofg, obg):
-        self.term = term
-        self.foreground = foreground
-        self.background = background
-        # Genes which are associated with the term
-        self.GenesWith = GenesWith
-        # Genes which are not associated with the term
-        self.GenesWithout = GenesWithout
+    Preranked gene set enrichment analysis, as described in
+    http://www.pnas.org/content/102/43/15545.full, of a ranked list of
+    genes against all terms in an AnnotationSet.
+
+    The ranked list is a tab delimited file with a header line, gene ids
+    in the first column and the ranking metric in the second, as written
+    by PipelineEnrichmentGSEA.preprocess_ExpressionData.  Terms with fewer
+    than min_size or more than max_size genes in the ranked list are
+    not tested.
+
+    Significance is assessed by gene set permutation - the enrichment
+    score of each term is compared to those of nperm random sets of the
+    same size.  The random sets are generated once for all terms, in
+    batches spread over threads processes with seeds spawned from seed
+    as for PermutationTest.  The normalised enrichment score is the enrichment
+    score divided by the mean of the random scores with the same sign,
+    p values are computed from the random scores with the same sign and
+    corrected for multiple testing as for the other tests.
+    '''
+
+    def __init__(self, rankedlist, AS, correction, thresh, outfile,
+                 outfile2, idtype, dbname, nperm=1000, seed=1, threads=1,
+                 min_size=15, max_size=500, weight=1):
+        self.AS = AS
+        self.runtype = "gsea"
+        self.testtype = "Permutation"
         self.correction = correction
         self.thresh = thresh
-        self.ntests = ntests
+        self.outfile = outfile
+        self.outfile2 = outfile2
         self.idtype = idtype
         self.dbname = dbname
-        self.ofg = ofg
-        self.obg = obg
-        self.collapse()
-
-    def collapse(self):
-        # collapses the lists of genes back to the original id type
-        # as different types of ID do not have a 1:1 relationship
-        # avoids this if idtype already ensemblg
-        if self.idtype != "ensemblg":
-            db = sqlite3.connect(self.dbname)
-            tab = pd.read_sql_query(
-                "SELECT * FROM ensemblg2%s$geneid" % self.idtype, db)
-            id = list(tab.columns)
-            id.remove('ensemblg')
-            id = id[0]
-            self.GenesWith = set(tab[id][tab['ensemblg'].isin(self.GenesWith)])
-            self.GenesWithout = set(
-                tab[id][tab['ensemblg'].isin(self.GenesWithout)])
-            self.foreground = set(
-                tab[id][tab['ensemblg'].isin(self.foreground)])
-            self.background = set(
-                tab[id][tab['ensemblg'].isin(self.background)])
+        self.nperm = nperm
+        self.seed = seed
+        self.threads = threads
+        self.min_size = min_size
+        self.max_size = max_size
+        self.nbatch = 100
+
+        # read the ranked list, highest first, keeping the first
+        # occurrence of duplicate ids
+        tab = pd.read_csv(rankedlist, sep="\t", usecols=[0, 1],
+                          dtype={0: str})
+        tab.columns = ['id', 'score']
+        tab = tab.dropna()
+        tab = tab.sort_values('score', ascending=False, kind="mergesort")
+        tab = tab.drop_duplicates('id')
+        self.ranked = list(tab['id'])
+        self.weights = np.abs(np.asarray(tab['score'], dtype=float)) ** weight
+
+        # map the terms to positions in the ranked list, genes
+        # missing from the list are ignored
+        self.AM = AS.compile(dbname, idtype)
+        items = self.AM.Genes if self.AM.Translation is None else self.AM.IDs
+        positions = dict([(y, x) for x, y in enumerate(self.ranked)])
+        itempos = np.array([positions.get(x, -1) for x in items],
+                           dtype=np.int64)
+        W = self.AM.termItems(self.AM.Matrix).tocoo()
+        keep = itempos[W.col] >= 0
+        self.Hits = sparse.csr_matrix(
+            (np.ones(keep.sum(), dtype=np.int32),
+             (W.row[keep], itempos[W.col[keep]])),
+            shape=(len(self.AM.Terms), len(self.ranked)))
+        self.Hits.sort_indices()
 
-            self.foreground = self.foreground & self.ofg
-            if self.obg is not None:
-                self.background = self.background & self.obg
+    def run(self, writegenes, host, ngenes):
+        sizes = np.diff(self.Hits.indptr)
+        tested = np.where((sizes >= max(self.min_size, 1))
+                          & (sizes <= self.max_size))[0]
+        results = dict()
+        if len(tested) > 0:
+            H = self.Hits[tested]
+            ES = _enrichmentScores(H.indices, sizes[tested],
+                                   self.weights)[0]
+            nsizes = np.unique(sizes[tested])
+            seeds = np.random.SeedSequence(self.seed).spawn(
+                (self.nperm + self.nbatch - 1) // self.nbatch)
+            tasks = [(seq, min(self.nbatch, self.nperm - x * self.nbatch))
+                     for x, seq in enumerate(seeds)]
+            batches = _runBatches(_gseaNull, tasks, self.threads,
+                                  (self.weights, nsizes))
+            nulls = dict([(y, np.concatenate([b[x] for b in batches]))
+                          for x, y in enumerate(nsizes)])
+
+            NES = np.empty(len(tested))
+            p = np.empty(len(tested))
+            for x, y in enumerate(tested):
+                null = nulls[sizes[y]]
+                if ES[x] >= 0:
+                    same = null[null >= 0]
+                    nexceed = np.sum(same >= ES[x])
+                else:
+                    same = null[null < 0]
+                    nexceed = np.sum(same <= ES[x])
+                if len(same) == 0 or np.mean(same) == 0:
+                    NES[x] = np.nan
+                else:
+                    NES[x] = ES[x] / abs(np.mean(same))
+                p[x] = (1.0 + nexceed) / (1.0 + len(same))
+
+            ST = StatsTest(self.correction, self.thresh, len(tested))
+            padj = ST.correct(p)
+            significant = ST.sig(padj)
+            for x, y in enumerate(tested):
+                results[self.AM.Terms[y]] = (int(sizes[y]), ES[x], NES[x],
+                                             p[x], padj[x], significant[x])
+        self.writeStats(results, self.outfile, self.outfile2,
+                        writegenes, host, ngenes)
 
-    def correct(self, pvalue):
+    def leadingEdge(self, term):
+        '''
+        Returns the genes annotated to term which appear in the ranked
+        list before the peak of the running sum if the enrichment score
+        is positive, or after it if it is negative.
+        '''
+        hits = self.Hits[self.AM.TermIndex[term]].indices
+        ES, top, bottom = _enrichmentScores(hits, [len(hits)], self.weights)
+        if ES[0] >= 0:
+            hits = hits[:np.argmax(top) + 1]
+        else:
+            hits = hits[np.argmin(bottom):]
+        return [self.ranked[x] for x in hits]
+
+    def writeStats(self, resultsdict, outfile, outfile2, writegenes,
+                   host, ngenes):
         '''
-        Correction for multiple testing
+        Writes the enrichment scores to an output table, with the
+        detail from the TermsToDetails table appended to each row.
+        outfile2 has the same information for significant terms only.
+        If writegenes is 1, the leading edge genes of the first ngenes
+        significant terms are written to tsv files.
         '''
+        parsedresults = []
+        for term in resultsdict:
+            size, ES, NES, p, padj, sig = resultsdict[term]
+            sig = "*" if sig is True else "-"
+            L = [term, str(size), str(round(ES, 4)), str(round(NES, 4)),
+                 str(round(p, 4)), str(round(padj, 4)), sig]
+            L += self.AS.TermsToDetails[term]
+            parsedresults.append(L)
+
+        cols = ['term_id', 'genes_mapped_to_term', 'es', 'nes', 'pvalue',
+                'padj', 'significant'] + self.AS.DetailsColumns[1:]
+        df = pd.DataFrame(parsedresults, columns=cols)
+        df['order'] = df['nes'].astype(float)
+        df = df.sort_values('order', ascending=False).drop('order', axis=1)
+        df.to_csv(outfile, sep="\t", index=False)
+
+        df2 = df[df['significant'] == "*"]
+        df2.to_csv(outfile2, sep="\t", index=False)
+
+        if writegenes == 1:
+            for term in df2['term_id'][0: ngenes]:
+                out = outfile.replace(".tsv", "_leading_edge_%s.tsv"
+                                      % (term.replace(":", "_")))
+                writeList(self.leadingEdge(term), out)
+
+
+class StatsTest(object):
+    '''
+    Container for StatsTest objects corresponding to different types
+    of statistical test for enrichment.  Tests are run on arrays of
+    contingency counts so that all terms are tested in one batch.
+    '''
+
+    def __init__(self, correction, thresh, ntests):
+        self.correction = correction
+        self.thresh = thresh
+        self.ntests = ntests
+
+    def correct(self, pvalues):
+        '''
+        Correction for multiple testing - bon (Bonferroni), bh
+        (Benjamini-Hochberg) or by (Benjamini-Yekutieli) false
+        discovery rate.  pvalues may be a subset of the ntests tests,
+        in which case the false discovery rate is computed assuming
+        the untested p values are larger.
+        '''
+        pvalues = np.asarray(pvalues, dtype=float)
         # Bonferroni correction
         if self.correction == "bon":
-            return pvalue * self.ntests
-
-    def sig(self, pvalue):
+            return np.minimum(pvalues * self.ntests, 1.0)
+        if self.correction in ("bh", "by"):
+            ntests = max(self.ntests, len(pvalues))
+            factor = float(ntests)
+            if self.correction == "by":
+                factor *= np.sum(1.0 / np.arange(1, ntests + 1))
+            # step-up - the adjusted p value of the ith smallest p value
+            # is the minimum of p * factor / rank over all larger p values
+            order = np.argsort(pvalues)[::-1]
+            ranks = np.arange(len(pvalues), 0, -1)
+            padj = np.minimum.accumulate(pvalues[order] * factor / ranks)
+            result = np.empty(len(pvalues))
+            result[order] = np.minimum(padj, 1.0)
+            return result
+        raise ValueError("unknown correction %s" % self.correction)
+
+    def sig(self, pvalues):
         '''
         Test for significance
         '''
-        if pvalue <= self.thresh:
-            return True
+        return [True if p <= self.thresh else None for p in pvalues]
+
+    def oddsRatio(self, A, B, C, D):
+        '''
+        Odds ratios for arrays of 2x2 contingency counts, nan if
+        any of the margins is empty.
+        '''
+        with np.errstate(divide="ignore", invalid="ignore"):
+            OR = np.where((B > 0) & (C > 0),
+                          (A * D).astype(float) / (B * C), np.inf)
+        degenerate = ((A + B == 0) | (C + D == 0)
+                      | (A + C == 0) | (B + D == 0))
+        OR[degenerate] = np.nan
+        return OR
 
 
 class FisherExactTest(StatsTest):
     '''
-    Runs a Fisher Exact Test (as implemented in scipy.stats)
-    on a term.
+    Runs a two-sided Fisher Exact Test on a batch of terms, giving
+    the same results as scipy.stats.fisher_exact on each term.
     Uses a 2x2 contingency table with counts of:
     A - Genes in foreground annotated to term
     B - Genes in foreground not annotated to term
     C - Genes in background annotated to term
     D - Genes in background not annotated to term
 
+    The hypergeometric distribution is computed once for each distinct
+    set of table margins.
     '''
 
-    def __init___(self, term, foreground, background, GenesWith, GenesWithout,
-                  correction, thresh, ntests, idtype, dbname):
-        StatsTest.__init__(self, term, foreground, background, GenesWith,
-                           GenesWithout, correction, thresh, ntests, idtype,
-                           dbname)
+    def run(self, A, B, C, D):
+        A, B, C, D = [np.asarray(x, dtype=np.int64) for x in (A, B, C, D)]
+        total = A + B + C + D
+        row = A + B
+        col = A + C
+
+        OR = self.oddsRatio(A, B, C, D)
+        p = np.ones(len(A))
+
+        todo = np.where(~np.isnan(OR))[0]
+        if len(todo) > 0:
+            margins, inverse = np.unique(
+                np.column_stack((total[todo], row[todo], col[todo])),
+                axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            order = np.argsort(inverse, kind="stable")
+            bounds = np.searchsorted(inverse[order],
+                                     np.arange(len(margins) + 1))
+            for x, (M, n, N) in enumerate(margins):
+                idx = todo[order[bounds[x]:bounds[x + 1]]]
+                lo = max(0, n + N - M)
+                pmf = stats.hypergeom.pmf(np.arange(lo, min(n, N) + 1),
+                                          M, n, N)
+                observed = pmf[A[idx] - lo]
+                spmf = np.sort(pmf)
+                cumulative = np.cumsum(spmf)
+                pos = np.searchsorted(spmf, observed * (1 + 1e-7),
+                                      side="right")
+                p[idx] = np.minimum(cumulative[pos - 1], 1.0)
 
-    def run(self):
-        A = self.GenesWith & self.foreground
-        B = self.GenesWithout & self.foreground
-        C = self.GenesWith & self.background
-        D = self.GenesWithout & self.background
+        padj = self.correct(p)
+        significant = self.sig(padj)
+        return OR, p, padj, significant
 
-        fishlist = ((len(A), len(B)), (len(C), len(D)))
 
-        FT = stats.fisher_exact(fishlist)
-        OR, p = FT
+class PermutationTest(StatsTest):
+    '''
+    Competitive permutation test - the number of foreground genes
+    annotated to each term is compared with the numbers for nperm
+    random foregrounds of the same size drawn from the background.
+
+    The random foregrounds are generated in batches of nbatch, each
+    batch counted for all terms with a single sparse matrix product,
+    and the batches are spread over threads processes.  Every batch
+    has its own seed spawned from seed, so results do not depend on
+    the number of processes.
+
+    The p value is (1 + the number of random foregrounds with at least
+    as many genes annotated to the term) / (1 + nperm).
+    '''
+
+    def __init__(self, correction, thresh, ntests, nperm=1000, seed=1,
+                 threads=1, nbatch=100):
+        StatsTest.__init__(self, correction, thresh, ntests)
+        self.nperm = nperm
+        self.seed = seed
+        self.threads = threads
+        self.nbatch = nbatch
+
+    def run(self, A, B, C, D, W, foreground, background):
+        '''
+        A, B, C and D are the contingency counts as for FisherExactTest,
+        W the test x item matrix returned by AnnotationMatrix.termItems
+        and foreground and background the indicator vectors the counts
+        were computed from.
+        '''
+        A, B, C, D = [np.asarray(x, dtype=np.int64) for x in (A, B, C, D)]
+        OR = self.oddsRatio(A, B, C, D)
+        population = np.where(np.asarray(background).ravel())[0]
+        nfg = int(np.asarray(foreground).sum())
+
+        seeds = np.random.SeedSequence(self.seed).spawn(
+            (self.nperm + self.nbatch - 1) // self.nbatch)
+        tasks = [(seq, min(self.nbatch, self.nperm - x * self.nbatch))
+                 for x, seq in enumerate(seeds)]
+        counts = _runBatches(_permuteBatch, tasks, self.threads,
+                             (W, population, nfg, A))
+        exceed = np.sum(counts, axis=0) if counts else np.zeros(len(A))
+
+        p = (1.0 + exceed) / (1.0 + self.nperm)
         padj = self.correct(p)
-        if padj > 1:
-            padj = 1
         significant = self.sig(padj)
+        return OR, p, padj, significant
+
+
+# state of the worker processes for permutation tests, set by
+# _initBatches
+BATCH_STATE = None
+
 
-        return OR, p, padj, significant, fishlist, A, C
+def _initBatches(state):
+    global BATCH_STATE
+    BATCH_STATE = state
+
+
+def _runBatches(func, tasks, threads, state):
+    '''
+    Applies func to each of tasks, in a pool of threads processes
+    sharing state unless threads is 1 or the current process is
+    a daemon, which cannot have children.
+    '''
+    if multiprocessing.current_process().daemon:
+        threads = 1
+    threads = min(threads, len(tasks))
+    if threads > 1:
+        pool = multiprocessing.Pool(threads, _initBatches, (state,))
+        results = pool.map(func, tasks)
+        pool.close()
+        pool.join()
+    else:
+        _initBatches(state)
+        results = [func(task) for task in tasks]
+    _initBatches(None)
+    return results
+
+
+def _permuteBatch(task):
+    '''
+    Counts, for a batch of random foregrounds, how often the number of
+    foreground items annotated to each term is at least the observed
+    number.
+    '''
+    W, population, nfg, observed = BATCH_STATE
+    seq, n = task
+    rng = np.random.default_rng(seq)
+    if nfg < len(population):
+        keys = rng.random((n, len(population)))
+        chosen = np.argpartition(keys, nfg, axis=1)[:, :nfg]
+    else:
+        chosen = np.tile(np.arange(len(population)), (n, 1))
+    F = sparse.csc_matrix(
+        (np.ones(chosen.size, dtype=np.int32),
+         (population[chosen.ravel()], np.repeat(np.arange(n), nfg))),
+        shape=(W.shape[1], n))
+    counts = W.dot(F).toarray()
+    return (counts >= observed[:, None]).sum(axis=1)
+
+
+def _enrichmentScores(hits, sizes, weights):
+    '''
+    Computes GSEA running sum enrichment scores for a batch of sets.
+
+    hits are the positions in the ranked list of the members of each
+    set, sorted and concatenated, sizes the number of members of each
+    set (at least 1) and weights the weight of each position in the
+    ranked list.
+
+    The running sum has its maximum deviation from zero either at or
+    just before a hit, so only these positions are evaluated.
+
+    Returns the enrichment scores and, for each hit, the running sum
+    at (top) and just before (bottom) the hit.
+    '''
+    sizes = np.asarray(sizes)
+    nitems = len(weights)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    setid = np.repeat(np.arange(len(sizes)), sizes)
+    rank = np.arange(len(hits)) - starts[setid]
+    w = weights[hits]
+    cumulative = np.cumsum(w)
+    cumw = cumulative - (cumulative[starts] - w[starts])[setid]
+    total = cumw[starts + sizes - 1]
+    total[total == 0] = 1.0
+    misses = ((hits - rank)
+              / np.maximum(nitems - sizes, 1).astype(float)[setid])
+    top = cumw / total[setid] - misses
+    bottom = (cumw - w) / total[setid] - misses
+    highest = np.maximum.reduceat(top, starts)
+    lowest = np.minimum.reduceat(bottom, starts)
+    ES = np.where(highest >= -lowest, highest, lowest)
+    return ES, top, bottom
+
+
+def _gseaNull(task):
+    '''
+    Enrichment scores of a batch of random sets of each size for
+    PrerankedGSEA.  The random sets of all sizes are the first
+    positions of the same random permutations of the ranked list.
+    '''
+    weights, sizes = BATCH_STATE
+    seq, n = task
+    rng = np.random.default_rng(seq)
+    permutations = rng.permuted(
+        np.tile(np.arange(len(weights)), (n, 1)), axis=1)
+    scores = []
+    for size in sizes:
+        hits = np.sort(permutations[:, :size], axis=1)
+        scores.append(_enrichmentScores(hits.ravel(), np.repeat(size, n),
+                                        weights)[0])
+    return scores
 
 # functions below here correspond to specific steps in the
 # pipeline_enrichment pipeline - they are written as functions
@@ -1204,7 +2011,8 @@ def HPABackground(tissue, level, supportive, outfile):
 @cluster_runnable
 def foregroundsVsBackgrounds(infiles, outfile, outfile2,
                              testtype, runtype, correction, thresh, dbname,
-                             writegenes, host, ngenes, idtype):
+                             writegenes, host, ngenes, idtype,
+                             nperm=1000, seed=1, threads=1):
     '''
     Runs the appropriate EnrichmentTester method according to
     the parameters specified in the pipeline.ini.
@@ -1226,9 +2034,29 @@ def foregroundsVsBackgrounds(infiles, outfile, outfile2,
     if runtype == "termbyterm":
         ET = TermByTermET(foreground, background, AS,
                           runtype, testtype, correction, thresh,
-                          outfile, outfile2, idtype, dbname)
+                          outfile, outfile2, idtype, dbname,
+                          nperm, seed, threads)
     elif runtype == "elim":
         ET = EliminateET(foreground, background, AS,
                          runtype, testtype, correction, thresh,
-                         outfile, outfile2, idtype, dbname)
+                         outfile, outfile2, idtype, dbname,
+                         nperm, seed, threads)
     ET.run(writegenes, host, ngenes)
+
+
+@cluster_runnable
+def rankedListVsAnnotations(infiles, outfile, outfile2, correction,
+                            thresh, dbname, writegenes, ngenes, idtype,
+                            nperm=1000, seed=1, threads=1, min_size=15,
+                            max_size=500, weight=1):
+    '''
+    Runs a preranked gene set enrichment analysis of a ranked list
+    of genes (infiles[0]) against an AnnotationSet (infiles[1]).
+    '''
+    annots = infiles[-1].replace("_genestoterms.tsv", "")
+    AS = AnnotationSet(annots)
+    AS.unstow()
+    ET = PrerankedGSEA(infiles[0], AS, correction, thresh,
+                       outfile, outfile2, idtype, dbname,
+                       nperm, seed, threads, min_size, max_size, weight)
+    ET.run(writegenes, None, ngenes)
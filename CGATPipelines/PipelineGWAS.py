@@ -0,0 +1,478 @@
+'''
+PipelineGWAS.py - utility functions for pipeline_gwas
+=====================================================
+
+Functions in this module operate on the output of plink and
+are written to keep memory usage independent of the size of the
+cohort wherever possible.
+
+'''
+
+import collections
+import os
+import zlib
+import numpy as np
+import pandas as pd
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+from CGATPipelines.Pipeline import cluster_runnable
+import matplotlib.pyplot as plt
+
+# lower PI_HAT boundaries of relationship classes, half-way
+# between the expected values of adjacent degrees
+RELATIONSHIP_CLASSES = (("unrelated", 0.0),
+                        ("third_degree", 0.09375),
+                        ("second_degree", 0.1875),
+                        ("first_degree", 0.375),
+                        ("duplicate", 0.75))
+
+
+def iterateIbdBlocks(infile, chunksize=1000000):
+    '''iterate over a plink :file:`.genome` file in blocks.
+
+    Arguments
+    ---------
+    infile : string
+        Filename of plink --genome output, can be compressed.
+    chunksize : int
+        Number of pairs in each block.
+
+    Returns
+    -------
+    blocks : iterator
+        Iterator over :class:`pandas.DataFrame` with the columns
+        FID1, IID1, FID2, IID2, Z0, Z1, Z2 and PI_HAT.
+    '''
+
+    return pd.read_csv(infile, sep=r"\s+", header=0,
+                       usecols=["FID1", "IID1", "FID2", "IID2",
+                                "Z0", "Z1", "Z2", "PI_HAT"],
+                       dtype={"FID1": str, "IID1": str,
+                              "FID2": str, "IID2": str},
+                       chunksize=chunksize)
+
+
+def findConnectedComponents(pairs):
+    '''group individuals into connected components with
+    a union-find over related pairs.
+
+    Arguments
+    ---------
+    pairs : list
+        List of tuples of related individuals.
+
+    Returns
+    -------
+    components : list
+        List of sets of individuals.
+    '''
+
+    parent = {}
+
+    def _find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            # path halving
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in pairs:
+        root_a, root_b = _find(a), _find(b)
+        if root_a != root_b:
+            parent[root_a] = root_b
+
+    components = collections.defaultdict(set)
+    for x in parent:
+        components[_find(x)].add(x)
+
+    return list(components.values())
+
+
+def selectRelatedExclusions(pairs):
+    '''select individuals to exclude so that no related
+    pairs remain.
+
+    Within each group of related individuals the individual with
+    the most relations is removed until no relations are left.
+
+    Arguments
+    ---------
+    pairs : list
+        List of tuples of related individuals.
+
+    Returns
+    -------
+    exclude : list
+        Sorted list of individuals to exclude.
+    '''
+
+    neighbours = collections.defaultdict(set)
+    for a, b in pairs:
+        if a != b:
+            neighbours[a].add(b)
+            neighbours[b].add(a)
+
+    exclude = []
+    for component in findConnectedComponents(pairs):
+        members = [x for x in component if neighbours[x]]
+        while members:
+            worst = max(sorted(members), key=lambda x: len(neighbours[x]))
+            for x in neighbours.pop(worst):
+                neighbours[x].discard(worst)
+            exclude.append(worst)
+            members = [x for x in members if neighbours[x]]
+
+    return sorted(exclude)
+
+
+@cluster_runnable
+def flagRelatedIndividuals(infile, hist_file, exclude_file, cutoff,
+                           chunksize=1000000, nbins=100):
+    '''flag related individuals from pairwise IBD estimates.
+
+    The plink :file:`.genome` file is read in blocks. The histogram
+    of PI_HAT and the counts of relationship classes are kept in
+    fixed-size accumulators, only pairs with PI_HAT >= `cutoff` are
+    kept in memory. Memory use is thus independent of the number of
+    pairs.
+
+    Related individuals are grouped with a union-find and the
+    individuals to exclude are chosen by
+    :func:`selectRelatedExclusions`.
+
+    Arguments
+    ---------
+    infile : string
+        Filename of plink --genome output
+    hist_file : string
+        Filename of PI_HAT histogram plot. The histogram values are
+        output into a file with the extension ``.tsv``.
+    exclude_file : string
+        Output filename for individuals to exclude. The file has the
+        columns FID and IID without a header, suitable for
+        plink --remove.
+    cutoff : float
+        PI_HAT threshold above which individuals are related.
+        Raises a ValueError if not set.
+    chunksize : int
+        Number of pairs to read at a time.
+    nbins : int
+        Number of histogram bins between 0 and 1.
+    '''
+
+    if cutoff is None or cutoff == "":
+        raise ValueError(
+            "no PI_HAT cutoff given to flag related individuals, "
+            "please set relationship_flag_cutoff")
+    cutoff = float(cutoff)
+    bins = np.linspace(0, 1, nbins + 1)
+    class_bounds = np.array([x[1] for x in RELATIONSHIP_CLASSES])
+
+    histogram = np.zeros(nbins, dtype=np.int64)
+    class_counts = np.zeros(len(RELATIONSHIP_CLASSES), dtype=np.int64)
+    related = []
+    npairs = 0
+
+    for block in iterateIbdBlocks(infile, chunksize=chunksize):
+        pi_hat = np.clip(block["PI_HAT"].values.astype(np.float64), 0, 1)
+        npairs += len(pi_hat)
+
+        # values of 1 fall into the last bin
+        idx = np.searchsorted(bins, pi_hat, side="right") - 1
+        histogram += np.bincount(np.minimum(idx, nbins - 1),
+                                 minlength=nbins)
+        class_counts += np.bincount(
+            np.searchsorted(class_bounds, pi_hat, side="right") - 1,
+            minlength=len(class_bounds))
+
+        hits = block[pi_hat >= cutoff]
+        if len(hits):
+            related.append(hits)
+        E.debug("read %i pairs, %i related" %
+                (npairs, sum([len(x) for x in related])))
+
+    if related:
+        related = pd.concat(related, ignore_index=True)
+    else:
+        related = pd.DataFrame(columns=["FID1", "IID1", "FID2", "IID2",
+                                        "Z0", "Z1", "Z2", "PI_HAT"])
+
+    pairs = list(zip(zip(related["FID1"], related["IID1"]),
+                     zip(related["FID2"], related["IID2"])))
+    exclude = selectRelatedExclusions(pairs)
+
+    E.info("%i pairs in total, %i related pairs at PI_HAT >= %f" %
+           (npairs, len(pairs), cutoff))
+    for (label, bound), count in zip(RELATIONSHIP_CLASSES, class_counts):
+        E.info("%s (PI_HAT >= %f): %i pairs" % (label, bound, count))
+    E.info("excluding %i related individuals" % len(exclude))
+
+    with IOTools.openFile(exclude_file, "w") as outf:
+        for fid, iid in exclude:
+            outf.write("%s\t%s\n" % (fid, iid))
+
+    hist_df = pd.DataFrame({"bin_start": bins[:-1],
+                            "bin_end": bins[1:],
+                            "npairs": histogram})
+    hist_df.to_csv(hist_file.replace(".png", ".tsv"), sep="\t",
+                   index=False)
+
+    p = plt.figure()
+    a = p.add_subplot(111)
+    a.bar(bins[:-1], histogram, width=1.0 / nbins, align="edge")
+    a.set_yscale("log")
+    a.axvline(cutoff, color="r", linestyle="--")
+    a.xaxis.set_label_text("PI_HAT")
+    a.yaxis.set_label_text("number of pairs")
+    p.savefig(hist_file)
+    plt.close(p)
+
+
+class LdStore(object):
+    '''pair-wise LD values of a single chromosome stored in
+    compressed blocks.
+
+    Every pair of SNPs is stored in both orientations as arrays of
+    the position of SNP A, the position of SNP B and r2 (as
+    float16), sorted by position of A and B.  The arrays are split
+    into blocks of `blocksize` pairs that are compressed
+    individually.  The store consists of three files:
+
+    ``<filename>``
+        the concatenated compressed blocks. The file is memory-mapped.
+    ``<filename>.idx.npy``
+        the coordinate index with the first and last position of
+        SNP A, the offset, compressed size and number of pairs of
+        each block.
+    ``<filename>.snps.tsv.gz``
+        the position and identifier of each SNP.
+
+    Looking up the LD neighbourhood of a SNP only decompresses the
+    blocks that contain the SNP, which takes milliseconds.
+
+    Stores are built with :func:`buildLdStore`.
+    '''
+
+    dtypes = (np.dtype("<i4"), np.dtype("<i4"), np.dtype("<f2"))
+
+    # number of decompressed blocks to keep
+    cache_size = 16
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = np.load(filename + ".idx.npy", mmap_mode="r")
+        if os.path.getsize(filename) > 0:
+            self.data = np.memmap(filename, dtype=np.uint8, mode="r")
+        else:
+            self.data = None
+        self._snps = None
+        self._cache = collections.OrderedDict()
+
+    def getSnps(self):
+        '''return table of SNPs with the columns BP and SNP,
+        sorted by position.
+        '''
+        if self._snps is None:
+            self._snps = pd.read_csv(self.filename + ".snps.tsv.gz",
+                                     sep="\t", header=0,
+                                     dtype={"BP": np.int64, "SNP": str})
+        return self._snps
+
+    def _getBlock(self, x):
+        '''return arrays of the decompressed block `x`.'''
+        if x in self._cache:
+            self._cache.move_to_end(x)
+            return self._cache[x]
+
+        first, last, offset, size, npairs = self.index[x]
+        buf = zlib.decompress(self.data[offset:offset + size].tobytes())
+        block, start = [], 0
+        for dtype in self.dtypes:
+            end = start + npairs * dtype.itemsize
+            block.append(np.frombuffer(buf[start:end], dtype=dtype))
+            start = end
+
+        self._cache[x] = block
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return block
+
+    def fetch(self, position, min_r2=0.0):
+        '''return SNPs in LD with the SNP at `position`.
+
+        Arguments
+        ---------
+        position : int
+            Position of the SNP.
+        min_r2 : float
+            Only return pairs with r2 >= `min_r2`.
+
+        Returns
+        -------
+        positions : numpy.array
+            Positions of SNPs in LD, sorted.
+        r2 : numpy.array
+            LD values as float32.
+        '''
+        start = np.searchsorted(self.index[:, 1], position, side="left")
+        end = np.searchsorted(self.index[:, 0], position, side="right")
+
+        positions = [np.zeros(0, dtype=np.int32)]
+        r2 = [np.zeros(0, dtype=np.float32)]
+        for x in range(start, end):
+            pos_a, pos_b, values = self._getBlock(x)
+            left = np.searchsorted(pos_a, position, side="left")
+            right = np.searchsorted(pos_a, position, side="right")
+            positions.append(pos_b[left:right])
+            r2.append(values[left:right].astype(np.float32))
+
+        positions = np.concatenate(positions)
+        r2 = np.concatenate(r2)
+        # values are stored as float16, round the threshold in the
+        # same way so that pairs at the threshold are kept
+        keep = r2 >= np.float32(np.float16(min_r2))
+        return positions[keep], r2[keep]
+
+    def fetchSnp(self, snp, min_r2=0.0):
+        '''return SNPs in LD with the SNP `snp`.
+
+        SNPs are identified by position, so if several SNPs
+        share a position all of them are returned.
+
+        Arguments
+        ---------
+        snp : string
+            SNP identifier.
+        min_r2 : float
+            Only return pairs with r2 >= `min_r2`.
+
+        Returns
+        -------
+        neighbours : pandas.DataFrame
+            Table with the columns SNP, BP and R2, sorted by position.
+        '''
+        snps = self.getSnps()
+        positions = snps.loc[snps["SNP"] == snp, "BP"].unique()
+        result = []
+        for position in positions:
+            pos_b, r2 = self.fetch(position, min_r2=min_r2)
+            result.append(pd.DataFrame({"BP": pos_b.astype(np.int64),
+                                        "R2": r2}))
+        if result:
+            result = pd.concat(result, ignore_index=True)
+        else:
+            result = pd.DataFrame({"BP": np.zeros(0, dtype=np.int64),
+                                   "R2": np.zeros(0, dtype=np.float32)})
+        result = result.merge(snps, on="BP", how="inner")
+        result = result[result["SNP"] != snp]
+        result = result.sort_values(["BP", "SNP"])
+        return result.loc[:, ["SNP", "BP", "R2"]].reset_index(drop=True)
+
+
+@cluster_runnable
+def buildLdStore(infile, outfile, chunksize=1000000, blocksize=65536):
+    '''build a :class:`LdStore` from plink LD output.
+
+    The plink ``--r2`` table output is read in chunks and needs to be
+    sorted by BP_A, which is the order that plink outputs pairs in.
+    Each pair is added in both orientations. Rows are output as soon
+    as no more pairs with the same position of SNP A can follow, so
+    memory is bounded by the size of the LD window rather than the
+    size of the input.
+
+    Arguments
+    ---------
+    infile : string
+        plink LD output for a single chromosome with the columns
+        BP_A, SNP_A, BP_B, SNP_B and R2.
+    outfile : string
+        Filename of the store.
+    chunksize : int
+        Number of rows to read at a time.
+    blocksize : int
+        Number of pairs in a compressed block.
+    '''
+
+    index = []
+    buffered = []
+    snps = []
+    pending = (np.zeros(0, dtype=np.int32),
+               np.zeros(0, dtype=np.int32),
+               np.zeros(0, dtype=np.float16))
+    last_key = None
+
+    def _writeBlocks(outf, arrays, flush):
+        '''write complete blocks, return the remainder.'''
+        pos_a, pos_b, r2 = [np.concatenate(x) for x in zip(*arrays)]
+        nblocks = len(pos_a) // blocksize
+        if flush and len(pos_a) % blocksize:
+            nblocks += 1
+        for x in range(nblocks):
+            block = slice(x * blocksize, (x + 1) * blocksize)
+            buf = zlib.compress(b"".join(
+                [array[block].astype(dtype).tobytes()
+                 for array, dtype in zip((pos_a, pos_b, r2),
+                                         LdStore.dtypes)]))
+            offset = outf.tell()
+            outf.write(buf)
+            index.append((pos_a[block][0], pos_a[block][-1],
+                          offset, len(buf), len(pos_a[block])))
+        rest = slice(nblocks * blocksize, len(pos_a))
+        return [(pos_a[rest], pos_b[rest], r2[rest])]
+
+    def _emit(keys, others, r2):
+        order = np.lexsort((others, keys))
+        buffered.append((keys[order], others[order], r2[order]))
+
+    reader = pd.read_csv(infile, sep=r"\s+", header=0,
+                         usecols=["BP_A", "SNP_A", "BP_B", "SNP_B", "R2"],
+                         dtype={"SNP_A": str, "SNP_B": str},
+                         chunksize=chunksize)
+
+    with open(outfile, "wb") as outf:
+        for chunk in reader:
+            bp_a = chunk["BP_A"].values.astype(np.int32)
+            bp_b = chunk["BP_B"].values.astype(np.int32)
+            r2 = chunk["R2"].values.astype(np.float16)
+
+            if (np.any(np.diff(bp_a) < 0)
+                    or (last_key is not None and bp_a[0] < last_key)):
+                raise ValueError(
+                    "LD file %s is not sorted by BP_A" % infile)
+            last_key = bp_a[-1]
+
+            keys = np.concatenate((pending[0], bp_a, bp_b))
+            others = np.concatenate((pending[1], bp_b, bp_a))
+            values = np.concatenate((pending[2], r2, r2))
+
+            # all pairs for positions before the last position
+            # in this chunk have been seen
+            done = keys < last_key
+            _emit(keys[done], others[done], values[done])
+            pending = (keys[~done], others[~done], values[~done])
+
+            snps.append(pd.DataFrame(
+                {"BP": np.concatenate((bp_a, bp_b)),
+                 "SNP": np.concatenate((chunk["SNP_A"].values,
+                                        chunk["SNP_B"].values))}
+            ).drop_duplicates())
+
+            if sum([len(x[0]) for x in buffered]) >= blocksize:
+                buffered = _writeBlocks(outf, buffered, flush=False)
+
+        _emit(*pending)
+        _writeBlocks(outf, buffered, flush=True)
+
+    np.save(outfile + ".idx.npy",
+            np.array(index, dtype=np.int64).reshape(-1, 5))
+
+    if snps:
+        snps = pd.concat(snps, ignore_index=True).drop_duplicates()
+    else:
+        snps = pd.DataFrame(columns=["BP", "SNP"])
+    snps = snps.sort_values(["BP", "SNP"])
+    snps.to_csv(outfile + ".snps.tsv.gz", sep="\t", index=False)
+
+    E.info("stored %i pairs for %i SNPs in %i blocks" %
+           (sum([x[4] for x in index]), len(snps), len(index)))
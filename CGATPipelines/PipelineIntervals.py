@@ -206,11 +206,207 @@ def getPeakShift(filename):
         return getPeakShiftFromSPP("%s.spp" % filename)
 
 
+def _collectReads(samfile, contig, start, end):
+    '''collect the reads within a genomic region.
+
+    Arguments
+    ---------
+    samfile : object
+        pysam file handle to a :term:`bam` formatted file.
+    contig : string
+        Chromosome
+    start : int
+        Start coordinate, 0-based
+    end : int
+        End coordinate, 0-based, position after end of region
+
+    Returns
+    -------
+    reads : dict
+        Arrays of the alignment start (`pos`) and end (`aend`), the
+        read length (`rlen`) and the strand (`reverse`) and mapping
+        status (`unmapped`) of the reads returned by fetch, in order
+        of alignment start. The alignment end follows the
+        conventions of fetch, it is at least one base after the
+        alignment start.
+    '''
+    pos, aend, rlen, flag = [], [], [], []
+    for read in samfile.fetch(contig, start, end):
+        pos.append(read.pos)
+        aend.append(read.aend or 0)
+        rlen.append(read.rlen)
+        flag.append(read.flag)
+
+    pos = numpy.array(pos, dtype=numpy.int64)
+    flag = numpy.array(flag, dtype=numpy.int64)
+    return {"pos": pos,
+            "aend": numpy.maximum(numpy.array(aend, dtype=numpy.int64),
+                                  pos + 1),
+            "rlen": numpy.array(rlen, dtype=numpy.int64),
+            "reverse": (flag & 16) != 0,
+            "unmapped": (flag & 4) != 0}
+
+
+def _clusterIntervals(intervals, max_gap, max_span):
+    '''group consecutive intervals that are close to each other.
+
+    A new group is started if the gap to the previous interval is
+    larger than `max_gap` or if the group would span more than
+    `max_span` bases.
+
+    Arguments
+    ---------
+    intervals : list
+        List of (start, end) tuples.
+    max_gap : int
+        Maximum distance between intervals in a group.
+    max_span : int
+        Maximum size of the region covered by a group.
+
+    Returns
+    -------
+    iterator : iterator
+        Iterator over lists of (start, end) tuples.
+    '''
+    cluster, lower, upper = [], 0, 0
+    for start, end in intervals:
+        if cluster and (start > upper + max_gap
+                        or end < lower - max_gap
+                        or max(upper, end) - min(lower, start) > max_span):
+            yield cluster
+            cluster = []
+        if cluster:
+            lower, upper = min(lower, start), max(upper, end)
+        else:
+            lower, upper = start, end
+        cluster.append((start, end))
+    if cluster:
+        yield cluster
+
+
+def getCountsInContig(contig, intervals, samfiles, offsets=[],
+                      max_gap=10000, max_span=1000000):
+    '''count number of reads within multiple genomic intervals
+    on the same contig.
+
+    Consecutive intervals that are close to each other are grouped
+    and the reads for a group are fetched once from each :term:`bam`
+    file. The read density in each interval is then built from arrays
+    of read starts and ends in a single pass. Intervals sorted by
+    position are thus counted most efficiently. Only the reads of one
+    group are kept in memory. See :func:`getCounts` for details.
+
+    Arguments
+    ---------
+    contig : string
+        Chromosome
+    intervals : list
+        List of (start, end) tuples with 0-based coordinates.
+    samfiles : list
+        List of pysam file handles to :term:`bam` formatted files.
+    offsets : list
+        Peak shifts to apply to reads
+    max_gap : int
+        Intervals further apart than `max_gap` are fetched separately.
+    max_span : int
+        Maximum size of a region fetched at once.
+
+    Returns
+    -------
+    iterator : iterator
+        Iterator over tuples of (nreads, counts) for each interval
+        in the order of `intervals`.
+    '''
+    assert len(offsets) == 0 or len(samfiles) == len(offsets)
+
+    if not offsets:
+        offsets = [None] * len(samfiles)
+
+    for cluster in _clusterIntervals(intervals, max_gap, max_span):
+        for result in _getCountsInCluster(contig, cluster,
+                                          samfiles, offsets):
+            yield result
+
+
+def _getCountsInCluster(contig, intervals, samfiles, offsets):
+    '''count reads within a group of nearby intervals.
+
+    See :func:`getCountsInContig`.
+    '''
+    # collect reads for all intervals with one fetch per bam file
+    regions = []
+    for samfile, offset in zip(samfiles, offsets):
+        shift = 0 if offset is None else offset / 2
+        xstart = max(0, min(x[0] for x in intervals) - shift)
+        xend = max(0, max(x[1] for x in intervals) + shift)
+        reads = _collectReads(samfile, contig, int(xstart),
+                              int(numpy.ceil(xend)))
+        if offset is None:
+            rstart = reads["pos"]
+            rend = reads["pos"] + reads["rlen"]
+        else:
+            # for peak counting I follow the MACS protocoll,
+            # see the function def __tags_call_peak in PeakDetect.py
+            # In words
+            # Only take the start of reads (taking into account the strand)
+            # add d/2=offset to each side of peak and start accumulate
+            # counts. for counting, extend reads by offset
+            # on + strand shift tags upstream
+            # i.e. look at the downstream window
+            rstart = numpy.where(reads["reverse"],
+                                 reads["aend"] - offset,
+                                 reads["pos"] + shift)
+            rend = rstart + shift
+        if len(reads["pos"]):
+            maxspan = numpy.max(reads["aend"] - reads["pos"])
+        else:
+            maxspan = 0
+        regions.append((reads, rstart, rend, maxspan, offset, shift))
+
+    for start, end in intervals:
+        length = end - start
+        counts = numpy.zeros(length + 1, dtype=numpy.int64)
+        nreads = 0
+
+        for reads, rstart, rend, maxspan, offset, shift in regions:
+            if offset is None:
+                xstart, xend = start, end
+            else:
+                xstart, xend = max(0, start - shift), max(0, end + shift)
+
+            # reads returned by fetch(contig, xstart, xend)
+            first = numpy.searchsorted(reads["pos"], xstart - maxspan)
+            last = numpy.searchsorted(reads["pos"], xend)
+            take = numpy.arange(first, last)
+            take = take[reads["aend"][take] > xstart]
+
+            if offset is None:
+                nreads += len(take)
+            else:
+                # some unmapped reads might have a position
+                take = take[~reads["unmapped"][take]]
+
+            lower = numpy.maximum(0, rstart[take] - start).astype(numpy.int64)
+            upper = numpy.minimum(length, rend[take] - start)
+            upper = numpy.trunc(upper).astype(numpy.int64)
+            # shifted tags, and reads whose aligned bases end before
+            # the interval because of a deletion, do not contribute.
+            # Previous versions incremented counts[0:rend - start]
+            # for these, a negative slice end that added them to
+            # most of the interval.
+            keep = upper > lower
+            counts += numpy.bincount(lower[keep], minlength=length + 1)
+            counts -= numpy.bincount(upper[keep], minlength=length + 1)
+
+        yield nreads, numpy.cumsum(counts[:length]).astype(numpy.float64)
+
+
 def getCounts(contig, start, end, samfiles, offsets=[]):
     '''count number of reads within a genomic interval
 
     If offsets are given, tags are shifted by `offset` / 2 and
-    extended by `offset` / 2.
+    extended by `offset` / 2. Only tags overlapping the interval
+    after shifting are counted.
 
     Arguments
     ---------
@@ -232,51 +428,51 @@ def getCounts(contig, start, end, samfiles, offsets=[]):
     counts : array
         Read density in interval.
     '''
-    assert len(offsets) == 0 or len(samfiles) == len(offsets)
+    return next(getCountsInContig(contig, [(start, end)], samfiles, offsets))
 
-    length = end - start
-    counts = numpy.zeros(length)
 
-    nreads = 0
+def countPeaksInContig(contig, intervals, samfiles, offsets=None):
+    '''compute peak parameters within multiple genomic intervals
+    on the same contig.
 
-    if offsets:
-        # if offsets are given, shift tags.
-        for samfile, offset in zip(samfiles, offsets):
+    Each :term:`bam` file is read once for all intervals, see
+    :func:`countPeaks` for details.
 
-            shift = offset / 2
-            # for peak counting I follow the MACS protocoll,
-            # see the function def __tags_call_peak in PeakDetect.py
-            # In words
-            # Only take the start of reads (taking into account the strand)
-            # add d/2=offset to each side of peak and start accumulate counts.
-            # for counting, extend reads by offset
-            # on + strand shift tags upstream
-            # i.e. look at the downstream window
-            xstart, xend = max(0, start - shift), max(0, end + shift)
+    Arguments
+    ---------
+    contig : string
+        Chromosome
+    intervals : list
+        List of (start, end) tuples with 0-based coordinates.
+    samfiles : list
+        List of pysam file handles to :term:`bam` formatted files.
+    offsets : list
+        Peak shifts to apply to reads
 
-            for read in samfile.fetch(contig, xstart, xend):
-                # some unmapped reads might have a position
-                if read.is_unmapped:
-                    continue
-                if read.is_reverse:
-                    # offset = 2 * shift
-                    rstart = read.pos + read.alen - offset
-                else:
-                    rstart = read.pos + shift
-
-                rend = rstart + shift
-                rstart = max(0, rstart - start)
-                rend = min(length, rend - start)
-                counts[int(rstart):int(rend)] += 1
+    Returns
+    -------
+    iterator : iterator
+        Iterator over tuples of (nresidues_in_peaks, peakcenter, length,
+        avgval, peakval, nreads) for each interval in the order of
+        `intervals`.
+    '''
+    intervals = list(intervals)
+    for (start, end), (nreads, counts) in zip(
+            intervals,
+            getCountsInContig(contig, intervals, samfiles, offsets or [])):
 
-    else:
-        for samfile in samfiles:
-            for read in samfile.fetch(contig, start, end):
-                nreads += 1
-                rstart = max(0, read.pos - start)
-                rend = min(length, read.pos - start + read.rlen)
-                counts[rstart:rend] += 1
-    return nreads, counts
+        length = end - start
+        avgval = numpy.mean(counts)
+        peakval = counts.max()
+
+        # set other peak parameters
+        peaks = numpy.flatnonzero(counts >= peakval)
+        npeaks = len(peaks)
+        # peakcenter is median coordinate between peaks
+        # such that it is a valid peak in the middle
+        peakcenter = start + peaks[npeaks // 2]
+
+        yield npeaks, peakcenter, length, avgval, peakval, nreads
 
 
 def countPeaks(contig, start, end, samfiles, offsets=None):
@@ -313,21 +509,7 @@ def countPeaks(contig, start, end, samfiles, offsets=None):
     nreads : int
         Number of tags contained in interval.
     '''
-
-    nreads, counts = getCounts(contig, start, end, samfiles, offsets)
-
-    length = end - start
-    avgval = numpy.mean(counts)
-    peakval = max(counts)
-
-    # set other peak parameters
-    peaks = numpy.array(list(range(0, length)))[counts >= peakval]
-    npeaks = len(peaks)
-    # peakcenter is median coordinate between peaks
-    # such that it is a valid peak in the middle
-    peakcenter = start + peaks[npeaks // 2]
-
-    return npeaks, peakcenter, length, avgval, peakval, nreads
+    return next(countPeaksInContig(contig, [(start, end)], samfiles, offsets))
 
 
 def buildBAMforPeakCalling(infiles, outfile, dedup, mask):
@@ -83,6 +83,9 @@ import glob
 import collections
 import re
 import itertools
+import bisect
+import heapq
+import random
 import CGATPipelines.Pipeline as P
 import logging as L
 import CGAT.Experiment as E
@@ -428,6 +431,172 @@ def resetGTFAttributes(infile, genome, gene_ids, outfile):
     # os.unlink(tmpfile2)
 
 
+def _iterateFastqRecords(infiles):
+    '''iterate over synchronised records in one or more fastq files.
+
+    Yields tuples with the four lines of a record from each file.
+    Raises a ValueError if the files contain a different number of
+    records.
+    '''
+    inputs = [IOTools.openFile(x) for x in infiles]
+    # four lines per fastq record
+    records = [zip(inf, inf, inf, inf) for inf in inputs]
+    for record in itertools.zip_longest(*records):
+        if None in record:
+            raise ValueError(
+                "fastq files %s are out of sync" % ",".join(infiles))
+        yield record
+    for inf in inputs:
+        inf.close()
+
+
+def subsampleFastqs(infiles, outfiles, params):
+    '''randomly subsample fastq files in a single pass.
+
+    Several subsamples of different sizes are created from a single
+    pass through the input. Records in paired files are sampled
+    together so that output files stay synchronised. Subsamples are
+    nested, i.e. each smaller subsample is contained in the larger
+    ones, and reads are output in their original order.
+
+    Two sampling methods are available:
+
+    reservoir
+        Exact sample sizes. If the number of reads in the input is
+        given, records are selected while reading (selection
+        sampling) and memory use is constant. Otherwise, the records
+        of the largest sample are kept in memory.
+    bernoulli
+        Each read is kept with probability `limit / nreads`, so the
+        sample sizes are approximate. Memory use is constant, but the
+        number of reads in the input needs to be known.
+
+    This function can be called via :file:`run_function.py`.
+
+    Arguments
+    ---------
+    infiles : string or list
+        Filenames of :term:`fastq` formatted input files. Multiple
+        files are treated as synchronised (paired) files.
+    outfiles : string or list
+        Output filenames. The files are ordered by sample size and
+        then by input file.
+    params : list
+        List of parameters: method (``reservoir`` or ``bernoulli``),
+        random seed, number of reads in the input (required for
+        bernoulli sampling, 0 if unknown) and the sample sizes in the
+        same order as `outfiles`.
+    '''
+    if isinstance(infiles, str):
+        infiles = [infiles]
+    if isinstance(outfiles, str):
+        outfiles = [outfiles]
+
+    method, seed, nreads = params[:3]
+    limits = [int(x) for x in params[3:]]
+    nfiles = len(infiles)
+
+    if len(outfiles) != len(limits) * nfiles:
+        raise ValueError(
+            "expected %i output files, got %i" %
+            (len(limits) * nfiles, len(outfiles)))
+
+    rng = random.Random(int(seed))
+    records = _iterateFastqRecords(infiles)
+
+    outputs = [IOTools.openFile(x, "w") for x in outfiles]
+
+    def _write(record, nsamples):
+        for j in range(nsamples):
+            for x, lines in enumerate(record):
+                outputs[j * nfiles + x].write("".join(lines))
+
+    # sort limits decreasing so that a record can be written
+    # to the first n outputs
+    order = sorted(range(len(limits)), key=lambda x: -limits[x])
+    outputs = [outputs[j * nfiles + x]
+               for j in order for x in range(nfiles)]
+    limits = [limits[j] for j in order]
+
+    if method == "bernoulli":
+        nreads = int(nreads)
+        if nreads <= 0:
+            raise ValueError(
+                "bernoulli sampling requires the number of reads")
+        # negated sampling probabilities in ascending order
+        thresholds = [-float(x) / nreads for x in limits]
+        for record in records:
+            key = rng.random()
+            nsamples = bisect.bisect_left(thresholds, -key)
+            if nsamples:
+                _write(record, nsamples)
+
+    elif method == "reservoir" and int(nreads) > 0:
+        # selection sampling (Knuth, Algorithm S): a record is selected
+        # with probability needed / available. Each sample is drawn
+        # from the records of the next larger one.
+        nreads = int(nreads)
+        needed = [min(x, nreads) for x in limits]
+        available = [nreads] + needed[:-1]
+        for record in records:
+            nsamples = 0
+            for j in range(len(limits)):
+                select = rng.random() * available[j] < needed[j]
+                available[j] -= 1
+                if not select:
+                    break
+                needed[j] -= 1
+                nsamples += 1
+            if nsamples:
+                _write(record, nsamples)
+        if available[0] != 0:
+            raise ValueError(
+                "fastq files %s contain %i reads, expected %i" %
+                (",".join(infiles), nreads - available[0], nreads))
+
+    elif method == "reservoir":
+        # keep the records with the smallest random keys in a
+        # max-heap (keys are negated)
+        kmax = limits[0]
+        heap = []
+        for index, record in enumerate(records):
+            key = rng.random()
+            if len(heap) < kmax:
+                heapq.heappush(heap, (-key, index, record))
+            elif key < -heap[0][0]:
+                heapq.heapreplace(heap, (-key, index, record))
+
+        # the k records with the smallest keys are a uniform
+        # sample of size k
+        selected = sorted(heap, reverse=True)
+        ranks = [(index, rank, record)
+                 for rank, (key, index, record) in enumerate(selected)]
+        thresholds = [-x for x in limits]
+        for index, rank, record in sorted(ranks):
+            nsamples = bisect.bisect_right(thresholds, -rank - 1)
+            _write(record, nsamples)
+    else:
+        raise ValueError("unknown sampling method '%s'" % method)
+
+    for outf in outputs:
+        outf.close()
+
+
+def _buildSubsampleStatement(infiles, outfiles, method, seed, nreads,
+                             limits):
+    '''build a statement running :func:`subsampleFastqs`.'''
+    inputs = " ".join(["--input=%s" % x for x in infiles])
+    outputs = " ".join(["--output-section=%s" % x for x in outfiles])
+    params = ",".join(map(str, [method, seed, nreads] + list(limits)))
+    statement = '''python %%(pipeline_scriptsdir)s/run_function.py
+    --module=CGATPipelines.PipelineMapping
+    --function=subsampleFastqs
+    %(inputs)s
+    %(outputs)s
+    --params=%(params)s;''' % locals()
+    return statement
+
+
 class SequenceCollectionProcessor(object):
     """base class for processors of sequence collections.
 
@@ -1472,49 +1641,80 @@ class SubsetHeads(Mapper):
 
 
 class SubsetRandom(Mapper):
-    """subset fastq files by taking a random n sequences"""
+    """subset fastq files by taking a random n sequences.
+
+    Reads are selected by reservoir sampling in a single pass through
+    the input, see :func:`subsampleFastqs`. Paired files are sampled
+    together.
+    """
 
     compress = True
 
-    def __init__(self, limit=1000000, *args, **kwargs):
+    def __init__(self, limit=1000000, seed=1, *args, **kwargs):
         Mapper.__init__(self, *args, **kwargs)
         self.limit = limit
+        self.seed = seed
 
     def mapper(self, infiles, outfile):
-        '''count number of reads by counting number of lines
-        in fastq files.
-        '''
-        # This used to be multiplied by 4 but this is a mistake - as the each line of the fastq
-        # is pasted into a single line before counting
-        limit = self.limit
-        statement = []
+        '''output a random sample of `limit` reads.'''
         output_prefix = P.snip(outfile, ".subset")
         assert len(infiles) == 1
         infiles = infiles[0]
 
         # check if single or paired end
         if len(infiles) == 1:
-            fastq = infiles[0]
-            statement = """
-            zcat %(fastq1)s |
-            paste - - - - |
-            sort -R |
-            awk -F'\\t'  'NR > %(limit)i {exit} {OFS="\\n";
-            print $1,$3,$5,$7 | "gzip > %(output_prefix)s.fastq.gz}"}';
-            """ % locals()
-
-        if len(infiles) == 2:
-            fastq1, fastq2 = infiles
-            statement = """
-            paste <(zcat %(fastq1)s) <(zcat %(fastq2)s) |
-            paste - - - - |
-            sort -R |
-            awk -F'\\t'  'NR > %(limit)i {exit} {OFS="\\n";
-            print $1,$3,$5,$7 | "gzip > %(output_prefix)s.fastq.1.gz";
-            print $2,$4,$6,$8 | "gzip > %(output_prefix)s.fastq.2.gz"}';
-            """ % locals()
+            outfiles = [output_prefix + ".fastq.gz"]
+        else:
+            outfiles = [output_prefix + ".fastq.%i.gz" % (x + 1)
+                        for x in range(len(infiles))]
 
-        return statement
+        return _buildSubsampleStatement(
+            infiles, outfiles, "reservoir", self.seed, 0, [self.limit])
+
+
+class SubsetRandoms(Mapper):
+    """subset fastq files by taking random samples of n sequences.
+
+    This is the random equivalent of :class:`SubsetHeads`. All samples
+    are created in a single pass through the input and are nested,
+    i.e. smaller samples are contained within larger ones.
+
+    With `method` ``reservoir``, samples have exactly the requested
+    size. If `nreads` is given, samples are selected while reading
+    and are not held in memory. With `method`
+    ``bernoulli`` each read is kept with probability limit/`nreads`,
+    which requires the number of reads in the input but uses constant
+    memory.
+    """
+
+    compress = True
+
+    def __init__(self, limits=[1000000], method="reservoir", seed=1,
+                 nreads=0, *args, **kwargs):
+        Mapper.__init__(self, *args, **kwargs)
+        self.limits = limits
+        self.method = method
+        self.seed = seed
+        self.nreads = nreads
+
+    def mapper(self, infiles, outfile):
+        '''output random samples of each size in `limits`.'''
+        limits = sorted(self.limits)
+        output_prefix = P.snip(outfile, ".sentinel")
+        assert len(infiles) == 1
+        infiles = infiles[0]
+
+        outfiles = []
+        for n in range(len(limits)):
+            if len(infiles) == 1:
+                outfiles.append(output_prefix + "_%i.fastq.gz" % n)
+            else:
+                outfiles.extend(
+                    [output_prefix + "_%i.fastq.%i.gz" % (n, x + 1)
+                     for x in range(len(infiles))])
+
+        return _buildSubsampleStatement(
+            infiles, outfiles, self.method, self.seed, self.nreads, limits)
 
 
 class BWA(Mapper):
@@ -1,11 +1,15 @@
 import os
 import re
 import collections
+import hashlib
+import heapq
 import itertools
+import multiprocessing
 import CGAT.Experiment as E
 import CGATPipelines.Pipeline as P
 import CGAT.IOTools as IOTools
 import CGAT.BamTools as BamTools
+import CGATPipelines.PipelineIntervals as PipelineIntervals
 import pandas as pd
 import pysam
 import numpy as np
@@ -379,7 +383,7 @@ def appendContigFilters(statement, inT, tabout, filters, pe,
 
 @cluster_runnable
 def filterBams(infile, outfiles, filters, bedfiles, blthresh, pe, strip, qual,
-               contigs_to_remove, keep_intermediates=False):
+               contigs_to_remove, keep_intermediates=False, threads=1):
     '''
     Builds a statement which applies various filters to bam files.
 
@@ -428,6 +432,8 @@ def filterBams(infile, outfiles, filters, bedfiles, blthresh, pe, strip, qual,
         minimum mapping quality to keep
     keep_intermediates: bool
         keep temporary files if True
+    threads: int
+        number of processes used to check the filtered bam file
 
     '''
     bamout, tabout = outfiles
@@ -516,7 +522,8 @@ def filterBams(infile, outfiles, filters, bedfiles, blthresh, pe, strip, qual,
     # remove reads whose mate has been filtered out elsewhere
 
     T = P.getTempFilename(".")
-    checkBams(bamout, filters, qual, pe, T, contigs_to_remove, submit=True)
+    checkBams(bamout, filters, qual, pe, T, contigs_to_remove,
+              threads=threads, job_threads=threads, submit=True)
     if int(keep_intermediates) == 1:
         shutil.copy(bamout, bamout.replace(".bam", "_beforepaircheck.bam"))
     shutil.move("%s.bam" % T, bamout)
@@ -528,8 +535,198 @@ def filterBams(infile, outfiles, filters, bedfiles, blthresh, pe, strip, qual,
     sortIndex(bamout)
 
 
+def _countRead(read, qlim, counter):
+    '''
+    Adds a read to the filtering counters of checkBams.
+    '''
+    counter['total_reads'] += 1
+    if read.is_secondary:
+        counter['secondary'] += 1
+    else:
+        counter['primary_alig'] += 1
+
+    if read.is_proper_pair:
+        counter['proper_pairs'] += 1
+    else:
+        counter['improper_pairs'] += 1
+
+    if read.mapping_quality >= qlim:
+        counter['high_quality'] += 1
+    else:
+        counter['low_quality'] += 1
+
+    if read.is_unmapped:
+        counter['unmapped'] += 1
+    else:
+        counter['mapped'] += 1
+
+
+def _getPosition(read):
+    '''
+    Returns the sort key of an alignment in a coordinate sorted bam file.
+    '''
+    return read.reference_id, read.reference_start
+
+
+def _checkPair(reads, filters, pe, counter, fragment_length, outbam):
+    '''
+    Checks a group of alignments with the same query name for checkBams,
+    counting fragment lengths and writing the alignments to outbam if
+    they should be kept.
+    '''
+    if "unpaired" in filters and pe == 1:
+        if len(reads) == 2:
+            if reads[0].is_read1 and reads[1].is_read2:
+                outbam.write(reads[0])
+                outbam.write(reads[1])
+
+            elif reads[0].is_read2 and reads[1].is_read1:
+                outbam.write(reads[1])
+                outbam.write(reads[0])
+
+            else:
+                counter['paired11_paired22'] += 1
+            fragment_length[abs(reads[0].template_length)] += 1
+        else:
+            counter['multiple_or_1_read_in_pair'] += 1
+            if "secondary" not in filters:
+                for read in reads:
+                    outbam.write(read)
+
+    elif pe == 1:
+        fragment_length[abs(reads[0].template_length)] += 1
+
+
+def _iterateMates(reads, multiple=()):
+    '''
+    Groups the alignments from a coordinate sorted iterator over a single
+    contig by query name.
+
+    An alignment is kept in memory only until the position of its mate
+    has been passed, so memory use depends on the fragment length and
+    not on the number of reads.
+
+    Groups are formed from primary alignments only, as only these
+    record the position of their mate. Secondary (0x100) and
+    supplementary (0x800) alignments and all alignments of reads in
+    `multiple` can be anywhere in the file. They are yielded on their
+    own as incomplete.
+
+    Yields tuples of (alignments, complete).  complete is False if any of
+    the alignments has its mate on another contig, these groups have to
+    be matched up with the other alignments of the read by the caller.
+    '''
+    pending = {}
+    heap = []
+    for read in reads:
+        pos = read.reference_start
+        while heap and heap[0][0] < pos:
+            release, name = heapq.heappop(heap)
+            group = pending.get(name)
+            if group is not None and group[1] == release:
+                del pending[name]
+                yield group[0], group[2]
+
+        if read.is_secondary or read.is_supplementary or \
+           read.query_name in multiple:
+            yield [read], False
+            continue
+
+        local = True
+        expected = pos
+        if read.is_paired and not read.mate_is_unmapped:
+            if read.next_reference_id == read.reference_id:
+                expected = max(pos, read.next_reference_start)
+            elif read.next_reference_id >= 0:
+                local = False
+
+        name = read.query_name
+        if name in pending:
+            group = pending[name]
+            group[0].append(read)
+            group[2] = group[2] and local
+            if expected > group[1]:
+                group[1] = expected
+                heapq.heappush(heap, (expected, name))
+        else:
+            pending[name] = [[read], expected, local]
+            heapq.heappush(heap, (expected, name))
+
+    for reads, release, complete in pending.values():
+        yield reads, complete
+
+
+def _getMultipleAlignmentNames(infile, outfile):
+    '''
+    Returns the names of reads with secondary or supplementary alignments
+    in infile.
+
+    The alignments are selected with samtools into temporary files
+    starting with outfile.
+    '''
+    names = set()
+    for flag in ("256", "2048"):
+        tmpfile = "%s.%s.sam" % (outfile, flag)
+        pysam.view("-f", flag, "-o", tmpfile, infile, catch_stdout=False)
+        with open(tmpfile) as inf:
+            for line in inf:
+                names.add(line.split("\t", 1)[0])
+        os.unlink(tmpfile)
+    return names
+
+
+def _checkBamContigs(args):
+    '''
+    Checks the alignments on a list of contigs for checkBams.
+
+    Alignments to keep are written to outfile, alignments whose mate is on
+    another contig and all alignments of reads with multiple alignments
+    are written to leftfile.
+
+    Returns the filtering counters, the fragment length histogram and the
+    number of reads on each contig.
+    '''
+    infile, contigs, filters, qlim, pe, outfile, leftfile, multiple = args
+    samfile = pysam.AlignmentFile(infile, 'rb')
+    counter = collections.Counter()
+    fragment_length = collections.Counter()
+    ncontig = collections.Counter()
+    outbam = leftbam = None
+    if outfile:
+        outbam = pysam.AlignmentFile(outfile, "wb", template=samfile)
+    if pe == 1:
+        leftbam = pysam.AlignmentFile(leftfile, "wb", template=samfile)
+
+    def _reads(contig):
+        for read in samfile.fetch(contig):
+            _countRead(read, qlim, counter)
+            ncontig[contig] += 1
+            yield read
+
+    for contig in contigs:
+        if pe != 1:
+            for read in _reads(contig):
+                pass
+            continue
+
+        for reads, complete in _iterateMates(_reads(contig), multiple):
+            if complete:
+                _checkPair(reads, filters, pe, counter, fragment_length,
+                           outbam)
+            else:
+                for read in reads:
+                    leftbam.write(read)
+
+    for bam in (outbam, leftbam):
+        if bam is not None:
+            bam.close()
+    samfile.close()
+    return counter, fragment_length, ncontig
+
+
 @cluster_runnable
-def checkBams(infile, filters, qlim, pe, outfile, contigs_to_remove):
+def checkBams(infile, filters, qlim, pe, outfile, contigs_to_remove,
+              threads=1):
     '''
     Generates a table to ensure that post filtering bam files do not
     contain any of the reads which should have been filtered out.  This table
@@ -555,6 +752,18 @@ def checkBams(infile, filters, qlim, pe, outfile, contigs_to_remove):
     bam file.  This file will have the suffix .fraglengths.  For unpaired
     data this file is generated but is blank.
 
+    The bam file is read in a single pass and memory use does not depend
+    on the number of reads.  Name sorted bam files are read in name groups.
+    Coordinate sorted, indexed bam files are read contig by contig, split
+    across threads processes, and mates are matched using the mate
+    position of each alignment.  Pairs with mates on different contigs
+    and all alignments of reads with secondary or supplementary
+    alignments are collected in a temporary bam file, which is name
+    sorted with samtools and matched up at the end.  For paired data,
+    the names of reads with multiple alignments are kept in memory.
+    Within a name group, alignments are checked in coordinate order
+    as for a coordinate sorted file.
+
     Parameters
     ----------
     infile: str
@@ -568,6 +777,8 @@ def checkBams(infile, filters, qlim, pe, outfile, contigs_to_remove):
         path to output file
     remove_contigs: set
         set of the contigs that should have been removed from the bam file
+    threads: int
+        number of processes to split the contigs across
     '''
 
     samfile = pysam.AlignmentFile(infile, 'rb')
@@ -579,16 +790,12 @@ def checkBams(infile, filters, qlim, pe, outfile, contigs_to_remove):
 
     counter = collections.Counter()
     fragment_length = collections.Counter()
-    d = collections.defaultdict(list)
 
     if "lowqual" not in filters:
         qlim = 0
 
     for item in remove_contigs:
-        if item in contigs_in_bam:
-            counter[item] = samfile.count(item)
-        else:
-            counter[item] = 0
+        counter[item] = 0
 
     counter['primary_alig'] = 0
     counter['secondary'] = 0
@@ -600,63 +807,100 @@ def checkBams(infile, filters, qlim, pe, outfile, contigs_to_remove):
     counter['mapped'] = 0
     counter['multiple_or_1_read_in_pair'] = 0
 
-    for read in samfile.fetch():
-        d[read.query_name].append(read)
+    write = "unpaired" in filters and pe == 1
+    if not write:
+        shutil.copy(infile, "%s.bam" % outfile)
 
-        counter['total_reads'] += 1
-        if read.is_secondary:
-            counter['secondary'] += 1
+    sortorder = samfile.header.to_dict().get("HD", {}).get("SO")
+    if sortorder == "queryname":
+        if write:
+            outbam = pysam.AlignmentFile("%s.bam" % outfile, "wb",
+                                         template=samfile)
         else:
-            counter['primary_alig'] += 1
-
-        if read.is_proper_pair:
-            counter['proper_pairs'] += 1
-        else:
-            counter['improper_pairs'] += 1
-
-        if read.mapping_quality >= qlim:
-            counter['high_quality'] += 1
+            outbam = None
+        # reads with the same name are adjacent, unplaced reads are
+        # skipped as they are not returned by fetch for indexed files
+        reads = (read for read in samfile.fetch(until_eof=True)
+                 if read.reference_id >= 0)
+        for name, group in itertools.groupby(reads,
+                                             lambda x: x.query_name):
+            group = sorted(group, key=_getPosition)
+            for read in group:
+                _countRead(read, qlim, counter)
+                if read.reference_name in remove_contigs:
+                    counter[read.reference_name] += 1
+            if pe == 1:
+                _checkPair(group, filters, pe, counter, fragment_length,
+                           outbam)
+        if outbam is not None:
+            outbam.close()
+    else:
+        # split the contigs into one chunk per process, largest first
+        contigs = sorted(zip(samfile.lengths, contigs_in_bam),
+                         reverse=True)
+        if multiprocessing.current_process().daemon:
+            threads = 1
+        threads = max(1, min(threads, len(contigs)))
+        if pe == 1:
+            multiple = _getMultipleAlignmentNames(infile, outfile)
         else:
-            counter['low_quality'] += 1
-
-        if read.is_unmapped:
-            counter['unmapped'] += 1
+            multiple = set()
+        tasks = []
+        for x in range(threads):
+            tasks.append(
+                (infile, [y[1] for y in contigs[x::threads]], filters, qlim,
+                 pe, "%s.%i.part.bam" % (outfile, x) if write else None,
+                 "%s.%i.left.bam" % (outfile, x), multiple))
+
+        if threads > 1:
+            pool = multiprocessing.Pool(threads)
+            results = pool.map(_checkBamContigs, tasks)
+            pool.close()
+            pool.join()
         else:
-            counter['mapped'] += 1
-
-    if "unpaired" in filters and pe == 1:
-        outbam = pysam.AlignmentFile("%s.bam" % outfile, "wb",
-                                     template=samfile)
-        for items, values in d.items():
-            if len(values) == 2:
-                if values[0].is_read1 and values[1].is_read2:
-                    outbam.write(values[0])
-                    outbam.write(values[1])
-
-                elif values[0].is_read2 and values[1].is_read1:
-                    outbam.write(values[1])
-                    outbam.write(values[0])
-
-                else:
-                    counter['paired11_paired22'] += 1
-                l = abs(values[0].template_length)
-                fragment_length[l] += 1
+            results = [_checkBamContigs(task) for task in tasks]
+
+        for c, f, ncontig in results:
+            counter.update(c)
+            fragment_length.update(f)
+            for item in remove_contigs:
+                counter[item] += ncontig[item]
+
+        parts = [task[5] for task in tasks if task[5]]
+        leftovers = [task[6] for task in tasks if pe == 1]
+        if leftovers:
+            # match up pairs with mates on different contigs
+            left = "%s.left.bam" % outfile
+            pysam.cat("-o", left + ".tmp", *leftovers)
+            pysam.sort("-n", "-o", left, left + ".tmp")
+            os.unlink(left + ".tmp")
+            leftfile = pysam.AlignmentFile(left, 'rb')
+            if write:
+                outleft = "%s.matched.bam" % outfile
+                leftbam = pysam.AlignmentFile(outleft, "wb",
+                                              template=samfile)
+                parts.append(outleft)
+            else:
+                leftbam = None
+            for name, group in itertools.groupby(
+                    leftfile.fetch(until_eof=True), lambda x: x.query_name):
+                _checkPair(sorted(group, key=_getPosition), filters, pe,
+                           counter, fragment_length, leftbam)
+            if leftbam is not None:
+                leftbam.close()
+            leftfile.close()
+            os.unlink(left)
+            for fn in leftovers:
+                os.unlink(fn)
+
+        if write:
+            if len(parts) == 1:
+                shutil.move(parts[0], "%s.bam" % outfile)
             else:
-                counter['multiple_or_1_read_in_pair'] += 1
-                if "secondary" not in filters:
-                    for v in values:
-                        outbam.write(v)
-        outbam.close()
+                pysam.cat("-o", "%s.bam" % outfile, *parts)
+                for fn in parts:
+                    os.unlink(fn)
 
-    elif pe == 1:
-        outbam = "%s.bam" % outfile
-        shutil.copy(infile, outbam)
-        for items, values in d.items():
-            l = abs(values[0].template_length)
-            fragment_length[l] += 1
-    else:
-        outbam = "%s.bam" % outfile
-        shutil.copy(infile, outbam)
     out = IOTools.openFile(infile.replace(".bam", ".fraglengths"), "w")
     out.write("frag_length\tfrequency\n")
     for key in fragment_length:
@@ -758,8 +1002,18 @@ def estimateInsertSize(infile, outfile, pe, nalignments, m2opts, conda_env):
     outf.close()
 
 
+def _pseudoReplicate(name, key):
+    '''
+    Assigns a read name to pseudo replicate 0 or 1 using a hash of the
+    name keyed with key, so that both reads of a pair are assigned to the
+    same replicate.
+    '''
+    digest = hashlib.blake2b(name.encode(), digest_size=1, key=key).digest()
+    return digest[0] & 1
+
+
 @cluster_runnable
-def makePseudoBams(infile, outfiles, pe, randomseed, filters):
+def makePseudoBams(infile, outfiles, pe, randomseed, filters, threads=1):
     '''
     Generates pseudo bam files by splitting a bam file into two
     equally sized subfiles.  Each read in the input bam is assigned
@@ -767,6 +1021,11 @@ def makePseudoBams(infile, outfiles, pe, randomseed, filters):
     If reads are paired end both reads in the pair are assigned
     to the same bam file.
 
+    Reads are assigned using a hash of the read name seeded with
+    randomseed, so mates go to the same pseudo bam without sorting
+    the input by name.  The input is read once in coordinate order
+    and the pseudo bams are written in coordinate order and indexed.
+
     Parameters
     ----------
     infile: str
@@ -783,92 +1042,45 @@ def makePseudoBams(infile, outfiles, pe, randomseed, filters):
         then reads are assumed to be paired end and a check is performed that
         each pseudo bam file contains exactly twice as many reads as read
         names. Anything else in this list is ignored by this function.
+    threads: int
+        number of threads to use for compressing the pseudo bam files
     '''
 
-    # read bam file
     bamfile = pysam.AlignmentFile(infile, "rb")
-    T = P.getTempFilename(".")
-    # sort
-    # pysam.sort("-n", infile, T, catch_stdout=False)
-    os.system("""samtools sort -n %(infile)s -o %(T)s.bam""" % locals())
-
-    sorted_bamfile = pysam.AlignmentFile("%s.bam" % T, "rb")
-
-    # for single end, count the reads, for paired end, halve number of reads
-    # then generate a random list of 0s and 1s of this length
-    # 0 = go to pseudo bam 0, 1 = go to pseudo bam 1
-    bamlength = bamfile.count()
-    if pe is True:
-        countreads = bamlength // 2
-    else:
-        countreads = bamlength
-    randomgen = np.random.RandomState()
-    randomgen.seed(randomseed)
-    intlist = randomgen.random_integers(0, 1, countreads)
-    outs = [pysam.AlignmentFile(outfiles[0], "wb", template=bamfile),
-            pysam.AlignmentFile(outfiles[1], "wb", template=bamfile)]
-    j = 0
-    i = 0
-    k = 0
-
-    # send reads to replicates according to the integers in intlist
-    dest = outfiles[i]
-    if pe is True:
-        for read in sorted_bamfile:
-            # if j is even
-            if j % 2 == 0:
-                # take item i from intlist
-                destint = intlist[i]
-                # sends to output bam file 0 or 1
-                dest = outs[destint]
-                i += 1
-            dest.write(read)
-            j += 1
-    else:
-        for read in sorted_bamfile:
-            destint = intlist[k]
-            dest = outs[destint]
-            dest.write(read)
-            k += 1
-
-    outs[0].close()
-    outs[1].close()
-    os.remove(T)
-    os.remove("%s.bam" % T)
-    lens = []
+    outs = [pysam.AlignmentFile(outfile, "wb", template=bamfile,
+                                threads=threads)
+            for outfile in outfiles]
+    key = str(randomseed).encode()
+
+    # counts of reads and first reads in pair in each pseudo bam
+    lens = [0, 0]
+    firsts = [0, 0]
+    for read in bamfile.fetch(until_eof=True):
+        dest = _pseudoReplicate(read.query_name, key)
+        outs[dest].write(read)
+        lens[dest] += 1
+        if read.is_read1:
+            firsts[dest] += 1
+
+    for out in outs:
+        out.close()
+    bamfile.close()
 
     # check that there are twice as many reads as read names for a paired
-    # end bam file and check the lengths of the files
-    for outf in outfiles:
-        T = P.getTempFilename(".")
-        os.system("""samtools sort %(outf)s -o %(T)s.bam;
-        samtools index %(T)s.bam""" % locals())
-#      pysam.sort(outf, T, catch_stdout=False)
-#      pysam.index("%s.bam" % T, catch_stdout=False)
-
-        bamfile = pysam.AlignmentFile("%s.bam" % T, "rb")
-        all = []
-        for nam in bamfile:
-            all.append(nam.qname)
-
-        if pe is True and "unpaired" in filters and "secondary" in filters:
-            allreads = len(all)
-            uniquereads = len(set(all))
-            expectedreads = len(all) // 2
+    # end bam file - every read name has exactly one first read
+    for outf, allreads, uniquereads in zip(outfiles, lens, firsts):
+        pysam.index(outf)
+        if pe and "unpaired" in filters and "secondary" in filters:
+            expectedreads = allreads // 2
             assert (
-                (len(set(all)) <= (len(all) // 2) + 2) &
-                (len(set(all)) >= (len(all) // 2) - 2)), """
+                (uniquereads <= expectedreads + 2) &
+                (uniquereads >= expectedreads - 2)), """
                 Error splitting bam file %(outf)s\
                 %(allreads)i reads in bam file and\
                 %(uniquereads)s unique read names -
                 expecting %(expectedreads)i unique read names\
                 """ % locals()
 
-        lens.append(bamfile.count())
-        os.remove(T)
-        shutil.move("%s.bam" % T, outf)
-        shutil.move("%s.bam.bai" % T, "%s.bai" % outf)
-
     E.info("Bamfile 1 length %i, Bamfile 2 length %i" % (lens[0], lens[1]))
 
 #############################################
@@ -2828,20 +3040,6 @@ def countPeaks(contig, start, end, samfiles, offsets=None):
 
     CG: THIS FUNCTION WAS COPIED FROM OLD PipelinePeakcalling to maintain
     compatability for pipeline_intervals.py. Could be removed if functionality
-    no longer needed.
+    no longer needed. It now uses the implementation in PipelineIntervals.
     '''
-
-    nreads, counts = getCounts(contig, start, end, samfiles, offsets)
-
-    length = end - start
-    avgval = numpy.mean(counts)
-    peakval = max(counts)
-
-    # set other peak parameters
-    peaks = numpy.array(list(range(0, length)))[counts >= peakval]
-    npeaks = len(peaks)
-    # peakcenter is median coordinate between peaks
-    # such that it is a valid peak in the middle
-    peakcenter = start + peaks[npeaks // 2]
-
-    return npeaks, peakcenter, length, avgval, peakval, nreads
+    return PipelineIntervals.countPeaks(contig, start, end, samfiles, offsets)
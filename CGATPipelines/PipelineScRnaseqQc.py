@@ -253,40 +253,54 @@ def cleanStatsTable(stats_file):
     return _df
 
 
-def extractTranscriptCounts(con, table):
+def extractTranscriptCounts(con, tables):
     '''
     Extract transcript model counts for a
-    given sample
+    set of samples
+
+    The tables are queried in batches with a single compound
+    query per batch rather than one query per table.
 
     Arguments
     ---------
     con: sqlite.connection
       An SQLite connection
 
-    table: string
-      the table to extract the transcript counts
+    tables: list
+      the tables to extract the transcript counts
       from.
 
     Returns
     -------
-    coverages: pandas.Core.Series
+    coverages: pandas.Core.DataFrame
+      with the columns `track` and `coverage_sense_pcovered`
     '''
 
-    statement = '''
-    SELECT coverage_sense_pcovered
-    FROM %(table)s
-    WHERE coverage_sense_nval > 0;
-    ''' % locals()
+    # sqlite limits the number of terms in a compound select
+    batch_size = 500
+    coverages = []
+    for x in range(0, len(tables), batch_size):
+        statement = " UNION ALL ".join(['''
+        SELECT '%(table)s' AS track, coverage_sense_pcovered
+        FROM %(table)s
+        WHERE coverage_sense_nval > 0''' % locals()
+                                        for table in tables[x:x + batch_size]])
+        coverages.append(pdsql.read_sql(statement, con))
+
+    if not coverages:
+        return pd.DataFrame(columns=["track", "coverage_sense_pcovered"])
 
-    coverages = pdsql.read_sql(statement, con)
-    coverages = coverages.loc[:, "coverage_sense_pcovered"]
-    return coverages
+    return pd.concat(coverages, ignore_index=True)
 
 
-def summariseOverBins(coverages, bins):
+def summariseOverBins(coverages, bins, tracks=None):
     '''
     Summarise model coverages over a set of bins
 
+    The first bin contains all values <= `bins[0]`, bin `i`
+    contains values in the interval (`bins[i-1]`, `bins[i]`].
+    Values above the last bin are ignored.
+
     Argumnets
     ---------
     coverages: pandas.Core.Series
@@ -295,23 +309,39 @@ def summariseOverBins(coverages, bins):
     bins: list
       values corresponding to percentage bins
 
+    tracks: pandas.Categorical
+      if given, coverages are summarised for each track
+      separately
+
     Returns
     -------
     freqs: numpy.array
-      frequency array of coverages over percentiles
+      frequency array of coverages over percentiles.  If
+      `tracks` is given, a matrix of tracks x bins with rows
+      in the order of `tracks.categories`.
     '''
 
-    freqs = np.zeros(shape=len(bins),
-                     dtype=np.float64)
-    for i in range(len(bins)):
-        if i == 0:
-            hits = coverages <= bins[i]
-        else:
-            hits = (coverages <= bins[i]) & (coverages > bins[i - 1])
-
-        freqs[i] = len(coverages[hits])
-
-    return freqs
+    nbins = len(bins)
+    idx = np.searchsorted(bins, np.asarray(coverages, dtype=np.float64),
+                          side="left")
+    if tracks is None:
+        codes = np.zeros(len(idx), dtype=np.int64)
+        ntracks = 1
+    else:
+        tracks = pd.Categorical(tracks)
+        codes = tracks.codes.astype(np.int64)
+        ntracks = len(tracks.categories)
+
+    # values above the last bin or NaN are not counted
+    keep = idx < nbins
+    freqs = np.bincount(codes[keep] * nbins + idx[keep],
+                        minlength=ntracks * nbins)
+    freqs = freqs.reshape(ntracks, nbins).astype(np.float64)
+
+    if tracks is None:
+        return freqs[0]
+    else:
+        return freqs
 
 
 def getModelCoverage(db, table_regex, model_type="transcript"):
@@ -346,16 +376,15 @@ def getModelCoverage(db, table_regex, model_type="transcript"):
     table_list = [tx[0] for tx in cursor.fetchall() if re.search(tab_reg,
                                                                  tx[0])]
 
-    # pull out counts for each cell and compute coverages
+    # pull out counts for all cells and compute coverages
 
     bins = list(range(0, 101))
-    cov_dict = {}
-    for tab in table_list:
-        covs = extractTranscriptCounts(dbh, tab)
-        freq_array = summariseOverBins(covs, bins)
-        cov_dict[tab] = freq_array
+    covs = extractTranscriptCounts(dbh, table_list)
+    freqs = summariseOverBins(covs["coverage_sense_pcovered"], bins,
+                              tracks=pd.Categorical(covs["track"],
+                                                    categories=table_list))
 
-    coverage_df = pd.DataFrame(cov_dict).T
+    coverage_df = pd.DataFrame(freqs, index=table_list)
     # create a regex group to remove superfluous characters
     # from the track names
     ix_re = re.compile(
@@ -15,7 +15,10 @@ Reference
 
 import os
 import re
+import shutil
+import zlib
 import collections
+import multiprocessing
 import pandas
 import math
 import numpy
@@ -307,6 +310,502 @@ def aggregateWindowsTagCounts(infiles,
     E.info("aggregateWindowsTagCounts: %s" % c)
 
 
+# windows shared with worker processes counting tags
+WINDOWS = None
+
+
+def _initWindows(windows):
+    global WINDOWS
+    WINDOWS = windows
+
+
+def readWindows(windowfile):
+    '''read windows from a :term:`bed` formatted file.
+
+    Windows are sorted by contig, start and end and duplicate
+    windows are removed.
+
+    Arguments
+    ---------
+    windowfile : string
+        Filename with windows in :term:`bed` format.
+
+    Returns
+    -------
+    contigs : list
+        Sorted list of contigs.
+    slices : dict
+        Rows of the windows on each contig.
+    starts : numpy.array
+        Window start coordinates.
+    ends : numpy.array
+        Window end coordinates.
+    '''
+    df = pandas.read_csv(windowfile, sep="\t", header=None,
+                         usecols=[0, 1, 2],
+                         dtype={0: str, 1: numpy.int64, 2: numpy.int64},
+                         comment="#")
+    df.columns = ["contig", "start", "end"]
+    df = df.drop_duplicates().sort_values(["contig", "start", "end"])
+
+    contigs = sorted(df["contig"].unique())
+    slices, first = {}, 0
+    sizes = df["contig"].value_counts()
+    for contig in contigs:
+        slices[contig] = slice(first, first + sizes[contig])
+        first += sizes[contig]
+
+    return (contigs, slices,
+            df["start"].values.copy(), df["end"].values.copy())
+
+
+def _countTagsInWindows(args):
+    '''count tags of a single sample in the windows in WINDOWS.
+
+    The tag file is read in chunks and the counts within each chunk
+    are added with a binary search of the sorted windows on each
+    contig.
+    '''
+    tagfile, outfile, counting_method, chunksize = args
+    contigs, slices, starts, ends = WINDOWS
+    counts = numpy.zeros(len(starts), dtype=numpy.int32)
+
+    reader = pandas.read_csv(tagfile, sep="\t", header=None,
+                             usecols=[0, 1, 2],
+                             dtype={0: str, 1: numpy.int64, 2: numpy.int64},
+                             chunksize=chunksize)
+    ntags = 0
+    for chunk in reader:
+        ntags += len(chunk)
+        for contig, tags in chunk.groupby(0, sort=False):
+            if contig not in slices:
+                continue
+            s = slices[contig]
+            tag_starts, tag_ends = tags[1].values, tags[2].values
+            if counting_method == "midpoint":
+                # window contains the midpoint of a tag
+                midpoints = numpy.sort(
+                    tag_starts + (tag_ends - tag_starts) // 2)
+                counts[s] += (
+                    numpy.searchsorted(midpoints, ends[s], side="left")
+                    - numpy.searchsorted(midpoints, starts[s], side="left"))
+            else:
+                # tag and window overlap by at least one base
+                counts[s] += (
+                    numpy.searchsorted(numpy.sort(tag_starts),
+                                       ends[s], side="left")
+                    - numpy.searchsorted(numpy.sort(tag_ends),
+                                         starts[s], side="right"))
+
+    numpy.save(outfile, counts)
+    E.info("counted %i tags in %s" % (ntags, tagfile))
+    return outfile
+
+
+class WindowsCounts(object):
+    '''a windows x samples matrix of tag counts stored in
+    compressed chunks.
+
+    Windows are sorted by contig and position and split into row
+    blocks of at most `blocksize` windows, blocks do not span
+    contigs.  The coordinates and the counts of each sample are
+    compressed separately for each block.  The store consists of
+    two files:
+
+    ``<filename>``
+        the concatenated compressed chunks.
+    ``<filename>.index.npz``
+        the tracks, contigs, the contig, first and last start, first
+        row and number of rows of each block, the offset and size
+        of each chunk and the maximum window length.
+
+    Blocks can be accessed by genomic region with :meth:`fetch` and
+    the counts of a single track with :meth:`getColumn`.  Only the
+    chunks required are decompressed, so that downstream tasks can
+    stream over the matrix block by block.
+
+    Stores are built with :func:`buildWindowsCounts`.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        index = numpy.load(filename + ".index.npz")
+        self.tracks = [str(x) for x in index["tracks"]]
+        self.contigs = [str(x) for x in index["contigs"]]
+        self.blocks = index["blocks"]
+        self.chunks = index["chunks"]
+        self.max_length = int(index["max_length"])
+        if os.path.getsize(filename) > 0:
+            self.data = numpy.memmap(filename, dtype=numpy.uint8, mode="r")
+        else:
+            self.data = None
+
+    def __len__(self):
+        return int(self.blocks[:, 4].sum())
+
+    def _getChunk(self, block, column, dtype):
+        offset, size = self.chunks[block, column]
+        return numpy.frombuffer(
+            zlib.decompress(self.data[offset:offset + size].tobytes()),
+            dtype=dtype)
+
+    def getCoordinates(self, block):
+        '''return contig, starts and ends of windows in `block`.'''
+        coords = self._getChunk(block, 0, numpy.dtype("<i8"))
+        return (self.contigs[self.blocks[block, 0]],
+                coords[0::2], coords[1::2])
+
+    def getCounts(self, block, tracks=None):
+        '''return counts of windows in `block` as a windows x
+        tracks matrix.
+
+        If `tracks` is given, only these tracks are decompressed.
+        '''
+        if tracks is None:
+            tracks = self.tracks
+        columns = [self.tracks.index(x) + 1 for x in tracks]
+        counts = numpy.zeros((self.blocks[block, 4], len(columns)),
+                             dtype=numpy.int32)
+        for x, column in enumerate(columns):
+            counts[:, x] = self._getChunk(block, column, numpy.dtype("<i4"))
+        return counts
+
+    def iterate(self, tracks=None):
+        '''iterate over blocks.
+
+        Yields tuples of contig, starts, ends and the windows
+        x tracks matrix of counts.
+        '''
+        for block in range(len(self.blocks)):
+            contig, starts, ends = self.getCoordinates(block)
+            yield contig, starts, ends, self.getCounts(block, tracks)
+
+    def getColumn(self, track):
+        '''return counts of `track` in all windows.'''
+        column = self.tracks.index(track) + 1
+        values = [numpy.zeros(0, dtype=numpy.int32)]
+        for block in range(len(self.blocks)):
+            values.append(self._getChunk(block, column, numpy.dtype("<i4")))
+        return numpy.concatenate(values)
+
+    def fetch(self, contig, start=None, end=None, tracks=None):
+        '''return windows overlapping a genomic region.
+
+        Arguments
+        ---------
+        contig : string
+            Contig name.
+        start : int
+            Start of region. If not given, the contig start.
+        end : int
+            End of region. If not given, the contig end.
+        tracks : list
+            Tracks to return. If not given, all tracks are returned.
+
+        Returns
+        -------
+        starts : numpy.array
+            Window start coordinates.
+        ends : numpy.array
+            Window end coordinates.
+        counts : numpy.array
+            Matrix of windows x tracks counts.
+        '''
+        if tracks is None:
+            tracks = self.tracks
+        if start is None:
+            start = 0
+        if end is None:
+            end = numpy.iinfo(numpy.int64).max
+
+        result = [(numpy.zeros(0, dtype=numpy.int64),
+                   numpy.zeros(0, dtype=numpy.int64),
+                   numpy.zeros((0, len(tracks)), dtype=numpy.int32))]
+
+        if contig in self.contigs:
+            code = self.contigs.index(contig)
+            # windows starting before start - max_length can not
+            # overlap the region
+            blocks = numpy.nonzero(
+                (self.blocks[:, 0] == code)
+                & (self.blocks[:, 1] < end)
+                & (self.blocks[:, 2] > start - self.max_length))[0]
+            for block in blocks:
+                contig, starts, ends = self.getCoordinates(block)
+                take = (starts < end) & (ends > start)
+                if take.any():
+                    result.append((starts[take], ends[take],
+                                   self.getCounts(block, tracks)[take]))
+
+        return tuple([numpy.concatenate(x) for x in zip(*result)])
+
+
+def writeWindowsCounts(outfile, contigs, slices, starts, ends,
+                       tracks, count_files, blocksize=100000):
+    '''write count vectors of several samples into a
+    :class:`WindowsCounts` store.
+
+    Arguments
+    ---------
+    outfile : string
+        Filename of the store.
+    contigs, slices, starts, ends :
+        Windows as returned by :func:`readWindows`.
+    tracks : list
+        Track names.
+    count_files : list
+        Filenames of :file:`.npy` formatted count vectors for each
+        track. The files are memory-mapped.
+    blocksize : int
+        Maximum number of windows in a block.
+    '''
+    counts = [numpy.load(x, mmap_mode="r") for x in count_files]
+
+    blocks, chunks = [], []
+    with open(outfile, "wb") as outf:
+
+        def _writeChunk(array):
+            buf = zlib.compress(array.tobytes())
+            offset = outf.tell()
+            outf.write(buf)
+            return offset, len(buf)
+
+        for code, contig in enumerate(contigs):
+            s = slices[contig]
+            for first in range(s.start, s.stop, blocksize):
+                last = min(first + blocksize, s.stop)
+                coords = numpy.empty(2 * (last - first), dtype="<i8")
+                coords[0::2] = starts[first:last]
+                coords[1::2] = ends[first:last]
+                chunk = [_writeChunk(coords)]
+                for values in counts:
+                    chunk.append(_writeChunk(
+                        numpy.asarray(values[first:last], dtype="<i4")))
+                blocks.append((code, starts[first], starts[last - 1],
+                               first, last - first))
+                chunks.append(chunk)
+
+    numpy.savez(outfile + ".index.npz",
+                tracks=numpy.array(tracks, dtype=str),
+                contigs=numpy.array(contigs, dtype=str),
+                blocks=numpy.array(blocks, dtype=numpy.int64).reshape(-1, 5),
+                chunks=numpy.array(chunks, dtype=numpy.int64).reshape(
+                    -1, len(tracks) + 1, 2),
+                max_length=max(0, numpy.max(ends - starts, initial=0)))
+
+
+@P.cluster_runnable
+def buildWindowsCounts(tagfiles,
+                       windowfile,
+                       outfile,
+                       counting_method="midpoint",
+                       regex="(.*)\.bed\.gz",
+                       threads=1,
+                       chunksize=1000000):
+    '''count tags of several samples within windows and
+    output a :class:`WindowsCounts` store.
+
+    Windows are read once and sorted. Tag files are read in chunks
+    and counted in parallel, one process per sample. Counts are
+    identical to the output of :func:`countTagsWithinWindows` and
+    :func:`aggregateWindowsTagCounts`.
+
+    Arguments
+    ---------
+    tagfiles : list
+        Filenames with tags to be counted in :term:`bed` format.
+    windowfile : string
+        Filename with windows in :term:`bed` format.
+    outfile : string
+        Filename of the store.
+    counting_method : string
+        Counting method to use. Possible values are ``nucleotide``
+        and ``midpoint``, see :func:`countTagsWithinWindows`.
+    regex : string
+        Regular expression used to extract the track name from the
+        filename.
+    threads : int
+        Number of samples to count in parallel.
+    chunksize : int
+        Number of tags to read at a time.
+    '''
+
+    if counting_method not in ("midpoint", "nucleotide"):
+        raise ValueError("unknown counting method: %s" % counting_method)
+
+    windows = readWindows(windowfile)
+    tracks = [re.search(regex, os.path.basename(x)).groups()[0]
+              for x in tagfiles]
+    E.info("counting %i samples in %i windows" %
+           (len(tracks), len(windows[2])))
+
+    tmpdir = P.getTempDir(".")
+    tasks = [(tagfile,
+              os.path.join(tmpdir, "%i.npy" % x),
+              counting_method,
+              chunksize) for x, tagfile in enumerate(tagfiles)]
+
+    if multiprocessing.current_process().daemon:
+        threads = 1
+    threads = min(threads, len(tasks))
+    if threads > 1:
+        pool = multiprocessing.Pool(threads, _initWindows, (windows,))
+        count_files = pool.map(_countTagsInWindows, tasks)
+        pool.close()
+        pool.join()
+    else:
+        _initWindows(windows)
+        count_files = [_countTagsInWindows(task) for task in tasks]
+        _initWindows(None)
+
+    writeWindowsCounts(outfile, *windows, tracks=tracks,
+                       count_files=count_files)
+    shutil.rmtree(tmpdir)
+
+
+def _getIntervalIds(contig, starts, ends):
+    return ["%s:%i-%i" % x for x in zip(
+        itertools.repeat(contig), starts, ends)]
+
+
+@P.cluster_runnable
+def outputWindowsCounts(infile, outfile):
+    '''output a :class:`WindowsCounts` store as a :term:`tsv`
+    formatted table.
+
+    The output has the same format as :func:`aggregateWindowsTagCounts`.
+    '''
+    store = WindowsCounts(infile)
+    with IOTools.openFile(outfile, "w") as outf:
+        outf.write("interval_id\t%s\n" % "\t".join(store.tracks))
+        for contig, starts, ends, counts in store.iterate():
+            df = pandas.DataFrame(counts,
+                                  index=_getIntervalIds(contig, starts, ends))
+            df.to_csv(outf, sep="\t", header=False)
+
+
+@P.cluster_runnable
+def normalizeWindowsCounts(infile, outfile):
+    '''normalize counts in a :class:`WindowsCounts` store to total
+    library size.
+
+    This is the equivalent of :func:`normalizeBed` streaming over the
+    store block by block. The geometric mean is accumulated over
+    blocks and the size factors are computed from one track at a
+    time.
+
+    Arguments
+    ---------
+    infile : string
+        Filename of a :class:`WindowsCounts` store.
+    outfile : string
+        Output filename in :term:`tsv` format.
+    '''
+    store = WindowsCounts(infile)
+
+    # geometric mean of all non-zero counts
+    sum_logs, nonzero = 0.0, 0
+    for contig, starts, ends, counts in store.iterate():
+        values = counts[counts > 0]
+        sum_logs += numpy.log(values).sum()
+        nonzero += len(values)
+    geom_mean = numpy.exp(sum_logs / max(1, nonzero))
+
+    size_factors = numpy.array(
+        [numpy.median(store.getColumn(x) / geom_mean)
+         for x in store.tracks])
+
+    header = True
+    with IOTools.openFile(outfile, "w") as outf:
+        for contig, starts, ends, counts in store.iterate():
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                normalized = counts / size_factors
+            # replace infs and nans with 0s
+            normalized[~numpy.isfinite(normalized)] = 0.0
+            df = pandas.DataFrame(normalized,
+                                  index=_getIntervalIds(contig, starts, ends),
+                                  columns=store.tracks)
+            df.to_csv(outf, sep="\t", header=header, index_label="interval")
+            header = False
+
+
+@P.cluster_runnable
+def buildWindowsFoldChanges(infile, outfile,
+                            map_track2input=None,
+                            names=None,
+                            index_label="Window",
+                            pseudocount=1):
+    '''compute l2fold changes of tracks in a :class:`WindowsCounts`
+    store compared to their input or their median.
+
+    Counts in a track with an input are normalized by the ratio of
+    medians and divided by the input.  Counts in a track without
+    input are divided by the median of the track.  A `pseudocount`
+    is added to all counts.
+
+    Medians are computed reading one track at a time, the fold
+    changes are computed and output block by block.
+
+    Arguments
+    ---------
+    infile : string
+        Filename of a :class:`WindowsCounts` store.
+    outfile : string
+        Output filename in :term:`tsv` format.
+    map_track2input : dict
+        Dictionary mapping tracks to be output to their input track
+        or None. If not given, all tracks are compared to their
+        median.
+    names : dict
+        Output column names of tracks. Defaults to the track names.
+    index_label : string
+        Column name of window identifiers. If None, window identifiers
+        are not output.
+    pseudocount : int
+        Pseudocount to add to counts.
+    '''
+    store = WindowsCounts(infile)
+    if map_track2input is None:
+        map_track2input = dict([(x, None) for x in store.tracks])
+    if names is None:
+        names = {}
+
+    tracks = [x for x in store.tracks if x in map_track2input]
+    inputs = [x for x in store.tracks
+              if x in set(map_track2input.values())]
+    take = tracks + [x for x in inputs if x not in tracks]
+
+    medians = dict([(x, numpy.median(store.getColumn(x) + pseudocount))
+                    for x in take])
+
+    header = True
+    with IOTools.openFile(outfile, "w") as outf:
+        for contig, starts, ends, counts in store.iterate(take):
+            columns = dict([(x, counts[:, idx])
+                            for idx, x in enumerate(take)])
+            folds = numpy.zeros((len(starts), len(tracks)))
+            for idx, track in enumerate(tracks):
+                values = columns[track].astype(numpy.float64) + pseudocount
+                i = map_track2input[track]
+                if i is not None:
+                    # normalize by input
+                    ratio = medians[i] / medians[track]
+                    values *= ratio / (columns[i] + pseudocount)
+                else:
+                    # normalize by median
+                    values /= medians[track]
+                folds[:, idx] = numpy.log2(values)
+
+            df = pandas.DataFrame(folds,
+                                  columns=[names.get(x, x) for x in tracks])
+            if index_label is not None:
+                df.index = _getIntervalIds(contig, starts, ends)
+            df.to_csv(outf, sep="\t", header=header,
+                      index=index_label is not None,
+                      index_label=index_label)
+            header = False
+
+
 def normalizeTagCounts(infile, outfile, method):
     '''normalize Tag counts
 
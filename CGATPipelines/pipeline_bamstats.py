@@ -258,7 +258,10 @@ def strandSpecificity(infile, outfile):
 
     PipelineBamStats.getStrandSpecificity(infile,
                                           outfile,
-                                          iterations)
+                                          iterations,
+                                          threads=4,
+                                          submit=True,
+                                          job_threads=4)
 
 
 @follows(mkdir("BamFiles.dir"))
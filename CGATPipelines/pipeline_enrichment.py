@@ -293,7 +293,14 @@ EnrichmentTester and specified in the pipeline.ini.
 Statistical tests for enrichment are called by the EnrichmentTester class
 and specified as StatsTest subclasses.  The test type, multiple testing
 correction and signficance threshold are specified in the pipeline.ini.
-(Only FisherExactTest currently implemented)
+Fisher's exact test (FisherExactTest) and a competitive permutation test
+(PermutationTest) are implemented, with Bonferroni, Benjamini-Hochberg
+or Benjamini-Yekutieli correction.
+
+If method is set to builtin in the stats_gsea section of the pipeline.ini,
+the preprocessed ranked gene lists are tested against every available
+annotation with a preranked GSEA (PrerankedGSEA) instead of runGSEA.
+Results are written to gsea_results.dir.
 '''
 
 from ruffus import *
@@ -389,6 +396,7 @@ def preprocessGsea(infile, outfile):
 
 
 @active_if(PARAMS['analysis_gsea'] == 1)
+@active_if(PARAMS['stats_gsea_method'] != "builtin")
 @follows(preprocessGsea)
 @transform(preprocessGsea,
            regex("gsea_processed.dir/(.*).processed$"),
@@ -554,6 +562,14 @@ def foregroundsVsBackgrounds(infiles, outfiles):
                                                 PARAMS['db_species'],
                                                 int(PARAMS['stats_ngenes']),
                                                 PARAMS['id_type'],
+                                                nperm=int(PARAMS[
+                                                    'stats_nperm']),
+                                                seed=int(PARAMS[
+                                                    'stats_seed']),
+                                                threads=int(PARAMS[
+                                                    'stats_threads']),
+                                                job_threads=int(PARAMS[
+                                                    'stats_threads']),
                                                 submit=True)
 
 
@@ -606,8 +622,47 @@ def makeCytoscapeInputs(infiles, outfile):
     os.remove(T)
 
 
+@active_if(PARAMS['analysis_gsea'] == 1)
+@active_if(PARAMS['stats_gsea_method'] == "builtin")
+@follows(mapUnmappedAnnotations)
+@follows(mkdir("gsea_results.dir"))
+@product(preprocessGsea,
+         formatter(".+/(?P<NAM>.*).processed"),
+         "annotations.dir/*_genestoterms.tsv",
+         formatter(".+/(?P<NAM>.*)_genestoterms.tsv"),
+         [r'gsea_results.dir/{NAM[0][0]}_{NAM[1][0]}_all_results.tsv',
+          r'gsea_results.dir/{NAM[0][0]}_{NAM[1][0]}_sig_results.tsv'])
+def rankedListsVsAnnotations(infiles, outfiles):
+    '''
+    Runs a preranked gene set enrichment analysis of every preprocessed
+    ranked gene list against every AnnotationSet, without calling
+    runGSEA.  Analysis is performed based on the "stats_gsea"
+    parameters in the pipeline.ini, the _sig output file contains
+    significantly enriched terms only.
+    '''
+    threads = int(PARAMS['stats_gsea_threads'])
+    PipelineEnrichment.rankedListVsAnnotations(
+        infiles,
+        outfiles[0], outfiles[1],
+        PARAMS['stats_gsea_correction'],
+        float(PARAMS['stats_gsea_thresh']),
+        dbname,
+        int(PARAMS['stats_writegenes']),
+        int(PARAMS['stats_ngenes']),
+        PARAMS['id_gsea_to_convert'],
+        nperm=int(PARAMS['stats_gsea_permut']),
+        seed=int(PARAMS['stats_gsea_seed']),
+        threads=threads,
+        min_size=int(PARAMS['stats_gsea_min_size']),
+        max_size=int(PARAMS['stats_gsea_max_size']),
+        weight=float(PARAMS['stats_gsea_weight']),
+        job_threads=threads,
+        submit=True)
+
+
 @follows(makeCytoscapeInputs,
-         runGsea)
+         runGsea,
+         rankedListsVsAnnotations)
 def full():
     pass
 
@@ -79,7 +79,9 @@ import os
 import re
 import sqlite3
 import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
 import CGATPipelines.Pipeline as P
+import CGATPipelines.PipelineGWAS as PipelineGWAS
 
 # load options from the config file
 PARAMS = P.getParameters(
@@ -1226,27 +1228,36 @@ def flagRelated(infiles, outfile):
     P.run()
 
 
-@follows(calculateIdentityByDescent)
+@follows(calculateIdentityByDescent,
+         mkdir("plots.dir"),
+         mkdir("exclusions.dir"))
 @transform(calculateIdentityByDescent,
            regex("QC.dir/(.+).genome.gz"),
-           r"plots.dir/IBD-hist.png")
-def plotIbdHistogram(infile, outfile):
-    '''
-    plot the distribution of IBD estimates
+           [r"plots.dir/IBD-hist.png",
+            r"exclusions.dir/\1.ibd_related"])
+def plotIbdHistogram(infile, outfiles):
     '''
+    plot the distribution of IBD estimates and flag
+    related individuals
 
-    job_memory = "300G"
-
-    statement = '''
-    cgat qcs2qc
-    --task=flag_relations
-    --relationship-file=%(infile)s
-    --ibs-cutoff=%(relationship_cutoff)s
-    --plotting-path=plots.dir
-    --log=%(outfile)s.log
+    The pairwise IBD file is processed in blocks of
+    ``relationship_chunksize`` pairs, so memory does not
+    grow with the number of pairs.  Individuals to remove
+    such that no pairs with IBD >= ``relationship_cutoff``
+    remain are output to the ``.ibd_related`` file.  If
+    ``relationship_cutoff`` is not set, ``relationship_flag_cutoff``
+    is used.
     '''
 
-    P.run()
+    hist_file, exclude_file = outfiles
+
+    PipelineGWAS.flagRelatedIndividuals(
+        infile, hist_file, exclude_file,
+        cutoff=(PARAMS['relationship_cutoff']
+                or PARAMS['relationship_flag_cutoff']),
+        chunksize=int(PARAMS['relationship_chunksize']),
+        submit=True,
+        job_memory="4G")
 
 # ----------------------------------------------------------------------------------------#
 # ----------------------------------------------------------------------------------------#
@@ -2001,32 +2012,35 @@ def splitTargetVariants(infile, outfile):
     P.touch(outfile)
 
 
-@follows(splitTargetVariants)
+# buildLdStore is defined further down with the other LD tasks,
+# refer to it by name
+@follows(splitTargetVariants,
+         "buildLdStore")
 @transform("target_snps.dir/*",
            regex("target_snps.dir/(.+).target"),
            r"target_snps.dir/\1.exclude")
 def excludeLdVariants(infile, outfile):
     '''
-    Extract the variants in LD with target variant
+    Extract the variants in LD (r2 >= 0.1) with target variant
     to exclude from epistasis analysis
     '''
 
     contig = PARAMS['candidate_chromosome'].lstrip("chr")
-    ld_dir = os.path.join(os.getcwd(), "ld.dir")
-    ld_files = [lf for lf in os.listdir(ld_dir) if re.search(contig, lf)]
-    ld_fle = [os.path.join(ld_dir, bg)
-              for bg in ld_files if re.search("bgz$", bg)][0]
+    store = PipelineGWAS.LdStore(
+        os.path.join("ld.dir", "chr%s.ldstore" % contig))
 
     snp = infile.split("/")[-1].split(".")[0]
-    job_memory = "2G"
-
-    statement = '''tabix %(ld_fle)s %(contig)s:87500000-90354753 |
-    grep "%(snp)s" | awk '{ print } END {if (!NR) {print "Empty"} else {if($7 > 0.1) { print }}}'
-    | cut -f 3,6 | tr -s '\\t' '\\n' | tr -s ';' '\\n' | sort | uniq | grep -v %(snp)s
-    > %(outfile)s
-    '''
+    neighbours = store.fetchSnp(snp, min_r2=0.1)
 
-    P.run()
+    with IOTools.openFile(outfile, "w") as outf:
+        # multi-allelic variants may have several ids
+        ids = set([x for y in neighbours["SNP"] for x in y.split(";")])
+        ids.discard(snp)
+        if ids:
+            for neighbour in sorted(ids):
+                outf.write("%s\n" % neighbour)
+        else:
+            outf.write("Empty\n")
 
 
 @follows(splitTargetVariants,
@@ -3298,27 +3312,17 @@ def tabixIndexLd(infile, outfile):
 @follows(calcLd)
 @transform(calcLd,
            suffix(".ld.gz"),
-           ".load")
-def loadLd(infile, outfile):
+           ".ldstore")
+def buildLdStore(infile, outfile):
     '''
-    Load all LD values into separate tables,
-    use BP_A as the index
+    Build a compressed, indexed store of all pair-wise
+    LD values for fast look-up of the SNPs in LD with
+    a given SNP, see :class:`PipelineGWAS.LdStore`
     '''
 
-    job_memory = "60G"
-    # ld output files need whitespace substituting for tabs
-    temp_file = P.getTempFilename(shared=True)
-    statement = '''
-    zcat %(infile)s | tr -s " " "\\t" |
-     sed 's/^[[:space:]]*//g' |
-     sed 's/[[:space:]]$//g' > %(temp_file)s
-    '''
-
-    P.run()
-
-    P.load(temp_file, outfile,
-           job_memory=job_memory,
-           options="--add-index=BP_A")
+    PipelineGWAS.buildLdStore(infile, outfile,
+                              submit=True,
+                              job_memory="4G")
 
 # ----------------------------------------------------------------------------------------#
 # ----------------------------------------------------------------------------------------#
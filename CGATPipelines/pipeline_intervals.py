@@ -436,8 +436,25 @@ def loadIntervals(infile, outfile):
 
     c = E.Counter()
 
-    # count tags
-    for bed in Bed.iterator(IOTools.openFile(infile, "r")):
+    beds = list(Bed.iterator(IOTools.openFile(infile, "r")))
+
+    # count tags, reading the bam files once per contig
+    peaks = {}
+    if samfiles:
+        contigs = {}
+        for x, bed in enumerate(beds):
+            contigs.setdefault(bed.contig, []).append(x)
+        for contig, indices in contigs.items():
+            # sort by position so that nearby intervals are counted
+            # together
+            indices.sort(key=lambda x: beds[x].start)
+            peaks.update(zip(indices, PipelineIntervals.countPeaksInContig(
+                contig,
+                [(beds[x].start, beds[x].end) for x in indices],
+                samfiles,
+                offsets)))
+
+    for x, bed in enumerate(beds):
 
         c.input += 1
 
@@ -459,13 +476,7 @@ def loadIntervals(infile, outfile):
             score = 1
 
         if samfiles:
-            npeaks, peakcenter, length, avgval, peakval, nprobes = \
-                PipelineIntervals.countPeaks(
-                    bed.contig,
-                    bed.start,
-                    bed.end,
-                    samfiles,
-                    offsets)
+            npeaks, peakcenter, length, avgval, peakval, nprobes = peaks[x]
             if nprobes == 0:
                 c.skipped_reads += 1
 
@@ -398,7 +398,8 @@ def filterInputBAMs(infile, outfiles):
                                    PARAMS['filters_strip'],
                                    PARAMS['filters_qual'],
                                    PARAMS['filters_contigs_to_remove'],
-                                   PARAMS['filters_keepint'])
+                                   PARAMS['filters_keepint'],
+                                   int(PARAMS['filters_threads']))
 
 
 @follows(mkdir("filtered_bams.dir"))
@@ -426,7 +427,8 @@ def filterChipBAMs(infile, outfiles):
                                    PARAMS['filters_strip'],
                                    PARAMS['filters_qual'],
                                    PARAMS['filters_contigs_to_remove'],
-                                   PARAMS['filters_keepint'])
+                                   PARAMS['filters_keepint'],
+                                   int(PARAMS['filters_threads']))
 
 
 # ############################################################################
@@ -764,6 +766,9 @@ if int(PARAMS['IDR_run']) == 1:
                                            PARAMS['IDR_randomseed'],
                                            PARAMS['filters_bamfilters'].split(
                                                ","),
+                                           threads=int(PARAMS['IDR_threads']),
+                                           job_threads=int(
+                                               PARAMS['IDR_threads']),
                                            submit=True)
 else:
     @follows(mkdir('peakcalling_bams.dir'))
@@ -365,6 +365,10 @@ def runFastqc(infiles, outfile):
         infiles = infiles.replace("processed.dir/trimmed",
                                   "reconciled.dir/trimmed")
 
+    # nothing below depends on the job having finished, so with
+    # cluster_async the next input can be submitted right away
+    job_async = True
+
     statement = m.build((infiles,), outfile)
     P.run()
 
@@ -629,7 +629,12 @@ def identifyHighestDepth(infiles, outfile):
 @split(identifyHighestDepth,
        "fastq.dir/highest_counts_subset_*")
 def subsetRange(infile, outfiles):
-    '''subset highest depth sample to 10%-100% depth '''
+    '''subset highest depth sample to 10%-100% depth.
+
+    Reads are either taken from the start of the file or randomly
+    sampled, see ``subset_method`` in :file:`pipeline.ini`. The 100%
+    subset is a copy of the input.
+    '''
 
     outfile = "fastq.dir/highest_counts_subset.sentinel"
     infile_prefix = P.snip(os.path.basename(infile), ".sentinel")
@@ -655,7 +660,14 @@ def subsetRange(infile, outfiles):
 
     ignore_pipe_erors = True
     ignore_errors = True
-    m = PipelineMapping.SubsetHeads(limits=limits)
+    if PARAMS["subset_method"] == "heads":
+        m = PipelineMapping.SubsetHeads(limits=limits)
+    else:
+        m = PipelineMapping.SubsetRandoms(limits=limits,
+                                          method=PARAMS["subset_method"],
+                                          seed=PARAMS["subset_seed"],
+                                          nreads=int(nreads))
+
     statement = m.build((infile,), outfile)
 
     P.run()
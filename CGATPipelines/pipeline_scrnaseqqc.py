@@ -73,6 +73,7 @@ import glob
 import sqlite3
 import CGAT.Experiment as E
 import CGATPipelines.Pipeline as P
+import CGATPipelines.PipelineScRnaseqQc as PipelineScRnaseqQc
 
 # load options from the config file
 PARAMS = P.getParameters(
@@ -739,28 +740,19 @@ def getDuplicationStats(outfile):
 @originate("stats.dir/coverage_stats.tsv")
 def getCoverageStats(outfile):
     '''
-    Grab the gene model coverage stats table
-    from the mapping pipeline database
+    Compute the gene model coverage stats for each cell
+    from the transcript count tables in the mapping
+    pipeline database
 
-    This is a table in the report generated from a tracker,
-    need to actually make this table ourselves to get
-    5'/3' coverages
+    The tables are selected with the regular expression
+    ``mapping_coverage``.  The coverages of all cells are
+    summarised over percentage bins at once, see
+    :func:`PipelineScRnaseqQc.getModelCoverage`.
     '''
 
-    statement = '''
-    cgat extract_stats
-    --task=extract_table
-    --log=%(outfile)s.log
-    --database-port=3306
-    --database-backend=%(database_backend)s
-    --database-hostname=%(database_host)s
-    --database-username=%(database_username)s
-    --database=%(mapping_db)s
-    --table-name=%(mapping_picard_dups)s
-    > %(outfile)s
-    '''
-
-    P.run()
+    coverage_df = PipelineScRnaseqQc.getModelCoverage(
+        PARAMS["mapping_db"], PARAMS["mapping_coverage"])
+    coverage_df.to_csv(outfile, sep="\t", index_label="track")
 
 
 @follows(getDuplicationStats,
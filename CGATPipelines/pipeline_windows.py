@@ -111,9 +111,7 @@ import os
 import re
 import glob
 import csv
-import numpy
 import sqlite3
-import pandas
 
 import CGAT.Experiment as E
 import CGAT.IOTools as IOTools
@@ -840,27 +838,25 @@ def buildBigBed(infile, outfile):
         pass
 
 
-# @P.add_doc(PipelineWindows.countTagsWithinWindows
+# @P.add_doc(PipelineWindows.buildWindowsCounts)
 @follows(mkdir("counts.dir"))
-@transform(prepareTags,
-           regex(".*/(.*).bed.gz"),
-           add_inputs(buildWindows),
-           r"counts.dir/\1.counts.bed.gz")
-def countTagsWithinWindows(infiles, outfile):
+@merge((prepareTags, buildWindows),
+       r"counts.dir/windows_counts.tsv.gz")
+def aggregateWindowsTagCounts(infiles, outfile):
     '''
-    Count the number of reads mapped to each window
+    Count the number of reads mapped to each window in all
+    samples and aggregate tag counts into a single file.
+
+    The counts are stored in the chunked store
+    :file:`counts.dir/windows_counts.store` and output
+    as a :term:`tsv` formatted table.
 
     Parameters
     ----------
     infiles: list
-        list of filenames
-
-    infiles[0]: str
-        filename of :term:`bed` format file containing read counts for
-        all sites
-
-    infiles[1]: str
-        filename of :term: `bed` format file containing window positions
+        filenames of :term:`bed` formatted files with tags for
+        each sample followed by the filename of the :term:`bed`
+        formatted file with window positions
 
     tiling_counting_method: str
         :term:`PARAMS`
@@ -870,37 +866,29 @@ def countTagsWithinWindows(infiles, outfile):
         nucleotide counts the number of reads overlapping the window by at
         least one base.
 
+    tiling_counting_threads: int
+        :term:`PARAMS`
+        number of samples to count in parallel
+
     outfile: str
-        filename for :term:`bed` formatted file of read counts per window
+        output filename for compiled window read counts
     '''
-    bedfile, windowfile = infiles
-    PipelineWindows.countTagsWithinWindows(
-        bedfile,
+
+    tagfiles, windowfile = infiles[:-1], infiles[-1]
+    store = P.snip(outfile, ".tsv.gz") + ".store"
+
+    PipelineWindows.buildWindowsCounts(
+        tagfiles,
         windowfile,
-        outfile,
+        store,
         counting_method=PARAMS['tiling_counting_method'],
+        regex="(.*).bed.gz",
+        threads=PARAMS['tiling_counting_threads'],
+        submit=True,
+        job_threads=PARAMS['tiling_counting_threads'],
         job_memory=PARAMS['tiling_counting_memory'])
 
-
-# @P.add_doc(PipelineWindows.aggregateWindowsTagCounts)
-@merge(countTagsWithinWindows,
-       r"counts.dir/windows_counts.tsv.gz")
-def aggregateWindowsTagCounts(infiles, outfile):
-    '''
-    Aggregate tag counts into a single file.
-
-    Parameters
-    ----------
-    infiles: list
-        filenames of all :term:`bed` formatted window read count files
-
-    outfile: str
-        output filename for compiled window read counts
-    '''
-
-    PipelineWindows.aggregateWindowsTagCounts(infiles,
-                                              outfile,
-                                              regex="(.*).counts.bed.gz")
+    PipelineWindows.outputWindowsCounts(store, outfile, submit=True)
 
 
 # @P.add_doc(PipelineWindows.countTagsWithinWindows)
@@ -1093,8 +1081,6 @@ def mapTrack2Input(tracks):
     return map_track2input
 
 
-@follows(loadWindowsTagCounts,
-         aggregateWindowsTagCounts)
 @transform(aggregateWindowsTagCounts,
            suffix(".tsv.gz"),
            "_l2foldchange_input.tsv.gz")
@@ -1103,138 +1089,69 @@ def buildWindowsFoldChangesPerInput(infile, outfile):
     Compute fold changes for each sample compared to appropriate input.
     If no input is present, simply divide by average.
 
+    The fold changes are computed from the chunked window count store
+    built by :func:`aggregateWindowsTagCounts`, see
+    :func:`PipelineWindows.buildWindowsFoldChanges`.
+
     Parameters
     ----------
     infile: str
-        filename of log from database load of windows tag counts
+        filename of :term:`tsv` file with windows tag counts
     outfile: str
         filename of :term:`tsv` formatted file to write the fold change data
 
     '''
 
-    # get all data
-    # don't use the database! only 10,000 windows are
-    # loaded!!
-    dbh = connect()
-    cc = dbh.cursor()
-    cc.execute("SELECT * FROM windows_counts")
-    # data = cc.fetchall()
+    store = P.snip(infile, ".tsv.gz") + ".store"
 
-    # transpose, remove interval_id column
-    # data = list(zip(*data))
-    if infile.split(".")[-1] == "gz":
-        compression = "gzip"
-    else:
-        compression = None
-
-    data = pandas.read_table(infile, sep="\t",
-                             compression=compression,
-                             index_col=0, header=0)
-
-    new_columns = [x.replace("-", "_", 3) for x in data.columns]
-    data.columns = new_columns
-    columns = [x[0] for x in cc.description]
-    # columns = [data.columns]
-    E.warn(columns)
-    map_track2input = mapTrack2Input(columns)
-    take_tracks = [y for x, y in enumerate(columns) if y in map_track2input]
-    E.warn([y for x, y in enumerate(columns) if y in map_track2input])
-    take_input = [y for x, y in enumerate(
-        columns) if y in list(map_track2input.values()) and y is not None]
-
-    # build data frame
-    E.warn(take_tracks)
-    E.warn(take_input)
-    # dataframe = pandas.DataFrame(
-    #    dict([(columns[x], data[x]) for x in take_tracks]))
-    dataframe = data[[x for x in take_tracks]]
-    dataframe = dataframe.astype('float64')
-    # dataframe_input = pandas.DataFrame(
-    #   dict([(columns[x], data[x]) for x in take_input]))
-    dataframe_input = data[[q for q in take_input]]
-
-    E.warn(dataframe.index)
-    # raise ValueError("break here")
-    # add pseudocounts
-    pseudocount = 1
-    for column in dataframe.columns:
-        dataframe[column] += pseudocount
-    for column in dataframe_input.columns:
-        dataframe_input[column] += pseudocount
-
-    # compute normalization ratios
-    # total_input / total_column
     # MM: note that the input in pipeline.ini needs to be the same
     # as the dataframe header, not the actual filename
-    ratios = {}
-    for column in dataframe.columns:
-        i = map_track2input[column]
-        if i is not None:
-            ratios[column] = dataframe_input[
-                i].median() / dataframe[column].median()
-        else:
-            ratios[column] = None
+    tracks = PipelineWindows.WindowsCounts(store).tracks
+    names = dict([(x, x.replace("-", "_", 3)) for x in tracks])
+    map_name2track = dict([(y, x) for x, y in list(names.items())])
 
-    for column in dataframe.columns:
-        if ratios[column] is not None:
-            # normalize by input
-            dataframe[column] *= ratios[column] / \
-                dataframe_input[map_track2input[column]]
-        else:
-            # normalize by median
-            dataframe[column] /= dataframe[column].median()
-
-    dataframe = numpy.log2(dataframe)
-
-    dataframe.to_csv(IOTools.openFile(outfile, "w"),
-                     sep="\t", index_label="Window")
+    map_track2input = {}
+    for name, i in list(mapTrack2Input(
+            [names[x] for x in tracks]).items()):
+        if i is not None:
+            i = map_name2track[i]
+        map_track2input[map_name2track[name]] = i
+
+    PipelineWindows.buildWindowsFoldChanges(
+        store, outfile,
+        map_track2input=map_track2input,
+        names=names,
+        index_label="Window",
+        submit=True,
+        job_memory=PARAMS["tiling_counting_memory"])
 
 
-@transform(loadWindowsTagCounts,
-           suffix(".load"),
+@transform(aggregateWindowsTagCounts,
+           suffix(".tsv.gz"),
            "_l2foldchange_median.tsv.gz")
 def buildWindowsFoldChangesPerMedian(infile, outfile):
     '''
     Compute l2fold changes for each sample compared to the median count
     in the sample.
 
+    The fold changes are computed over all windows in the chunked
+    window count store built by :func:`aggregateWindowsTagCounts`.
+
     Parameters
     ----------
     infile: str
-        name of database load logfile for :term:`tsv` file of read counts
-        across windows
+        filename of :term:`tsv` file with windows tag counts
     outfile: str
         filename for :term:`tsv` formatted file to write the fold change data
     '''
 
-    # get all data
-    dbh = connect()
-    cc = dbh.cursor()
-    cc.execute("SELECT * FROM windows_counts")
-    data = cc.fetchall()
-
-    # transpose, remove interval_id column
-    data = list(zip(*data))
-    columns = [x[0] for x in cc.description]
+    store = P.snip(infile, ".tsv.gz") + ".store"
 
-    take_tracks = [x for x, y in enumerate(columns) if y != "interval_id"]
-    # build data frame
-    dataframe = pandas.DataFrame(
-        dict([(columns[x], data[x]) for x in take_tracks]))
-    dataframe = dataframe.astype('float64')
-
-    # add pseudocounts
-    pseudocount = 1
-    for column in dataframe.columns:
-        dataframe[column] += pseudocount
-
-    for column in dataframe.columns:
-        dataframe[column] /= dataframe[column].median()
-
-    dataframe = numpy.log2(dataframe)
-
-    dataframe.to_csv(IOTools.openFile(outfile, "w"),
-                     sep="\t", index=False)
+    PipelineWindows.buildWindowsFoldChanges(
+        store, outfile,
+        index_label=None,
+        submit=True,
+        job_memory=PARAMS["tiling_counting_memory"])
 
 
 @jobs_limit(PARAMS.get("jobs_limit_db", 1), "db")
@@ -1375,7 +1292,7 @@ def loadTagCountSummary(infile, outfile):
 
 
 # @P.add_doc(PipelineWindows.normalizeBed)
-@follows(buildWindows, countTagsWithinWindows)
+@follows(buildWindows, aggregateWindowsTagCounts)
 @transform((aggregateWindowsTagCounts,
             aggregateContextTagCounts),
            suffix(".tsv.gz"),
@@ -1385,6 +1302,9 @@ def normalizeBed(infile, outfile):
     Normalize counts in a bed file by total library size.
     Return as bedGraph format
 
+    Window counts are normalized block by block from the chunked
+    store built by :func:`aggregateWindowsTagCounts`.
+
     Parameters
     ----------
     infile: str
@@ -1394,6 +1314,13 @@ def normalizeBed(infile, outfile):
     '''
 
     # normalize count column by total library size
+    store = P.snip(infile, ".tsv.gz") + ".store"
+    if os.path.exists(store):
+        PipelineWindows.normalizeWindowsCounts(
+            store, outfile,
+            submit=True,
+            job_memory=PARAMS["tiling_counting_memory"])
+        return
 
     tmpfile = P.getTempFilename(shared=True)
 
@@ -41,6 +41,13 @@ lines. The script is also able to handle multiple outputs for jobs.
 On error, error messages are echoed and nothing is returned.  The
 temporary directory is not deleted to allow manual recovery.
 
+With the ``--stream`` option, chunks are submitted as soon as they
+have been created and results are output as soon as all previous
+chunks have finished, so that splitting the input, running the jobs
+and merging the results overlap. The option ``--max-chunks`` limits
+the number of chunks kept in the temporary directory. On error, the
+results of the chunks before the failed job will have been output.
+
 Examples
 --------
 
@@ -77,6 +84,7 @@ import subprocess
 import tempfile
 import shutil
 import stat
+import queue
 
 from multiprocessing.pool import Pool, ThreadPool
 
@@ -633,108 +641,118 @@ def hasFinished(retcode, filename, output_tag, logfile):
     return True
 
 
-def runDRMAA(data, environment):
-    '''run jobs in data using drmaa to connect to the cluster.'''
+def submitDRMAAJob(session, data, environment):
+    '''submit a single job in data to the cluster using drmaa.
 
-    # SNS: Error dection now taken care of with Cluster.py
-    # expandStatement function
+    Returns
+    -------
+    job : tuple
+        Tuple of jobid, path of the job script, chunk filename,
+        command and logfile.
+    '''
+    filename, cmd, options, tmpdir, subdirs = data
 
-    # working directory - needs to be the one from which the
-    # the script is called to resolve input files.
-    cwd = os.getcwd()
+    from_stdin, to_stdout = True, True
 
-    session = drmaa.Session()
-    session.initialize()
+    if subdirs:
+        outdir = "%s.dir/" % (filename)
+        os.mkdir(outdir)
+        cmd = re.sub("%DIR%", outdir, cmd)
 
-    jobids = []
-    kwargs = {}
+    x = re.search("'--log=(\S+)'", cmd) or re.search("'--L\s+(\S+)'", cmd)
+    if x:
+        logfile = filename + ".log"
+        cmd = cmd[:x.start()] + "--log=%s" % logfile + cmd[x.end():]
+    else:
+        logfile = filename + ".out"
 
-    for filename, cmd, options, tmpdir, subdirs in data:
+    if "%STDIN%" in cmd:
+        cmd = re.sub("%STDIN%", filename, cmd)
+        from_stdin = False
 
-        from_stdin, to_stdout = True, True
+    if "%STDOUT%" in cmd:
+        cmd = re.sub("%STDOUT%", filename + ".out", cmd)
+        to_stdout = False
 
-        if subdirs:
-            outdir = "%s.dir/" % (filename)
-            os.mkdir(outdir)
-            cmd = re.sub("%DIR%", outdir, cmd)
+    cmd = " ".join(re.sub("\t+", " ", cmd).split("\n"))
+    E.info("running statement:\n%s" % cmd)
 
-        x = re.search("'--log=(\S+)'", cmd) or re.search("'--L\s+(\S+)'", cmd)
-        if x:
-            logfile = filename + ".log"
-            cmd = cmd[:x.start()] + "--log=%s" % logfile + cmd[x.end():]
-        else:
-            logfile = filename + ".out"
+    job_script = tempfile.NamedTemporaryFile(dir=os.getcwd(), delete=False, mode="w+t")
+    job_script.write("#!/bin/bash\n")  # -l -O expand_aliases\n" )
+    job_script.write(Cluster.expandStatement(cmd) + "\n")
+    job_script.close()
 
-        if "%STDIN%" in cmd:
-            cmd = re.sub("%STDIN%", filename, cmd)
-            from_stdin = False
+    job_path = os.path.abspath(job_script.name)
 
-        if "%STDOUT%" in cmd:
-            cmd = re.sub("%STDOUT%", filename + ".out", cmd)
-            to_stdout = False
+    os.chmod(job_path, stat.S_IRWXG | stat.S_IRWXU)
 
-        cmd = " ".join(re.sub("\t+", " ", cmd).split("\n"))
-        E.info("running statement:\n%s" % cmd)
+    # get session for process - only one is permitted
 
-        job_script = tempfile.NamedTemporaryFile(dir=os.getcwd(), delete=False, mode="w+t")
-        job_script.write("#!/bin/bash\n")  # -l -O expand_aliases\n" )
-        job_script.write(Cluster.expandStatement(cmd) + "\n")
-        job_script.close()
+    job_name = "farm.py"
 
-        job_path = os.path.abspath(job_script.name)
+    options_dict = vars(options)
+    options_dict["workingdir"] = os.getcwd()
 
-        os.chmod(job_path, stat.S_IRWXG | stat.S_IRWXU)
+    if options.job_memory:
+        job_memory = options.job_memory
+    elif options.cluster_memory_default:
+        job_memory = options.cluster_memory_default
+    else:
+        job_memory = "2G"
 
-        # get session for process - only one is permitted
+    jt = Cluster.setupDrmaaJobTemplate(session, options_dict,
+                                       job_name, job_memory)
 
-        job_name = os.path.basename(kwargs.get("outfile", "farm.py"))
+    jt.remoteCommand = job_path
 
-        options_dict = vars(options)
-        options_dict["workingdir"] = os.getcwd()
+    # update the environment
+    e = {'BASH_ENV': options.bashrc}
+    if environment:
+        for en in environment:
+            try:
+                e[en] = os.environ[en]
+            except KeyError:
+                raise KeyError(
+                    "could not export environment variable '%s'" % en)
+    jt.jobEnvironment = e
 
-        if options.job_memory:
-            job_memory = options.job_memory
-        elif options.cluster_memory_default:
-            job_memory = options.cluster_memory_default
-        else:
-            job_memory = "2G"
+    # SNS: Native specifation setting abstracted
+    # to Pipeline/Cluster.setupDrmaaJobTemplate()
 
-        jt = Cluster.setupDrmaaJobTemplate(session, options_dict,
-                                           job_name, job_memory)
+    # use stdin for data
+    if from_stdin:
+        jt.inputPath = ":" + filename
 
-        jt.remoteCommand = job_path
+    # set paths.
 
-        # update the environment
-        e = {'BASH_ENV': options.bashrc}
-        if environment:
-            for en in environment:
-                try:
-                    e[en] = os.environ[en]
-                except KeyError:
-                    raise KeyError(
-                        "could not export environment variable '%s'" % en)
-        jt.jobEnvironment = e
+    # later: allow redirection of stdout and stderr to files
+    # could this even be across hosts?
+    if to_stdout:
+        jt.outputPath = ":" + filename + ".out"
+    else:
+        jt.outputPath = ":" + filename + ".stdout"
 
-        # SNS: Native specifation setting abstracted
-        # to Pipeline/Cluster.setupDrmaaJobTemplate()
+    jt.errorPath = ":" + filename + ".err"
 
-        # use stdin for data
-        if from_stdin:
-            jt.inputPath = ":" + filename
+    jobid = session.runJob(jt)
+    session.deleteJobTemplate(jt)
 
-        # set paths.
+    return jobid, job_path, filename, cmd, logfile
 
-        # later: allow redirection of stdout and stderr to files
-        # could this even be across hosts?
-        if to_stdout:
-            jt.outputPath = ":" + filename + ".out"
-        else:
-            jt.outputPath = ":" + filename + ".stdout"
 
-        jt.errorPath = ":" + filename + ".err"
+def runDRMAA(data, environment):
+    '''run jobs in data using drmaa to connect to the cluster.'''
 
-        jobid = session.runJob(jt)
-        jobids.append((jobid, job_path, filename, cmd, logfile))
+    # SNS: Error dection now taken care of with Cluster.py
+    # expandStatement function
+
+    session = drmaa.Session()
+    session.initialize()
+
+    jobids = []
+
+    for job in data:
+        jobids.append(submitDRMAAJob(session, job, environment))
 
     E.debug("%i jobs have been submitted" % len(jobids))
 
@@ -760,10 +778,209 @@ def runDRMAA(data, environment):
 
         os.unlink(job_path)
 
-    session.deleteJobTemplate(jt)
     session.exit()
 
 
+class PoolExecutor:
+
+    '''run jobs with :func:`runCommand` in a process or thread pool.
+
+    Completed jobs are collected in the order in which they finish.
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.completed = queue.Queue()
+
+    def submit(self, idx, data):
+        self.pool.apply_async(
+            runCommand, (data,),
+            callback=lambda result: self.completed.put((idx, result)),
+            error_callback=lambda msg: self.completed.put((idx, msg)))
+
+    def wait(self, block=True):
+        '''return the next completed job as a tuple (idx, result).
+
+        If `block` is False, return None if no job has completed.
+        '''
+        try:
+            idx, result = self.completed.get(block)
+        except queue.Empty:
+            return None
+        if isinstance(result, Exception):
+            raise result
+        return idx, result
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class DRMAAExecutor:
+
+    '''run jobs on the cluster using drmaa.
+
+    Completed jobs are collected in the order in which they finish.
+    '''
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.session = drmaa.Session()
+        self.session.initialize()
+        self.jobs = {}
+
+    def submit(self, idx, data):
+        jobid, job_path, filename, cmd, logfile = submitDRMAAJob(
+            self.session, data, self.environment)
+        self.jobs[jobid] = (idx, job_path, filename, cmd, logfile)
+
+    def wait(self, block=True):
+        '''return the next completed job as a tuple (idx, result).
+
+        If `block` is False, return None if no job has completed.
+        '''
+        if block:
+            timeout = drmaa.Session.TIMEOUT_WAIT_FOREVER
+        else:
+            timeout = drmaa.Session.TIMEOUT_NO_WAIT
+        try:
+            retval = self.session.wait(drmaa.Session.JOB_IDS_SESSION_ANY,
+                                       timeout)
+        except drmaa.ExitTimeoutException:
+            return None
+
+        idx, job_path, filename, cmd, logfile = self.jobs.pop(retval.jobId)
+        os.unlink(job_path)
+
+        if retval.hasExited:
+            retcode = retval.exitStatus
+        else:
+            retcode = -1
+        return idx, (retcode, filename, cmd, logfile, 1)
+
+    def close(self):
+        self.session.exit()
+
+
+def runStreaming(chunks, cmd, options, executor, builder):
+    '''submit chunks as soon as they are produced and output results
+    in order while later chunks are still running.
+
+    At most ``options.max_chunks`` chunks are kept on disk, chunks
+    whose results have been output are removed. If a job fails, no
+    further chunks are submitted and no further results are output.
+
+    Arguments
+    ---------
+    chunks : iterator
+        Iterator over filenames of chunks, see `chunk_iterator_*`.
+    cmd : string
+        Command to execute.
+    options : object
+        Command line options.
+    executor : object
+        :class:`PoolExecutor` or :class:`DRMAAExecutor` to run jobs.
+    builder : object
+        :class:`ResultBuilder` to merge results into stdout.
+
+    Returns
+    -------
+    started_requests : list
+        Tuples of chunk filename and output filename.
+    failed_requests : list
+        Tuples of chunk filename and command of failed jobs.
+    niterations : int
+        Number of job executions.
+    '''
+    started_requests, failed_requests = [], []
+    finished = set()
+    niterations, running, merged = 0, 0, 0
+    exhausted = False
+
+    while True:
+
+        if (not exhausted and not failed_requests
+                and len(started_requests) - merged < options.max_chunks):
+            try:
+                filename = next(chunks)
+            except StopIteration:
+                exhausted = True
+            else:
+                executor.submit(
+                    len(started_requests),
+                    (filename, cmd, options, None, options.subdirs))
+                started_requests.append((filename, filename + ".out"))
+                running += 1
+            block = False
+        elif running == 0:
+            break
+        else:
+            block = True
+
+        # collect completed jobs
+        while running:
+            result = executor.wait(block)
+            if result is None:
+                break
+            block = False
+            running -= 1
+
+            idx, (retcode, filename, c, logfile, iterations) = result
+            niterations += iterations
+            if hasFinished(retcode, filename, options.output_tag, logfile):
+                finished.add(idx)
+            else:
+                failed_requests.append((filename, c))
+
+        if failed_requests:
+            continue
+
+        # output results that are ready in order
+        while merged in finished:
+            fi, fn = started_requests[merged]
+            builder([(fi, fn)], options.stdout, options)
+            options.stdout.flush()
+            if not options.debug:
+                os.unlink(fi)
+                os.unlink(fn)
+            finished.remove(merged)
+            merged += 1
+
+    executor.close()
+
+    E.info("streamed results from %i out of %i chunks" %
+           (merged, len(started_requests)))
+
+    return started_requests, failed_requests, niterations
+
+
+def getResultBuilder(options, mapper):
+    '''return result builder for stdout.'''
+
+    name = None
+    index = None
+
+    for pattern, column in options.renumber_column:
+
+        if re.search(pattern, "stdout"):
+            try:
+                index = int(column) - 1
+            except ValueError:
+                name = column
+                break
+
+    if options.binary:
+        return ResultBuilderBinary()
+    else:
+        regex = None
+        if options.output_regex_header:
+            regex = re.compile(options.output_regex_header)
+        return ResultBuilder(mapper=mapper,
+                             field_index=index,
+                             field_name=name,
+                             header_regex=regex)
+
+
 def getOptionParser():
     """create parser and add options."""
 
@@ -912,6 +1129,17 @@ def getOptionParser():
         help="Pattern for secondary output filenames. Should contain a '%s' "
         "[%default].")
 
+    parser.add_option(
+        "--stream", dest="stream", action="store_true",
+        help="submit chunks as soon as they have been created and output "
+        "results in order while later chunks are still running. Results "
+        "of chunks before a failed job will have been output [%default].")
+
+    parser.add_option(
+        "--max-chunks", dest="max_chunks", type="int",
+        help="in streaming mode, maximum number of chunks that have been "
+        "created but whose results have not been output yet [%default].")
+
     parser.set_defaults(
         split_at_lines=None,
         split_at_column=None,
@@ -943,6 +1171,8 @@ def getOptionParser():
         binary=False,
         environment=[],
         output_pattern="%s",
+        stream=False,
+        max_chunks=100,
     )
 
     # stop parsing options at the first argument
@@ -983,6 +1213,11 @@ def main(argv=None):
     started_requests = []
     niterations = 0
 
+    if options.renumber:
+        mapper = MapperLocal(pattern=options.renumber)
+    else:
+        mapper = MapperEmpty()
+
     if not options.collect:
         tmpdir = os.path.abspath(tempfile.mkdtemp(dir=options.tmpdir))
 
@@ -1006,21 +1241,35 @@ def main(argv=None):
         else:
             raise ValueError("please specify a way to chunk input data")
 
-        data = [(x, cmd, options, None, options.subdirs)
-                for x in chunk_iterator(
-                    options.stdin,
-                    args,
-                    prefix=tmpdir,
-                    use_header=options.input_header)]
-
-        started_requests = [(x[0], x[0] + ".out") for x in data]
+        chunks = chunk_iterator(options.stdin,
+                                args,
+                                prefix=tmpdir,
+                                use_header=options.input_header)
+
+        if options.stream:
+            if options.method == "multiprocessing":
+                executor = PoolExecutor(Pool(options.cluster_num_jobs))
+            elif options.method == "drmaa":
+                executor = DRMAAExecutor(options.environment)
+            elif options.method == "threads":
+                executor = PoolExecutor(ThreadPool(options.cluster_num_jobs))
+
+            started_requests, failed_requests, niterations = runStreaming(
+                chunks, cmd, options, executor,
+                getResultBuilder(options, mapper))
+        else:
+            data = [(x, cmd, options, None, options.subdirs)
+                    for x in chunks]
+            started_requests = [(x[0], x[0] + ".out") for x in data]
 
-        if len(data) == 0:
+        if len(started_requests) == 0:
             E.warn("no data received")
             E.Stop()
             sys.exit(0)
 
-        if options.method == "multiprocessing":
+        if options.stream:
+            results = []
+        elif options.method == "multiprocessing":
             pool = Pool(options.cluster_num_jobs)
             results = pool.map(runCommand, data, chunksize=1)
         elif options.method == "drmaa":
@@ -1030,7 +1279,6 @@ def main(argv=None):
             pool = ThreadPool(options.cluster_num_jobs)
             results = pool.map(runCommand, data, chunksize=1)
 
-        niterations = 0
         for retcode, filename, cmd, logfile, iterations in results:
             niterations += iterations
             if not hasFinished(retcode, filename, options.output_tag, logfile):
@@ -1049,35 +1297,10 @@ def main(argv=None):
     else:
         E.info("building result from %i parts" % len(started_requests))
 
-        if options.renumber:
-            mapper = MapperLocal(pattern=options.renumber)
-        else:
-            mapper = MapperEmpty()
-
-        # deal with stdout
-        name = None
-        index = None
-
-        for pattern, column in options.renumber_column:
-
-            if re.search(pattern, "stdout"):
-                try:
-                    index = int(column) - 1
-                except ValueError:
-                    name = column
-                    break
-
-        if options.binary:
-            ResultBuilderBinary()(started_requests, options.stdout, options)
-        else:
-            regex = None
-            if options.output_regex_header:
-                regex = re.compile(options.output_regex_header)
-            ResultBuilder(mapper=mapper,
-                          field_index=index,
-                          field_name=name,
-                          header_regex=regex
-                          )(started_requests, options.stdout, options)
+        # deal with stdout, already output in streaming mode
+        if not options.stream or options.collect:
+            getResultBuilder(options, mapper)(
+                started_requests, options.stdout, options)
 
         # deal with logfiles : combine them into a single file
         rr = re.search("'--log=(\S+)'", cmd) or re.search("'--L\s+(\S+)'", cmd)
@@ -1165,5 +1388,10 @@ def main(argv=None):
 
     E.Stop()
 
+    # in streaming mode, results of completed chunks have already been
+    # written to stdout, so signal the failure through the exit status
+    if options.stream and failed_requests:
+        return 1
+
 if __name__ == '__main__':
     sys.exit(main())
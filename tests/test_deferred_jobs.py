@@ -0,0 +1,108 @@
+'''test_deferred_jobs - test deferred collection of cluster jobs
+================================================================
+
+:Author: Andreas Heger
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+This script tests that ruffus jobs of tasks setting ``job_async``
+are run through :class:`CGATPipelines.Pipeline.Control.DeferredJobPool`
+without waiting for their cluster jobs. Cluster jobs are simulated by
+futures that are resolved after a delay, so no cluster is required.
+
+This script is best run within nosetests::
+
+   nosetests tests/test_deferred_jobs.py
+
+'''
+import concurrent.futures
+import tempfile
+import threading
+import time
+
+from nose.tools import ok_, assert_raises
+from ruffus import ruffus_exceptions
+
+import CGATPipelines.Pipeline.Execution as Execution
+import CGATPipelines.Pipeline.Parameters as Parameters
+from CGATPipelines.Pipeline.Control import DeferredJobPool
+
+# seconds each simulated cluster job takes
+JOB_TIME = 0.5
+
+
+def _runJob(options, job_memory, task_name):
+    '''submit a simulated cluster job for the statement in `options`.
+
+    Returns the future of the job and a function checking the job
+    in the same way as :func:`Execution._run` for deferred jobs.
+    '''
+    future = concurrent.futures.Future()
+    statement = options["statement"]
+    timer = threading.Timer(JOB_TIME, future.set_result, (statement,))
+    timer.daemon = True
+    timer.start()
+
+    def _collect(retval):
+        if "fail" in retval:
+            raise OSError("job failed: %s" % retval)
+
+    return future, _collect
+
+
+def runTask(args):
+    '''task function submitting a single deferred job.'''
+    outfile, statement = args
+    job_async = True
+    cluster_async = True
+    Execution.run()
+    return outfile
+
+
+def setUp():
+    global saved
+    saved = (Execution.PARAMS, Execution._run, Execution.GLOBAL_POLLER)
+    Execution.PARAMS = dict(Parameters.HARDCODED_PARAMS)
+    Execution.PARAMS.update({"workingdir": tempfile.mkdtemp(),
+                             "cluster_memory_default": "1G"})
+    Execution._run = _runJob
+    # deferral requires a poller, jobs are simulated by _runJob
+    Execution.GLOBAL_POLLER = object()
+
+
+def tearDown():
+    Execution.PARAMS, Execution._run, Execution.GLOBAL_POLLER = saved
+
+
+def test_deferred_jobs_complete():
+    '''ruffus jobs complete once their cluster jobs have finished.'''
+    pool = DeferredJobPool(2)
+    njobs = 8
+    start = time.time()
+    results = list(pool.imap_unordered(
+        runTask,
+        [("out%i" % x, "echo %i" % x) for x in range(njobs)]))
+    elapsed = time.time() - start
+    pool.close()
+
+    ok_(sorted(results) == sorted(["out%i" % x for x in range(njobs)]),
+        "unexpected results: %s" % results)
+    # results are held back until the cluster jobs have finished
+    ok_(elapsed >= JOB_TIME, "jobs completed after %fs" % elapsed)
+    # two threads run all jobs at once instead of two at a time
+    ok_(elapsed < JOB_TIME * njobs / 2,
+        "jobs took %fs, threads waited for cluster jobs" % elapsed)
+
+
+def test_failing_deferred_job_raises():
+    '''a failing cluster job stops the pipeline.'''
+    pool = DeferredJobPool(2)
+    jobs = [("out%i" % x, "echo %i" % x) for x in range(4)]
+    jobs.append(("out_fail", "fail"))
+    with assert_raises(ruffus_exceptions.RethrownJobError):
+        list(pool.imap_unordered(runTask, jobs))
+    pool.close()